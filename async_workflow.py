@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+LETDANCE 异步工作流
+基于asyncio的LetDanceWorkflow：LLM调用使用ainvoke，音乐生成使用异步HTTP，
+每个阶段有独立的截止时间，新一轮开始时协作式取消被取代的旧轮次
+"""
+
+import time
+import asyncio
+import logging
+import threading
+import functools
+import contextvars
+from typing import Dict, Any, Optional
+
+from config.azure_config import AzureConfig
+from client import create_async_music_client
+from main_agent import LetDanceWorkflow
+from pipeline import LLMUsageTracker
+from tools.circuit_breaker import start_latency_budget, CircuitOpenError, LatencyBudgetExceeded
+from tools.capture_control import start_capture_control
+
+# 配置日志
+logger = logging.getLogger(__name__)
+
+# 各阶段默认截止时间（秒）；采集阶段为姿态时长 + capture_margin
+DEFAULT_STAGE_TIMEOUTS = {
+    'capture_margin': 30.0,
+    'agent': 90.0,
+    'fusion': 20.0,
+    'music': 150.0
+}
+
+async def _settled(task: asyncio.Task) -> None:
+    """
+    等待任务结束，忽略它的结果、异常或取消
+
+    只吞掉被等待任务的结果：当前任务自己被取消时CancelledError照常抛出
+    """
+    await asyncio.wait({task})
+    if not task.cancelled():
+        # 读取异常，避免"Task exception was never retrieved"警告
+        task.exception()
+
+class AsyncLetDanceWorkflow(LetDanceWorkflow):
+    """
+    LETDANCE 异步工作流
+
+    - 摄像头工具本身是阻塞的，放到线程中运行；取消或超时时通过stop_event让姿态采集提前结束
+    - Agent与关键词融合使用ainvoke，受熔断器acall和阶段截止时间保护
+    - 音乐生成使用httpx异步客户端，取消时连接随任务一起中断
+    - Agent模式下工具在Agent的执行线程中运行，取消协程不会让它们停下：
+      超时或取消时通过采集控制通知摄像头工具提前结束，并等待摄像头释放后再降级或结束本轮
+    """
+
+    def __init__(self, mode: str = 'agent', use_keyword_cache: bool = True,
+                 stage_timeouts: Optional[Dict[str, float]] = None, speculative_music: bool = False):
+        super().__init__(mode, use_keyword_cache, speculative_music)
+        self.stage_timeouts = {**DEFAULT_STAGE_TIMEOUTS, **(stage_timeouts or {})}
+        # 配置了多台音乐生成服务时与同步客户端共用路由状态（健康、延迟、冷却）并同样对冲
+        self.async_music_client = create_async_music_client(self.music_client)
+        if self.speculator is not None:
+            # 异步推测生成未命中时可以直接取消HTTP请求
+            self.speculator.async_client = self.async_music_client
+        self._current_round: Optional[asyncio.Task] = None
+
+    async def acapture_round(self, duration: int = 10, mode: Optional[str] = None) -> Dict[str, Any]:
+        """capture_round的异步版本"""
+        mode = mode or self.mode
+        if mode not in self.WORKFLOW_MODES:
+            raise ValueError(f"不支持的工作流模式: {mode}，可选: {self.WORKFLOW_MODES}")
+
+        # 每个任务有独立的上下文，并行的轮次不会共用预算
+        start_latency_budget(AzureConfig.ROUND_LATENCY_BUDGET + duration)
+        round_state = {
+            'mode': mode,
+            'start_time': time.time(),
+            'usage_tracker': LLMUsageTracker()
+        }
+
+        if mode in ('pipeline', 'local'):
+            try:
+                round_state['tool_results'] = await self._acapture_tools(
+                    duration, image_backend='local' if mode == 'local' else 'azure'
+                )
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"流水线采集异常: {e}")
+                round_state['result'] = {
+                    'success': False,
+                    'message': f'流水线分析异常: {str(e)}',
+                    'music_keywords': [],
+                    'ready_for_music_generation': False,
+                    'azure_metrics': self.breaker.get_metrics()
+                }
+        else:
+            round_state['result'] = await self._aanalyze_with_agent(duration, round_state['usage_tracker'])
+
+        return round_state
+
+    async def _acapture_tools(self, duration: int, image_backend: str = 'azure') -> Dict[str, Any]:
+        """在线程中运行摄像头工具；超时或取消时通知姿态采集提前结束并等待摄像头释放"""
+        stop_event = threading.Event()
+        loop = asyncio.get_running_loop()
+        capture = functools.partial(
+            contextvars.copy_context().run, self.pipeline.capture, duration, stop_event, image_backend
+        )
+        future = loop.run_in_executor(None, capture)
+
+        try:
+            return await asyncio.wait_for(
+                asyncio.shield(future), timeout=duration + self.stage_timeouts['capture_margin']
+            )
+        except asyncio.TimeoutError:
+            # 超时：提前结束采集，用已采集到的数据继续
+            logger.warning("⏰ 采集阶段超时，提前结束姿态采集")
+            stop_event.set()
+            return await future
+        except asyncio.CancelledError:
+            # 被取代：停止采集并等待摄像头释放，避免与下一轮争用摄像头
+            stop_event.set()
+            try:
+                await future
+            except Exception:
+                pass
+            raise
+
+    async def _aanalyze_with_agent(self, duration: int, tracker: LLMUsageTracker) -> Dict[str, Any]:
+        """Agent模式的异步版本"""
+        try:
+            logger.info("开始LETDANCE分析流程（异步）")
+
+            compaction_stats = self.compactor.start_round()
+            # 工具随Agent的上下文拿到同一个采集控制对象
+            capture_control = start_capture_control()
+            try:
+                result = await asyncio.wait_for(
+                    self.breaker.acall(
+                        self.agent_executor.ainvoke, {"input": self._agent_input(duration)},
+                        {'callbacks': [tracker]}, label='agent'
+                    ),
+                    timeout=duration + self.stage_timeouts['agent']
+                )
+            except asyncio.TimeoutError:
+                self.breaker.record_failure('agent')
+                # 超时的Agent可能仍在执行线程中占用摄像头，释放后才能降级重新采集
+                await self._arelease_capture(capture_control)
+                return await self._adegraded_analysis(duration, 'Agent阶段超时')
+            except asyncio.CancelledError:
+                # 被取代：等摄像头释放后再结束，下一轮不会与孤立的采集线程争用摄像头
+                await self._arelease_capture(capture_control)
+                raise
+            except (CircuitOpenError, LatencyBudgetExceeded) as e:
+                return await self._adegraded_analysis(duration, str(e))
+
+            analysis = self._agent_result_to_analysis(result)
+            analysis['context_compaction'] = self.compactor.summarize(compaction_stats)
+            return analysis
+
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"分析流程异常: {e}")
+            return {
+                'success': False,
+                'message': f'分析流程异常: {str(e)}',
+                'music_keywords': [],
+                'ready_for_music_generation': False,
+                'azure_metrics': self.breaker.get_metrics()
+            }
+
+    async def _arelease_capture(self, capture_control) -> None:
+        """通知执行线程中的摄像头工具提前结束，并等待摄像头释放"""
+        await asyncio.to_thread(capture_control.stop_and_wait, self.stage_timeouts['capture_margin'])
+
+    async def _adegraded_analysis(self, duration: int, reason: str) -> Dict[str, Any]:
+        """在线程中执行降级分析（重新采集姿态），使用新的采集控制，被取消时同样等待摄像头释放"""
+        capture_control = start_capture_control()
+        try:
+            return await asyncio.to_thread(self._degraded_analysis, duration, reason)
+        except asyncio.CancelledError:
+            await self._arelease_capture(capture_control)
+            raise
+
+    async def acomplete_round(self, round_state: Dict[str, Any]) -> Dict[str, Any]:
+        """complete_round的异步版本，融合阶段超时时退回本地规则关键词"""
+        result = round_state.get('result')
+
+        # 离线模式的规则关键词在complete_round中同步生成（不涉及网络调用）
+        if result is None and round_state['mode'] != 'local':
+            pipeline_result = await self.pipeline.afinish(
+                round_state['tool_results'], callbacks=[round_state['usage_tracker']],
+                timeout=self.stage_timeouts['fusion']
+            )
+            round_state['result'] = self._pipeline_result_to_analysis(pipeline_result)
+
+        return self.complete_round(round_state)
+
+    async def aanalyze_and_generate_music_keywords(self, duration: int = 10,
+                                                   mode: Optional[str] = None) -> Dict[str, Any]:
+        """analyze_and_generate_music_keywords的异步版本"""
+        return await self.acomplete_round(await self.acapture_round(duration, mode))
+
+    async def agenerate_music(self, keywords: list, speculation=None) -> Dict[str, Any]:
+        """generate_music的异步版本，受music阶段截止时间限制；推测生成命中时直接使用其结果"""
+        prompt = ", ".join(keywords)
+        logger.info(f"生成音乐提示词: {prompt}")
+
+        try:
+            cached_file = await asyncio.to_thread(self.music_cache.get, keywords) if self.music_cache else None
+            if cached_file:
+                logger.info(f"🎼 命中音乐缓存: {cached_file}")
+                if speculation is not None:
+                    self.speculator.discard(speculation, '命中音乐缓存')
+                result = await asyncio.to_thread(self._play_generated_music, cached_file, keywords)
+                result['music_cache_hit'] = True
+                return result
+
+            if speculation is not None:
+                music_file = await asyncio.wait_for(
+                    self.speculator.aresolve(speculation, keywords), timeout=self.stage_timeouts['music']
+                )
+                if music_file:
+                    music_file = await asyncio.to_thread(self._cache_music, keywords, music_file)
+                    result = await asyncio.to_thread(self._play_generated_music, music_file, keywords)
+                    result['speculative'] = True
+                    return result
+
+            music_file = await asyncio.wait_for(
+                self.async_music_client.generate_music(prompt), timeout=self.stage_timeouts['music']
+            )
+        except asyncio.TimeoutError:
+            logger.error(f"⏰ 音乐生成超过{self.stage_timeouts['music']}秒，放弃本次生成")
+            return {
+                'success': False,
+                'message': '音乐生成超时',
+                'keywords_used': keywords,
+                'music_file': None
+            }
+
+        music_file = await asyncio.to_thread(self._cache_music, keywords, music_file)
+        return await asyncio.to_thread(self._play_generated_music, music_file, keywords)
+
+    async def arun_complete_workflow(self, duration: int = 10, mode: Optional[str] = None,
+                                     generate_music: bool = True) -> Dict[str, Any]:
+        """运行完整异步工作流：分析 -> 生成音乐关键词 -> （可选）生成音乐"""
+        round_state = await self.acapture_round(duration, mode)
+
+        # 启用推测时，采集完成后即用临时关键词开始生成音乐，与关键词融合并行
+        provisional = self.provisional_keywords(round_state)
+        cached = provisional and self.music_cache and self.music_cache.contains(provisional)
+        if generate_music and self.speculator is not None and provisional and not cached:
+            round_state['speculation'] = self.speculator.astart(provisional)
+
+        try:
+            analysis_result = await self.acomplete_round(round_state)
+
+            if not analysis_result['success'] or not generate_music:
+                self.discard_speculative_music(round_state, '本轮不生成音乐')
+                return analysis_result
+
+            music_result = await self.agenerate_music(analysis_result['music_keywords'], round_state.get('speculation'))
+        except asyncio.CancelledError:
+            # 被新一轮取代：推测生成的请求随之取消
+            self.discard_speculative_music(round_state, '本轮被取消')
+            raise
+
+        if self.speculator is not None:
+            music_result['speculation_stats'] = self.speculator.get_stats()
+
+        return {
+            'success': True,
+            'message': '完整工作流执行完成',
+            'analysis_result': analysis_result,
+            'music_result': music_result,
+            'final_keywords': analysis_result['music_keywords']
+        }
+
+    def start_round(self, duration: int = 10, mode: Optional[str] = None,
+                    generate_music: bool = True) -> asyncio.Task:
+        """
+        开始新一轮完整工作流；上一轮仍在进行时将其取消（协作式，已采集的摄像头会先释放）
+
+        Returns:
+            本轮的asyncio任务
+        """
+        previous = self._current_round
+        if previous is not None and not previous.done():
+            logger.info("⏭️ 上一轮被新一轮取代，正在取消")
+            previous.cancel()
+
+        self._current_round = asyncio.create_task(
+            self._run_after(previous, duration, mode, generate_music)
+        )
+        return self._current_round
+
+    async def _run_after(self, previous: Optional[asyncio.Task], duration: int,
+                         mode: Optional[str], generate_music: bool) -> Dict[str, Any]:
+        """等被取代的轮次完成清理（释放摄像头）后再开始本轮；等待期间本轮被取代时同样取消"""
+        if previous is not None:
+            await _settled(previous)
+
+        return await self.arun_complete_workflow(duration, mode, generate_music)
+
+    async def aclose(self):
+        """取消进行中的轮次并关闭异步HTTP客户端"""
+        if self._current_round is not None and not self._current_round.done():
+            self._current_round.cancel()
+            await _settled(self._current_round)
+        await self.async_music_client.aclose()
+
+async def main():
+    """独立运行测试：连续两轮，第二轮开始时取消第一轮"""
+    workflow = AsyncLetDanceWorkflow(mode='pipeline')
+    try:
+        workflow.start_round(duration=10, generate_music=False)
+        await asyncio.sleep(3)
+        result = await workflow.start_round(duration=10, generate_music=False)
+        print(f"关键词: {result.get('music_keywords')}")
+        print(f"指标: {result.get('metrics')}")
+    finally:
+        await workflow.aclose()
+
+if __name__ == "__main__":
+    asyncio.run(main())
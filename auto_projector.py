@@ -12,9 +12,16 @@ import time
 import webbrowser
 import os
 import sys
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
 from http.server import HTTPServer, SimpleHTTPRequestHandler
 from urllib.parse import urlparse
 from main_agent import LetDanceWorkflow
+from tools.circuit_breaker import get_circuit_breaker
+from tools.music_keywords_tool import MUSIC_KEYWORD_THEMES
+from keyword_cache import get_keyword_cache
+from music_cache import get_music_cache
+from microphone import get_playback_stats
 
 # 配置日志
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(message)s')
@@ -26,22 +33,22 @@ class EmotionMapper:
     KEYWORD_MAPPING = {
         # 主题1: 快乐/兴奋类 - 暖色调
         'theme1': {
-            'keywords': ['energetic', 'upbeat', 'cheerful', 'joyful', 'vibrant', 'lively', 'happy', 'excited', 'bright', 'dynamic'],
+            'keywords': MUSIC_KEYWORD_THEMES['theme1'],
             'emotion_text': '充满活力'
         },
         # 主题2: 平静/舒缓类 - 冷色调
         'theme2': {
-            'keywords': ['ambient', 'calm', 'peaceful', 'relaxing', 'gentle', 'serene', 'soft', 'soothing', 'tranquil', 'mellow'],
+            'keywords': MUSIC_KEYWORD_THEMES['theme2'],
             'emotion_text': '宁静舒缓'
         },
         # 主题3: 忧郁/深沉类 - 深色调
         'theme3': {
-            'keywords': ['melancholic', 'contemplative', 'introspective', 'emotional', 'sad', 'thoughtful', 'moody', 'nostalgic', 'brooding', 'reflective'],
+            'keywords': MUSIC_KEYWORD_THEMES['theme3'],
             'emotion_text': '深度思考'
         },
         # 主题4: 强烈/激情类 - 热色调
         'theme4': {
-            'keywords': ['intense', 'powerful', 'dramatic', 'epic', 'strong', 'aggressive', 'passionate', 'bold', 'fierce', 'energizing'],
+            'keywords': MUSIC_KEYWORD_THEMES['theme4'],
             'emotion_text': '强烈激情'
         }
     }
@@ -95,9 +102,67 @@ class AutoProjectorHandler(SimpleHTTPRequestHandler):
             self._send_json_response(emotions)
         elif parsed_path.path == '/api/status':
             self._send_json_response({'status': 'ready', 'auto_mode': True})
+        elif parsed_path.path == '/api/metrics':
+            workflow = getattr(self.server, 'workflow', None)
+            speculator = getattr(workflow, 'speculator', None)
+            music_queue = getattr(workflow, 'music_queue', None)
+            # 配置了多台音乐生成服务时为MusicBackendPool
+            music_backends = getattr(workflow, 'music_client', None)
+            if not hasattr(music_backends, 'backends'):
+                music_backends = None
+            engine = self._audio_engine()
+            self._send_json_response({
+                'azure': get_circuit_breaker('azure').get_metrics(),
+                'keyword_cache': get_keyword_cache().get_stats(),
+                'music_cache': get_music_cache().get_stats(),
+                'speculative_music': speculator.get_stats() if speculator else None,
+                'music_queue': music_queue.get_stats() if music_queue else None,
+                'music_transfer': workflow.music_client.get_transfer_stats() if workflow else None,
+                'music_backends': music_backends.get_stats() if music_backends else None,
+                'playback': get_playback_stats(),
+                'audio_engine': engine.status() if engine else None
+            })
+        elif parsed_path.path == '/api/audio':
+            engine = self._audio_engine()
+            self._send_json_response(engine.status() if engine else {'running': False})
         else:
             super().do_GET()
     
+    def do_POST(self):
+        """处理POST请求：音频引擎控制 {"action": "skip" | "stop" | "volume" | "crossfade", "value": 数值}"""
+        if urlparse(self.path).path != '/api/audio':
+            self._send_json_response({'error': 'not found'}, 404)
+            return
+        
+        engine = self._audio_engine()
+        if engine is None:
+            self._send_json_response({'error': '音频引擎未启用'}, 409)
+            return
+        
+        try:
+            command = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            action = command.get('action')
+            if action == 'skip':
+                engine.skip()
+            elif action == 'stop':
+                engine.stop()
+            elif action == 'volume':
+                engine.set_volume(float(command['value']))
+            elif action == 'crossfade':
+                engine.set_crossfade(float(command['value']))
+            else:
+                self._send_json_response({'error': f'未知操作: {action}'}, 400)
+                return
+        except (ValueError, KeyError, TypeError) as e:
+            self._send_json_response({'error': f'请求格式错误: {e}'}, 400)
+            return
+        
+        self._send_json_response(engine.status())
+    
+    def _audio_engine(self):
+        workflow = getattr(self.server, 'workflow', None)
+        return getattr(workflow, 'audio_engine', None)
+    
     def _send_json_response(self, data, status=200):
         """发送JSON响应"""
         self.send_response(status)
@@ -113,12 +178,20 @@ class AutoProjectorHandler(SimpleHTTPRequestHandler):
 class AutoProjectorSystem:
     """全自动投影系统"""
     
-    def __init__(self, port=8080):
+    def __init__(self, port=8080, workflow_mode=None, generate_music=False):
         self.port = port
+        # 工作流模式：agent / pipeline / local(离线)，默认读取环境变量 LETDANCE_WORKFLOW_MODE
+        self.workflow_mode = workflow_mode or os.getenv('LETDANCE_WORKFLOW_MODE', 'agent')
+        # 每轮是否在投影后生成并播放音乐
+        self.generate_music = generate_music
         self.server = None
         self.workflow = None
         self.running = True
         
+        # 流水线调度下各轮可能乱序完成，记录已投影的最新轮次
+        self._projection_lock = threading.Lock()
+        self._latest_projected_round = 0
+        
     def start_server(self):
         """启动Web服务器"""
         try:
@@ -170,58 +243,150 @@ class AutoProjectorSystem:
             logger.error(f"更新投影失败: {e}")
             return False
     
-    def run_continuous_analysis(self, interval=30):
-        """持续运行分析投影"""
-        logger.info(f"🔄 开始持续分析，间隔{interval}秒")
+    def run_continuous_analysis(self, interval=30, max_in_flight=2, duration=10):
+        """
+        持续运行分析投影（流水线调度）
+        
+        摄像头采集在调度线程中串行进行；关键词生成、投影更新和音乐生成交给后台线程，
+        下一轮采集可以在上一轮生成阶段仍在进行时开始。
+        
+        Args:
+            interval: 目标节奏，相邻两轮采集开始的间隔（秒），不是每轮结束后的额外等待
+            max_in_flight: 最多同时在途的轮次数（背压），达到上限时暂停新的采集
+            duration: 每轮姿态分析时长（秒）
+        """
+        logger.info(f"🔄 开始持续分析，目标节奏{interval}秒/轮，最多{max_in_flight}轮在途")
         
         # 初始化工作流
         try:
-            self.workflow = LetDanceWorkflow()
-            logger.info("✅ LETDANCE工作流初始化成功")
+            # 生成音乐时启用推测生成：临时关键词投影的同时开始生成音乐；
+            # 并启用生成队列，在轮次间隙为每个情绪主题预取曲目
+            # 连续多轮的音乐通过常驻音频引擎交叉淡化衔接
+            self.workflow = LetDanceWorkflow(mode=self.workflow_mode, speculative_music=self.generate_music,
+                                             use_music_queue=self.generate_music, audio_engine=self.generate_music)
+            if self.workflow.music_queue:
+                self.workflow.music_queue.start_prefetch()
+            if self.server:
+                self.server.workflow = self.workflow
+            logger.info(f"✅ LETDANCE工作流初始化成功（{self.workflow_mode}模式）")
         except Exception as e:
             logger.error(f"❌ 工作流初始化失败: {e}")
             return
         
+        in_flight = threading.BoundedSemaphore(max_in_flight)
+        executor = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix='letdance-round')
         analysis_count = 0
+        next_start = time.time()
         
-        while self.running:
-            try:
+        try:
+            while self.running:
+                # 按目标节奏等待下一轮开始；上一轮已超时则立即开始
+                while self.running and time.time() < next_start:
+                    time.sleep(max(0.0, min(1.0, next_start - time.time())))
+                
+                # 背压：在途轮次达到上限时等待
+                while self.running and not in_flight.acquire(timeout=1):
+                    pass
+                if not self.running:
+                    break
+                
                 analysis_count += 1
+                round_start = time.time()
+                next_start = round_start + interval
                 logger.info(f"\n{'='*20} 第{analysis_count}轮分析 {'='*20}")
                 
-                # 运行分析
-                result = self.workflow.analyze_and_generate_music_keywords(duration=10)
-                
-                if result['success'] and result['music_keywords']:
-                    keywords = result['music_keywords']
-                    logger.info(f"✅ 分析完成，关键词: {keywords}")
+                try:
+                    round_state = self.workflow.capture_round(duration=duration)
+                    logger.info(f"📷 第{analysis_count}轮采集完成，用时{time.time() - round_start:.1f}秒")
                     
-                    # 立即更新投影
-                    if self.update_projection(keywords):
-                        logger.info("🎨 投影效果已自动更新")
+                    # 先用本地规则关键词临时投影，LLM关键词返回后再覆盖
+                    provisional = self.workflow.provisional_keywords(round_state)
+                    if provisional and self._project_round(analysis_count, provisional, provisional=True):
+                        logger.info(f"⚡ 第{analysis_count}轮临时投影（本地规则）: {provisional}")
+                    if self.generate_music:
+                        self.workflow.start_speculative_music(round_state)
                     
-                    # 显示拉班分析摘要
-                    if result.get('laban_analysis_text'):
-                        logger.info("🤸 拉班动作分析完成")
+                    # 复制上下文，让后台线程沿用本轮的延迟预算
+                    context = contextvars.copy_context()
+                    future = executor.submit(context.run, self._complete_round, analysis_count, round_state)
+                    future.add_done_callback(lambda _: in_flight.release())
                     
-                else:
-                    logger.warning(f"⚠️  分析未成功: {result.get('message', '未知错误')}")
+                except KeyboardInterrupt:
+                    in_flight.release()
+                    logger.info("🛑 收到停止信号")
+                    break
+                except Exception as e:
+                    in_flight.release()
+                    logger.error(f"❌ 分析过程异常: {e}")
+                    logger.info("⏳ 等待10秒后重试...")
+                    next_start = time.time() + 10
+        finally:
+            executor.shutdown(wait=False)
+    
+    def _project_round(self, round_id, keywords, provisional=False):
+        """
+        投影某一轮的关键词，返回是否已投影
+        
+        各轮完成顺序可能与开始顺序不同，只用更新的轮次覆盖投影；
+        同一轮的最终关键词可以覆盖它自己的临时投影
+        """
+        with self._projection_lock:
+            if provisional:
+                is_latest = round_id > self._latest_projected_round
+            else:
+                is_latest = round_id >= self._latest_projected_round
+            if is_latest:
+                self._latest_projected_round = round_id
+        
+        if not is_latest:
+            logger.info(f"⏭️ 第{round_id}轮结果已过期（已投影第{self._latest_projected_round}轮），跳过投影更新")
+            return False
+        
+        return self.update_projection(keywords)
+    
+    def _complete_round(self, round_id, round_state):
+        """后台完成一轮分析：生成关键词 -> 更新投影 -> （可选）生成音乐"""
+        try:
+            result = self.workflow.complete_round(round_state)
+            
+            if result['success'] and result['music_keywords']:
+                keywords = result['music_keywords']
+                logger.info(f"✅ 第{round_id}轮分析完成，关键词: {keywords}")
+                
+                projected = self._project_round(round_id, keywords)
+                if projected:
+                    logger.info("🎨 投影效果已自动更新")
                 
-                # 等待下一轮分析
-                if self.running:
-                    logger.info(f"⏳ 等待{interval}秒后进行下一轮分析...")
-                    for i in range(interval):
-                        if not self.running:
-                            break
-                        time.sleep(1)
+                # 显示拉班分析摘要
+                if result.get('laban_analysis_text'):
+                    logger.info("🤸 拉班动作分析完成")
+                
+                if self.generate_music and projected:
+                    music_result = self.workflow.generate_music(keywords, round_state.get('speculation'))
+                    if not music_result['success']:
+                        logger.warning(f"🎵 第{round_id}轮音乐生成失败: {music_result['message']}")
+                    elif music_result.get('speculative'):
+                        logger.info(f"🔮 第{round_id}轮使用推测生成的音乐")
+                else:
+                    self.workflow.discard_speculative_music(round_state, '本轮结果未投影')
                 
-            except KeyboardInterrupt:
-                logger.info("🛑 收到停止信号")
-                break
-            except Exception as e:
-                logger.error(f"❌ 分析过程异常: {e}")
-                logger.info("⏳ 等待10秒后重试...")
-                time.sleep(10)
+            else:
+                self.workflow.discard_speculative_music(round_state, '分析未成功')
+                # 不投影失败结果，投影保持本轮的临时关键词（或上一轮的结果）
+                logger.warning(f"⚠️  第{round_id}轮分析未成功，保持当前投影: {result.get('message', '未知错误')}")
+            
+            if result.get('degraded'):
+                logger.warning("🔌 Azure不可用，本轮使用本地规则关键词")
+            elif result.get('rule_based'):
+                logger.info("📴 离线模式，本轮使用本地规则关键词")
+            elif result.get('cache_hit'):
+                logger.info("🗃️ 本轮命中关键词缓存，未调用LLM生成关键词")
+            
+            logger.info(f"⏱️ 第{round_id}轮总耗时{result['metrics']['wall_time']}秒")
+            
+        except Exception as e:
+            logger.error(f"❌ 第{round_id}轮生成阶段异常: {e}")
+            self.workflow.discard_speculative_music(round_state, '生成阶段异常')
     
     def stop(self):
         """停止系统"""
@@ -1,36 +1,253 @@
 import requests
 import json
 import os
+import re
+import time
+import uuid
+import base64
+import shutil
+import struct
+import zipfile
+import asyncio
+import threading
+import subprocess
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import httpx
+    HTTPX_AVAILABLE = True
+except ImportError:
+    HTTPX_AVAILABLE = False
+
+# 音乐生成服务地址，可通过环境变量指向本地服务替身（mock_music_server.py）
+DEFAULT_SERVER_URL = os.getenv('LETDANCE_MUSIC_SERVER', 'http://192.168.19.126:5000')
+
+# 多台音乐生成服务（逗号分隔），设置后按健康状态和延迟在各台之间路由
+SERVER_URLS_ENV = 'LETDANCE_MUSIC_SERVERS'
+
+# 表示服务不可用的状态码；其他5xx是单次生成失败（如某个提示词出错），不影响服务健康状态
+UNAVAILABLE_STATUS_CODES = (502, 503, 504)
+
+# 流式下载的分块大小，以及开始播放前需要缓冲的字节数（WAV头44字节 + 约0.3秒16bit立体声44.1kHz）
+STREAM_CHUNK_SIZE = 32 * 1024
+PLAYBACK_PREBUFFER = 64 * 1024
+
+# 可协商的传输格式：格式 -> Accept中的MIME类型；压缩格式需要本地ffmpeg解码
+AUDIO_FORMATS = {
+    'wav': 'audio/wav',
+    'flac': 'audio/flac',
+    'opus': 'audio/ogg; codecs=opus'
+}
+COMPRESSED_FORMATS = ('flac', 'opus')
+FFMPEG_AVAILABLE = shutil.which('ffmpeg') is not None
+
+# ffmpeg解码参数：输出16bit PCM WAV，去掉元数据块（流式播放器只认标准WAV头）
+FFMPEG_DECODE_ARGS = ['-f', 'wav', '-acodec', 'pcm_s16le', '-map_metadata', '-1', '-fflags', '+bitexact']
+
+def new_music_path(output_dir):
+    """生成不会重名的音乐文件路径（时间戳 + 随机后缀，同一秒内多次生成也不会互相覆盖）"""
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    return os.path.join(output_dir, f"music_{timestamp}_{uuid.uuid4().hex[:8]}.wav")
+
+def natural_sort_key(name):
+    """文件名排序键：数字部分按数值比较（track_2排在track_10之前）"""
+    return [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', name)]
+
+def negotiate_format(audio_format):
+    """确定请求的传输格式：本地没有ffmpeg时无法解码压缩音频，退回WAV"""
+    if audio_format not in AUDIO_FORMATS:
+        raise ValueError(f"不支持的音频格式: {audio_format}，可选: {tuple(AUDIO_FORMATS)}")
+    if audio_format in COMPRESSED_FORMATS and not FFMPEG_AVAILABLE:
+        print(f"未找到ffmpeg，无法解码{audio_format}，改为请求WAV")
+        return 'wav'
+    return audio_format
+
+def accept_header(audio_format):
+    """生成Accept请求头：首选格式，WAV作为兜底"""
+    if audio_format == 'wav':
+        return AUDIO_FORMATS['wav']
+    return f"{AUDIO_FORMATS[audio_format]}, {AUDIO_FORMATS['wav']};q=0.5"
+
+def response_format(content_type):
+    """根据响应的Content-Type判断音频格式（无法识别时按WAV处理）"""
+    mime = content_type.split(';')[0].strip().lower()
+    if mime in ('audio/flac', 'audio/x-flac'):
+        return 'flac'
+    if mime in ('audio/ogg', 'audio/opus'):
+        return 'opus'
+    return 'wav'
+
+def sniff_format(head):
+    """根据文件头判断音频格式（批量响应中的曲目没有单独的Content-Type）"""
+    if head[:4] == b'fLaC':
+        return 'flac'
+    if head[:4] == b'OggS':
+        return 'opus'
+    return 'wav'
+
+def decode_file(src, dst):
+    """用ffmpeg把压缩音频文件解码为WAV文件"""
+    subprocess.run(
+        ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-y', '-i', src] + FFMPEG_DECODE_ARGS + [dst],
+        check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+
+def fix_wav_header(path):
+    """回填RIFF和data块长度（ffmpeg输出到管道时无法回写，两处长度都是占位值）"""
+    size = os.path.getsize(path)
+    with open(path, 'r+b') as f:
+        header = f.read(12)
+        if header[:4] != b'RIFF' or header[8:12] != b'WAVE':
+            return
+        f.seek(4)
+        f.write(struct.pack('<I', size - 8))
+        
+        position = 12
+        while position + 8 <= size:
+            f.seek(position)
+            chunk_id = f.read(4)
+            if chunk_id == b'data':
+                f.write(struct.pack('<I', size - position - 8))
+                return
+            chunk_size = struct.unpack('<I', f.read(4))[0]
+            position += 8 + chunk_size + (chunk_size & 1)
+
+class TransferStats:
+    """音频传输统计：传输字节数、解码后字节数与解码耗时（线程安全）"""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {
+            'tracks': 0,
+            'compressed_tracks': 0,
+            'bytes_transferred': 0,
+            'bytes_decoded': 0,
+            'decode_time': 0.0
+        }
+    
+    def record(self, audio_format, bytes_transferred, bytes_decoded, decode_time=0.0):
+        """
+        记录一首曲目的传输
+        
+        Args:
+            audio_format: 实际传输的格式
+            bytes_transferred: 网络上传输的音频字节数
+            bytes_decoded: 解码后的WAV字节数（未压缩时与传输字节数相同）
+            decode_time: 下载结束后还需等待解码的时间（秒）
+        """
+        with self._lock:
+            self._stats['tracks'] += 1
+            self._stats['bytes_transferred'] += bytes_transferred
+            self._stats['bytes_decoded'] += bytes_decoded
+            if audio_format in COMPRESSED_FORMATS:
+                self._stats['compressed_tracks'] += 1
+                self._stats['decode_time'] += decode_time
+    
+    def get_stats(self):
+        """获取累计传输量、压缩率与平均解码耗时"""
+        with self._lock:
+            stats = dict(self._stats)
+        
+        compressed = stats['compressed_tracks']
+        stats['compression_ratio'] = (
+            round(stats['bytes_transferred'] / stats['bytes_decoded'], 3) if stats['bytes_decoded'] else None
+        )
+        stats['avg_decode_time'] = round(stats['decode_time'] / compressed, 3) if compressed else None
+        stats['decode_time'] = round(stats['decode_time'], 3)
+        return stats
 
 class MusicGenClient:
-    def __init__(self, server_url="http://192.168.19.126:5000"):
+    def __init__(self, server_url=DEFAULT_SERVER_URL, pool_maxsize=4, max_retries=2, health_ttl=30,
+                 audio_format='flac', connect_timeout=5, read_timeout=120):
         """
         初始化音乐生成客户端
         用于接收Agent生成的提示词并请求外部音乐生成服务
         
         Args:
             server_url: API服务器地址
+            pool_maxsize: 连接池中保持的长连接数（推测生成与正式生成可能同时请求）
+            max_retries: 连接失败的重试次数（生成请求不会在服务端已收到后重试）
+            health_ttl: 健康状态缓存时间（秒）
+            audio_format: 请求的传输格式（wav/flac/opus），压缩格式下载时边收边解码为WAV；
+                          服务端不支持时按响应的Content-Type处理
+            connect_timeout: 建立连接超时（秒）
+            read_timeout: 等待生成结果的超时（秒），批量请求按曲目数放大
         """
         self.server_url = server_url
         self.generate_url = f"{server_url}/generate_music"
         self.health_url = f"{server_url}/health"
+        self.health_ttl = health_ttl
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.audio_format = negotiate_format(audio_format)
+        self.transfer_stats = TransferStats()
+        
+        # 复用TCP连接，避免每次请求重新握手
+        retry = Retry(
+            total=max_retries,
+            backoff_factor=0.5,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=frozenset(['GET', 'HEAD'])  # POST只在连接建立失败时重试
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers['Accept'] = accept_header(self.audio_format)
+        
+        # 健康状态缓存，由健康检查和实际生成请求的结果刷新
+        self._health_lock = threading.Lock()
+        self._healthy = None
+        self._health_updated_at = 0.0
     
-    def check_health(self):
-        """检查音乐生成服务状态"""
+    def _record_health(self, healthy):
+        """记录服务健康状态"""
+        with self._health_lock:
+            self._healthy = healthy
+            self._health_updated_at = time.time()
+    
+    def _record_response_health(self, status_code):
+        """按生成请求的响应更新健康状态：502/503/504为不可用，其他5xx保持缓存的状态不变"""
+        if status_code in UNAVAILABLE_STATUS_CODES:
+            self._record_health(False)
+        elif status_code < 500:
+            self._record_health(True)
+    
+    def check_health(self, force=False):
+        """
+        检查音乐生成服务状态
+        
+        缓存未过期时直接返回缓存结果，不发起请求
+        
+        Args:
+            force: 忽略缓存，立即请求健康检查接口
+        """
+        with self._health_lock:
+            if not force and self._healthy is not None and time.time() - self._health_updated_at < self.health_ttl:
+                return self._healthy
+        
         try:
-            response = requests.get(self.health_url, timeout=5)
-            return response.status_code == 200
-        except:
-            return False
+            response = self.session.get(self.health_url, timeout=self.connect_timeout)
+            healthy = response.status_code == 200
+        except requests.RequestException:
+            healthy = False
+        
+        self._record_health(healthy)
+        return healthy
     
-    def generate_music(self, prompt, output_dir="generated_music"):
+    def generate_music(self, prompt, output_dir="generated_music", player=None):
         """
-        生成音乐
+        生成音乐（流式下载到文件，不在内存中保留整首音乐）
         
         Args:
             prompt: 音乐生成提示词
             output_dir: 输出目录
+            player: 可选的流式播放器（microphone.StreamingPlayer），
+                    收到WAV头和第一段缓冲后即开始播放，播放器在自己的线程中跟随读取下载中的文件
             
         Returns:
             生成的音频文件路径
@@ -39,39 +256,889 @@ class MusicGenClient:
         if not os.path.exists(output_dir):
             os.makedirs(output_dir)
         
-        # 准备请求数据
-        data = {"prompts": [prompt]}
+        # 准备请求数据（格式同时放在请求体中，兼容不解析Accept头的服务端）
+        data = {"prompts": [prompt], "format": self.audio_format}
         
         try:
-            # 发送请求
-            response = requests.post(
+            # 发送请求（复用会话中的长连接，响应体按块读取）
+            response = self.session.post(
                 self.generate_url,
                 json=data,
-                timeout=120  # 2分钟超时
+                timeout=(self.connect_timeout, self.read_timeout),
+                stream=True
             )
+            self._record_response_health(response.status_code)
             
-            if response.status_code == 200:
-                # 生成文件名
-                timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                filename = f"music_{timestamp}.wav"
-                filepath = os.path.join(output_dir, filename)
+            with response:
+                if response.status_code == 200:
+                    # 生成文件名
+                    filepath = new_music_path(output_dir)
+                    
+                    if response_format(response.headers.get('Content-Type', '')) in COMPRESSED_FORMATS:
+                        self._decode_to_file(response, filepath, player)
+                    else:
+                        self._stream_to_file(response, filepath, player, record=True)
+                    
+                    print(f"音乐生成成功，文件保存位置: {filepath}")
+                    return filepath
+                else:
+                    print(f"音乐生成失败，状态码: {response.status_code}")
+                    return None
                 
-                # 保存音频文件
-                with open(filepath, 'wb') as f:
-                    f.write(response.content)
+        except requests.ConnectionError as e:
+            # 只有连接失败说明服务不可用；读取超时或下载中断不改变健康状态
+            self._record_health(False)
+            print(f"音乐生成异常: {e}")
+            return None
+        except requests.RequestException as e:
+            print(f"音乐生成异常: {e}")
+            return None
+        except Exception as e:
+            print(f"音乐生成异常: {e}")
+            return None
+        finally:
+            if player is not None:
+                player.end()
+    
+    def _stream_to_file(self, response, filepath, player=None, record=False):
+        """
+        把响应体按块写入文件（未压缩的WAV或批量响应的压缩包）
+        
+        Args:
+            record: 是否计入传输统计（单曲WAV响应）
+        """
+        written = self._write_chunks(response.iter_content(chunk_size=STREAM_CHUNK_SIZE), filepath, player)
+        if record:
+            self.transfer_stats.record('wav', written, written)
+    
+    def _decode_to_file(self, response, filepath, player=None):
+        """
+        压缩音频边下载边解码：后台线程把响应体写入ffmpeg，解码出的WAV写入文件并送入播放器
+        """
+        audio_format = response_format(response.headers.get('Content-Type', ''))
+        decoder = subprocess.Popen(
+            ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-i', 'pipe:0'] + FFMPEG_DECODE_ARGS + ['pipe:1'],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+        )
+        download = {'bytes': 0, 'finished_at': None, 'error': None}
+        
+        def feed():
+            try:
+                for chunk in response.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+                    if chunk:
+                        decoder.stdin.write(chunk)
+                        download['bytes'] += len(chunk)
+            except BaseException as e:
+                download['error'] = e
+            finally:
+                download['finished_at'] = time.time()
+                try:
+                    decoder.stdin.close()
+                except OSError:
+                    pass
+        
+        feeder = threading.Thread(target=feed, name='music-download', daemon=True)
+        feeder.start()
+        
+        def finalize(temp_path):
+            # 下载和解码都成功后才改名为正式文件
+            feeder.join()
+            returncode = decoder.wait()
+            if download['error'] is not None:
+                raise download['error']
+            if returncode != 0:
+                raise RuntimeError(f"ffmpeg解码{audio_format}失败，返回码: {returncode}")
+            fix_wav_header(temp_path)
+        
+        try:
+            decoded = self._write_chunks(
+                iter(lambda: decoder.stdout.read(STREAM_CHUNK_SIZE), b''), filepath, player, finalize
+            )
+        except BaseException:
+            decoder.kill()
+            feeder.join()
+            raise
+        finally:
+            decoder.stdout.close()
+        
+        decode_time = max(0.0, time.time() - download['finished_at'])
+        self.transfer_stats.record(audio_format, download['bytes'], decoded, decode_time)
+        print(f"{audio_format}传输{download['bytes'] / 1024:.0f}KB，解码为{decoded / 1024:.0f}KB WAV，"
+              f"下载结束后解码用时{decode_time:.2f}秒")
+    
+    def _write_chunks(self, chunks, filepath, player=None, finalize=None):
+        """
+        按块写入临时文件，完成后原子改名（下载中断时不会留下不完整的音乐文件）
+        
+        传入播放器时，写满PLAYBACK_PREBUFFER字节且确认是WAV数据后开始播放；
+        播放器在自己的线程中跟随读取临时文件，这里只通知写入进度，下载按网络速度进行
+        
+        Args:
+            finalize: 改名前对临时文件的检查/修正，抛出异常时放弃该文件
+            
+        Returns:
+            写入的字节数
+        """
+        temp_path = f"{filepath}.part"
+        header = bytearray()
+        streaming = player is not None
+        written = 0
+        
+        try:
+            with open(temp_path, 'wb') as f:
+                for chunk in chunks:
+                    if not chunk:
+                        continue
+                    f.write(chunk)
+                    written += len(chunk)
+                    
+                    if not streaming:
+                        continue
+                    if len(header) < 12:
+                        header.extend(chunk[:12 - len(header)])
+                    if player.started:
+                        f.flush()
+                        streaming = player.advance(written)
+                    elif written >= PLAYBACK_PREBUFFER:
+                        f.flush()
+                        streaming = self._start_player(player, header, temp_path, written)
+            
+            # 音乐比预缓冲还短时，下载完成后再开始播放
+            if streaming and not player.started and written:
+                self._start_player(player, header, temp_path, written)
+            
+            if finalize is not None:
+                finalize(temp_path)
+            os.replace(temp_path, filepath)
+            return written
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            if player is not None and player.started:
+                player.abort()
+            raise
+    
+    def _start_player(self, player, header, temp_path, written):
+        """确认WAV头后让播放器开始跟随读取临时文件，返回是否继续流式播放"""
+        if header[:4] != b'RIFF' or header[8:12] != b'WAVE':
+            print("响应不是WAV数据，下载完成后再播放")
+            return False
+        return player.start(temp_path) and player.advance(written)
+    
+    def generate_many(self, prompts, output_dir="generated_music", batch_size=4):
+        """
+        批量生成音乐：每个请求携带最多batch_size个提示词，把多曲目响应拆分为单独的文件
+        
+        支持的响应格式：
+        - application/zip：压缩包内每个文件对应一个提示词（按文件名排序，数字部分按数值比较，
+          如track_2在track_10之前；与文件写入压缩包的顺序无关）
+        - application/json：{"tracks": [base64, ...]} 或 [{"audio": base64}, ...]
+        - 单个WAV：仅在该批只有一个提示词时接受
+        
+        Args:
+            prompts: 音乐生成提示词列表
+            output_dir: 输出目录
+            batch_size: 每个请求携带的提示词数
+            
+        Returns:
+            与prompts一一对应的结果列表：
+            {'prompt', 'music_file', 'success', 'batch_index', 'batch_time', 'time_per_track'}
+        """
+        os.makedirs(output_dir, exist_ok=True)
+        results = []
+        
+        for batch_index, start in enumerate(range(0, len(prompts), batch_size)):
+            batch = list(prompts[start:start + batch_size])
+            batch_start = time.time()
+            music_files = self._generate_batch(batch, output_dir)
+            batch_time = time.time() - batch_start
+            
+            print(f"第{batch_index + 1}批生成完成: {sum(1 for f in music_files if f)}/{len(batch)}首，"
+                  f"用时{batch_time:.1f}秒")
+            
+            for prompt, music_file in zip(batch, music_files):
+                results.append({
+                    'prompt': prompt,
+                    'music_file': music_file,
+                    'success': music_file is not None,
+                    'batch_index': batch_index,
+                    'batch_time': round(batch_time, 3),
+                    # 服务端整批一起生成，按曲目数均摊
+                    'time_per_track': round(batch_time / len(batch), 3)
+                })
+        
+        return results
+    
+    def _generate_batch(self, prompts, output_dir):
+        """发送一批提示词，返回与提示词一一对应的文件路径（失败为None）"""
+        filepaths = [new_music_path(output_dir) for _ in prompts]
+        
+        try:
+            response = self.session.post(
+                self.generate_url,
+                json={"prompts": prompts, "format": self.audio_format},
+                timeout=(self.connect_timeout, self.read_timeout * len(prompts)),  # 生成时间随曲目数增加
+                stream=True
+            )
+            self._record_response_health(response.status_code)
+            
+            with response:
+                if response.status_code != 200:
+                    print(f"批量生成失败，状态码: {response.status_code}")
+                    return [None] * len(prompts)
                 
-                print(f"音乐生成成功，文件保存位置: {filepath}")
-                return filepath
-            else:
-                print(f"音乐生成失败，状态码: {response.status_code}")
+                content_type = response.headers.get('Content-Type', '').split(';')[0].strip()
+                if content_type in ('application/zip', 'application/x-zip-compressed'):
+                    tracks = self._save_zip_tracks(response, filepaths)
+                elif content_type == 'application/json':
+                    tracks = self._save_json_tracks(response.json(), filepaths)
+                elif len(prompts) == 1 and response_format(content_type) in COMPRESSED_FORMATS:
+                    self._decode_to_file(response, filepaths[0])
+                    tracks = filepaths
+                elif len(prompts) == 1:
+                    self._stream_to_file(response, filepaths[0], record=True)
+                    tracks = filepaths
+                else:
+                    print(f"批量生成响应只包含单个音频（{content_type}），无法对应{len(prompts)}个提示词")
+                    return [None] * len(prompts)
+            
+        except requests.ConnectionError as e:
+            self._record_health(False)
+            print(f"批量生成异常: {e}")
+            return [None] * len(prompts)
+        except requests.RequestException as e:
+            print(f"批量生成异常: {e}")
+            return [None] * len(prompts)
+        except Exception as e:
+            print(f"批量生成异常: {e}")
+            return [None] * len(prompts)
+        
+        if len(tracks) < len(prompts):
+            print(f"批量生成只返回了{len(tracks)}/{len(prompts)}首")
+        return list(tracks) + [None] * (len(prompts) - len(tracks))
+    
+    def _save_zip_tracks(self, response, filepaths):
+        """把zip响应先流式写入临时文件，再逐个解压到对应的文件"""
+        zip_path = f"{filepaths[0]}.zip.part"
+        self._stream_to_file(response, zip_path)
+        try:
+            saved = []
+            with zipfile.ZipFile(zip_path) as archive:
+                # 按文件名排序后对应提示词，不依赖文件写入压缩包的顺序
+                names = sorted(
+                    (name for name in archive.namelist() if not name.endswith('/')), key=natural_sort_key
+                )
+                for name, filepath in zip(names, filepaths):
+                    with archive.open(name) as src, open(filepath, 'wb') as dst:
+                        while True:
+                            block = src.read(STREAM_CHUNK_SIZE)
+                            if not block:
+                                break
+                            dst.write(block)
+                    saved.append(self._decode_track(filepath))
+            return saved
+        finally:
+            os.remove(zip_path)
+    
+    def _save_json_tracks(self, payload, filepaths):
+        """把JSON响应中的base64音频逐个写入对应的文件"""
+        tracks = payload.get('tracks', []) if isinstance(payload, dict) else payload
+        saved = []
+        for track, filepath in zip(tracks, filepaths):
+            if isinstance(track, dict):
+                track = track.get('audio') or track.get('audio_base64')
+            if not track:
+                saved.append(None)
+                continue
+            with open(filepath, 'wb') as f:
+                f.write(base64.b64decode(track))
+            saved.append(self._decode_track(filepath))
+        return saved
+    
+    def _decode_track(self, filepath):
+        """批量响应中的单个曲目：压缩格式就地解码为WAV，返回文件路径（解码失败为None）"""
+        transferred = os.path.getsize(filepath)
+        with open(filepath, 'rb') as f:
+            audio_format = sniff_format(f.read(4))
+        
+        if audio_format not in COMPRESSED_FORMATS:
+            self.transfer_stats.record(audio_format, transferred, transferred)
+            return filepath
+        
+        source_path = f"{filepath}.{audio_format}"
+        os.replace(filepath, source_path)
+        try:
+            decode_start = time.time()
+            decode_file(source_path, filepath)
+            self.transfer_stats.record(audio_format, transferred, os.path.getsize(filepath), time.time() - decode_start)
+            return filepath
+        except (OSError, subprocess.CalledProcessError) as e:
+            print(f"解码{audio_format}曲目失败: {e}")
+            if os.path.exists(filepath):
+                os.remove(filepath)
+            return None
+        finally:
+            os.remove(source_path)
+    
+    def get_transfer_stats(self):
+        """获取音频传输统计（协商的格式、传输量、压缩率与解码耗时）"""
+        return {'audio_format': self.audio_format, **self.transfer_stats.get_stats()}
+    
+    def close(self):
+        """关闭连接池"""
+        self.session.close()
+
+
+class PlayerGate:
+    """
+    多个请求共用一个流式播放器：第一个开始流式下载的请求获得播放器，其余请求只下载到文件
+    """
+    
+    def __init__(self, player):
+        self.player = player
+        self.owner = None
+        self._lock = threading.Lock()
+    
+    def proxy(self, attempt):
+        """为一个请求创建播放器代理"""
+        return _GatedPlayer(self, attempt)
+    
+    def claim(self, attempt):
+        with self._lock:
+            if self.owner is None:
+                self.owner = attempt
+            return self.owner is attempt
+
+class _GatedPlayer:
+    """PlayerGate中单个请求看到的播放器，未获得播放器时start()返回False"""
+    
+    def __init__(self, gate, attempt):
+        self._gate = gate
+        self._attempt = attempt
+    
+    @property
+    def _owns(self):
+        return self._gate.owner is self._attempt
+    
+    @property
+    def started(self):
+        return self._owns and self._gate.player.started
+    
+    def start(self, source_path):
+        return self._gate.claim(self._attempt) and self._gate.player.start(source_path)
+    
+    def advance(self, available):
+        return self._owns and self._gate.player.advance(available)
+    
+    def end(self):
+        if self._owns:
+            self._gate.player.end()
+    
+    def abort(self):
+        if self._owns:
+            self._gate.player.abort()
+
+class MusicBackend:
+    """一台音乐生成服务：在途请求数、延迟EWMA与最近延迟样本（用于对冲阈值）"""
+    
+    def __init__(self, client, ewma_alpha=0.3, window=100, idle_half_life=60):
+        self.client = client
+        self.url = client.server_url
+        self.ewma_alpha = ewma_alpha
+        self.idle_half_life = idle_half_life
+        self.outstanding = 0
+        self.ewma = None
+        self.updated_at = 0.0
+        self.latencies = deque(maxlen=window)
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.cooldown_until = 0.0
+    
+    def p95(self):
+        """最近成功请求延迟的p95"""
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(0.95 * len(ordered)))]
+    
+    def record_latency(self, latency):
+        self.latencies.append(latency)
+        self.ewma = latency if self.ewma is None else self.ewma_alpha * latency + (1 - self.ewma_alpha) * self.ewma
+        self.updated_at = time.time()
+    
+    def score(self):
+        """
+        路由得分（越小越好）：延迟EWMA × (在途请求数 + 1)，没有样本的服务优先试探；
+        EWMA在没有新样本时按半衰期衰减，变慢后不再被选中的服务过一段时间会被重新试探
+        """
+        if self.ewma is None:
+            return 0.0
+        decay = 0.5 ** ((time.time() - self.updated_at) / self.idle_half_life)
+        return self.ewma * decay * (self.outstanding + 1)
+
+class _Attempt:
+    """一次发往某台服务的生成请求"""
+    
+    def __init__(self, backend, hedge=False):
+        self.backend = backend
+        self.hedge = hedge
+        self.future = None
+        self.music_file = None
+
+class MusicBackendPool:
+    """
+    多台音乐生成服务的路由客户端（接口与MusicGenClient一致）
+    
+    - 路由：跳过不健康或冷却中的服务，选择 延迟EWMA × (在途请求数+1) 最小的一台
+    - 对冲：首个请求超过该服务最近的p95延迟仍未完成时，向另一台发送相同请求，先完成的生效，
+      另一个完成后删除其文件（同步请求无法中途取消）
+    """
+    
+    def __init__(self, server_urls, hedge=True, hedge_min_samples=10, failure_threshold=3,
+                 cooldown=30, **client_kwargs):
+        """
+        Args:
+            server_urls: 音乐生成服务地址列表
+            hedge: 是否发送对冲请求
+            hedge_min_samples: 某台服务至少有多少个延迟样本后才按其p95对冲
+            failure_threshold: 连续失败多少次后暂停向该服务路由
+            cooldown: 暂停路由的时长（秒），之后重新试探
+            **client_kwargs: 传给每台服务的MusicGenClient
+        """
+        if not server_urls:
+            raise ValueError("至少需要一个音乐生成服务地址")
+        
+        self.backends = [MusicBackend(MusicGenClient(url, **client_kwargs)) for url in server_urls]
+        self.server_url = self.backends[0].url
+        self.hedge = hedge and len(self.backends) > 1
+        self.hedge_min_samples = hedge_min_samples
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        
+        self._lock = threading.Lock()
+        # 每台服务可能同时有正式、推测、预取和对冲请求
+        self._executor = ThreadPoolExecutor(max_workers=4 * len(self.backends), thread_name_prefix='music-backend')
+        self._stats = {'requests': 0, 'hedged': 0, 'hedge_wins': 0, 'discarded': 0, 'failed': 0}
+    
+    def _available(self, backend):
+        if time.time() < backend.cooldown_until:
+            return False
+        return backend.client.check_health()
+    
+    def _select(self, exclude=()):
+        """选择得分最低的可用服务；全部不可用时退回所有服务中得分最低的一台"""
+        candidates = [backend for backend in self.backends if backend not in exclude]
+        available = [backend for backend in candidates if self._available(backend)]
+        if not available and exclude:
+            # 对冲请求只发往可用的服务
+            return None
+        with self._lock:
+            return min(available or candidates, key=lambda backend: backend.score(), default=None)
+    
+    def _begin(self, backend):
+        with self._lock:
+            backend.outstanding += 1
+            backend.requests += 1
+    
+    def _finish(self, backend, latency, success):
+        """记录请求结果：成功时更新延迟EWMA和样本，连续失败达到阈值时进入冷却"""
+        with self._lock:
+            backend.outstanding -= 1
+            if success:
+                backend.consecutive_failures = 0
+                backend.record_latency(latency)
+                return
+            
+            backend.failures += 1
+            backend.consecutive_failures += 1
+            if backend.consecutive_failures >= self.failure_threshold:
+                backend.cooldown_until = time.time() + self.cooldown
+                print(f"音乐生成服务{backend.url}连续失败{backend.consecutive_failures}次，暂停路由{self.cooldown}秒")
+    
+    def _run(self, attempt, prompt, output_dir, gate):
+        backend = attempt.backend
+        self._begin(backend)
+        start = time.time()
+        music_file = None
+        try:
+            player = gate.proxy(attempt) if gate is not None else None
+            music_file = backend.client.generate_music(prompt, output_dir=output_dir, player=player)
+            attempt.music_file = music_file
+            return music_file
+        finally:
+            self._finish(backend, time.time() - start, music_file is not None)
+    
+    def _submit(self, backend, prompt, output_dir, gate, hedge=False):
+        attempt = _Attempt(backend, hedge)
+        attempt.future = self._executor.submit(self._run, attempt, prompt, output_dir, gate)
+        return attempt
+    
+    def _hedge_delay(self, backend):
+        """对冲等待时间：该服务最近的p95延迟，样本不足时不对冲"""
+        if not self.hedge:
+            return None
+        with self._lock:
+            if len(backend.latencies) < self.hedge_min_samples:
                 return None
+            return backend.p95()
+    
+    def check_health(self, force=False):
+        """至少一台服务可用"""
+        return any(backend.client.check_health(force) for backend in self.backends)
+    
+    def generate_music(self, prompt, output_dir="generated_music", player=None):
+        """
+        生成音乐（路由 + 对冲）
+        
+        Args:
+            prompt: 音乐生成提示词
+            output_dir: 输出目录
+            player: 可选的流式播放器；对冲时由先开始流式下载的请求播放
+            
+        Returns:
+            生成的音频文件路径
+        """
+        primary = self._select()
+        gate = PlayerGate(player) if player is not None else None
+        attempts = [self._submit(primary, prompt, output_dir, gate)]
+        with self._lock:
+            self._stats['requests'] += 1
+        
+        delay = self._hedge_delay(primary)
+        if delay is not None:
+            done, _ = wait([attempts[0].future], timeout=delay)
+            # 已经开始播放的请求不再对冲
+            if not done and (gate is None or gate.owner is None):
+                secondary = self._select(exclude=(primary,))
+                if secondary is not None:
+                    print(f"{primary.url}超过p95延迟{delay:.1f}秒未完成，向{secondary.url}发送对冲请求")
+                    attempts.append(self._submit(secondary, prompt, output_dir, gate, hedge=True))
+                    with self._lock:
+                        self._stats['hedged'] += 1
+        
+        try:
+            winner = self._pick_winner(attempts, gate)
+        finally:
+            if gate is not None and gate.owner is None:
+                player.end()
+        
+        for attempt in attempts:
+            if attempt is not winner:
+                attempt.future.add_done_callback(self._discard)
+        
+        with self._lock:
+            if winner is None:
+                self._stats['failed'] += 1
+            elif winner.hedge:
+                self._stats['hedge_wins'] += 1
+        return winner.music_file if winner else None
+    
+    def _pick_winner(self, attempts, gate):
+        """
+        等待先成功的请求；某个请求已经在播放时以它为准（播放的音乐与返回的文件一致），
+        除非它失败
+        """
+        pending = {attempt.future: attempt for attempt in attempts}
+        finished = []
+        while pending:
+            done, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+            finished.extend(pending.pop(future) for future in done)
+            
+            owner = gate.owner if gate is not None else None
+            if owner is not None and owner in pending.values():
+                continue
+            candidates = [owner] if owner is not None and owner.music_file else finished
+            for attempt in candidates:
+                if attempt.music_file:
+                    return attempt
+        return None
+    
+    def _discard(self, future):
+        """删除落选请求生成的文件"""
+        music_file = None if future.exception() else future.result()
+        if music_file and os.path.exists(music_file):
+            try:
+                os.remove(music_file)
+            except OSError:
+                pass
+            with self._lock:
+                self._stats['discarded'] += 1
+    
+    def generate_many(self, prompts, output_dir="generated_music", batch_size=4):
+        """批量生成：整批路由到一台服务（不对冲）"""
+        backend = self._select()
+        self._begin(backend)
+        results = []
+        try:
+            results = backend.client.generate_many(prompts, output_dir=output_dir, batch_size=batch_size)
+            return results
+        finally:
+            with self._lock:
+                backend.outstanding -= 1
+                if results and not any(result['success'] for result in results):
+                    backend.failures += 1
+    
+    def get_transfer_stats(self):
+        """各台服务的音频传输统计"""
+        return {backend.url: backend.client.get_transfer_stats() for backend in self.backends}
+    
+    def get_stats(self):
+        """获取对冲次数与各台服务的在途请求数、延迟EWMA、p95和失败数"""
+        with self._lock:
+            now = time.time()
+            return {
+                **self._stats,
+                'backends': [
+                    {
+                        'url': backend.url,
+                        'outstanding': backend.outstanding,
+                        'requests': backend.requests,
+                        'failures': backend.failures,
+                        'ewma': round(backend.ewma, 3) if backend.ewma is not None else None,
+                        'p95': round(backend.p95(), 3) if backend.latencies else None,
+                        'cooling_down': now < backend.cooldown_until
+                    }
+                    for backend in self.backends
+                ]
+            }
+    
+    def close(self):
+        """关闭线程池和各台服务的连接池"""
+        self._executor.shutdown(wait=False)
+        for backend in self.backends:
+            backend.client.close()
+
+def create_music_client(server_urls=None, **kwargs):
+    """
+    创建音乐生成客户端：配置了多台服务（参数或LETDANCE_MUSIC_SERVERS）时返回MusicBackendPool，
+    否则返回MusicGenClient
+    """
+    if server_urls is None:
+        server_urls = [url.strip() for url in os.getenv(SERVER_URLS_ENV, '').split(',') if url.strip()]
+    if len(server_urls) > 1:
+        return MusicBackendPool(server_urls, **kwargs)
+    return MusicGenClient(server_urls[0] if server_urls else DEFAULT_SERVER_URL, **kwargs)
+
+
+class AsyncMusicGenClient:
+    def __init__(self, server_url=DEFAULT_SERVER_URL, timeout=120, audio_format='flac'):
+        """
+        异步音乐生成客户端（httpx），供asyncio工作流在事件循环中调用
+        请求可随任务一起被取消，不会占用线程
+        
+        Args:
+            server_url: API服务器地址
+            timeout: 生成请求超时（秒）
+            audio_format: 请求的传输格式（wav/flac/opus），压缩格式下载完成后解码为WAV
+        """
+        if not HTTPX_AVAILABLE:
+            raise ImportError("httpx未安装，请运行: pip install httpx")
+        
+        self.server_url = server_url
+        self.generate_url = f"{server_url}/generate_music"
+        self.health_url = f"{server_url}/health"
+        self.audio_format = negotiate_format(audio_format)
+        self.transfer_stats = TransferStats()
+        self._client = httpx.AsyncClient(
+            timeout=httpx.Timeout(timeout, connect=5.0),
+            headers={'Accept': accept_header(self.audio_format)}
+        )
+    
+    async def check_health(self):
+        """检查音乐生成服务状态"""
+        try:
+            response = await self._client.get(self.health_url, timeout=5)
+            return response.status_code == 200
+        except Exception:
+            return False
+    
+    async def generate_music(self, prompt, output_dir="generated_music"):
+        """
+        生成音乐
+        
+        Args:
+            prompt: 音乐生成提示词
+            output_dir: 输出目录
+            
+        Returns:
+            生成的音频文件路径
+        """
+        os.makedirs(output_dir, exist_ok=True)
+        
+        try:
+            data = {"prompts": [prompt], "format": self.audio_format}
+            async with self._client.stream('POST', self.generate_url, json=data) as response:
+                if response.status_code == 200:
+                    filepath = new_music_path(output_dir)
+                    audio_format = response_format(response.headers.get('Content-Type', ''))
+                    
+                    if audio_format in COMPRESSED_FORMATS:
+                        await self._decode_to_file(response, filepath, audio_format)
+                    else:
+                        written = await self._stream_to_file(response, filepath)
+                        self.transfer_stats.record('wav', written, written)
+                    
+                    print(f"音乐生成成功，文件保存位置: {filepath}")
+                    return filepath
+                else:
+                    print(f"音乐生成失败，状态码: {response.status_code}")
+                    return None
                 
+        except asyncio.CancelledError:
+            raise
         except Exception as e:
             print(f"音乐生成异常: {e}")
             return None
     
-                
+    async def _stream_to_file(self, response, filepath):
+        """按块写入临时文件，完成后原子改名，返回写入的字节数；写文件放到线程中，避免阻塞事件循环"""
+        temp_path = f"{filepath}.part"
+        written = 0
+        f = await asyncio.to_thread(open, temp_path, 'wb')
+        try:
+            async for chunk in response.aiter_bytes(STREAM_CHUNK_SIZE):
+                await asyncio.to_thread(f.write, chunk)
+                written += len(chunk)
+            await asyncio.to_thread(f.close)
+            os.replace(temp_path, filepath)
+            return written
+        except BaseException:
+            f.close()
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
     
+    async def _decode_to_file(self, response, filepath, audio_format):
+        """压缩音频先下载到临时文件，再在线程中用ffmpeg解码为WAV（异步工作流不做流式播放）"""
+        source_path = f"{filepath}.{audio_format}"
+        transferred = await self._stream_to_file(response, source_path)
+        try:
+            decode_start = time.time()
+            await asyncio.to_thread(decode_file, source_path, filepath)
+            self.transfer_stats.record(audio_format, transferred, os.path.getsize(filepath), time.time() - decode_start)
+        except BaseException:
+            if os.path.exists(filepath):
+                os.remove(filepath)
+            raise
+        finally:
+            os.remove(source_path)
+    
+    async def aclose(self):
+        """关闭连接池"""
+        await self._client.aclose()
+
+class AsyncMusicBackendPool:
+    """
+    MusicBackendPool的异步版本（接口与AsyncMusicGenClient一致）
+    
+    与同步路由客户端共用各台服务的状态（健康、在途请求数、延迟EWMA、冷却），路由和对冲规则相同；
+    对冲时先成功的请求生效，落选的请求直接取消
+    """
+    
+    def __init__(self, pool, **client_kwargs):
+        """
+        Args:
+            pool: 同步路由客户端MusicBackendPool
+            **client_kwargs: 传给每台服务的AsyncMusicGenClient
+        """
+        self.pool = pool
+        self.server_url = pool.server_url
+        self._clients = {backend.url: AsyncMusicGenClient(backend.url, **client_kwargs) for backend in pool.backends}
+    
+    async def check_health(self):
+        """至少一台服务可用"""
+        results = await asyncio.gather(*(client.check_health() for client in self._clients.values()))
+        return any(results)
+    
+    async def _run(self, backend, prompt, output_dir):
+        self.pool._begin(backend)
+        start = time.time()
+        try:
+            music_file = await self._clients[backend.url].generate_music(prompt, output_dir=output_dir)
+        except asyncio.CancelledError:
+            # 被取消的请求（对冲落选或外层超时）不计入该服务的成败
+            with self.pool._lock:
+                backend.outstanding -= 1
+            raise
+        except Exception:
+            self.pool._finish(backend, time.time() - start, False)
+            raise
+        
+        self.pool._finish(backend, time.time() - start, music_file is not None)
+        return music_file
+    
+    async def generate_music(self, prompt, output_dir="generated_music"):
+        """
+        生成音乐（路由 + 对冲）
+        
+        Args:
+            prompt: 音乐生成提示词
+            output_dir: 输出目录
+            
+        Returns:
+            生成的音频文件路径
+        """
+        pool = self.pool
+        # 健康检查使用同步请求（有缓存），放到线程中避免阻塞事件循环
+        primary = await asyncio.to_thread(pool._select)
+        with pool._lock:
+            pool._stats['requests'] += 1
+        attempts = {asyncio.create_task(self._run(primary, prompt, output_dir)): False}
+        
+        try:
+            delay = pool._hedge_delay(primary)
+            if delay is not None:
+                done, _ = await asyncio.wait(list(attempts), timeout=delay)
+                if not done:
+                    secondary = await asyncio.to_thread(pool._select, (primary,))
+                    if secondary is not None:
+                        print(f"{primary.url}超过p95延迟{delay:.1f}秒未完成，向{secondary.url}发送对冲请求")
+                        attempts[asyncio.create_task(self._run(secondary, prompt, output_dir))] = True
+                        with pool._lock:
+                            pool._stats['hedged'] += 1
+            
+            winner = None
+            pending = set(attempts)
+            while pending and winner is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None and task.result():
+                        if winner is None:
+                            winner = task
+                        else:
+                            # 同时完成的另一个请求
+                            pool._discard(task)
+        finally:
+            for task in attempts:
+                if not task.done():
+                    task.cancel()
+                    with pool._lock:
+                        pool._stats['discarded'] += 1
+        
+        with pool._lock:
+            if winner is None:
+                pool._stats['failed'] += 1
+            elif attempts[winner]:
+                pool._stats['hedge_wins'] += 1
+        return winner.result() if winner else None
+    
+    def get_transfer_stats(self):
+        """各台服务的音频传输统计（异步请求）"""
+        return {url: client.transfer_stats.get_stats() for url, client in self._clients.items()}
+    
+    async def aclose(self):
+        """关闭各台服务的连接池"""
+        await asyncio.gather(*(client.aclose() for client in self._clients.values()))
+
+def create_async_music_client(music_client, **kwargs):
+    """
+    为同步音乐生成客户端创建对应的异步客户端：MusicBackendPool对应AsyncMusicBackendPool（共用路由状态），
+    否则为同一地址的AsyncMusicGenClient
+    """
+    if isinstance(music_client, MusicBackendPool):
+        return AsyncMusicBackendPool(music_client, **kwargs)
+    return AsyncMusicGenClient(music_client.server_url, **kwargs)
 
 def main():
     """主程序 - 仅用于测试客户端功能"""
@@ -20,6 +20,11 @@ class AzureConfig:
     DEPLOYMENT_NAME = "gpt-4.1"
     API_VERSION = "2024-02-15-preview"
     
+    # 熔断与延迟预算配置
+    CIRCUIT_FAILURE_THRESHOLD = 3      # 连续失败多少次后熔断
+    CIRCUIT_RESET_TIMEOUT = 30.0       # 熔断后多久放行探测请求（秒）
+    ROUND_LATENCY_BUDGET = 25.0        # 每轮分析中Azure调用的延迟预算（秒，不含姿态采集时长）
+    
     def __init__(self):
         """初始化Azure配置"""
         self.setup_environment()
@@ -59,6 +64,14 @@ class AzureConfig:
             "max_retries": 3,
         }
     
+    @classmethod
+    def get_circuit_breaker_config(cls) -> Dict[str, Any]:
+        """获取Azure共享熔断器配置参数"""
+        return {
+            "failure_threshold": cls.CIRCUIT_FAILURE_THRESHOLD,
+            "reset_timeout": cls.CIRCUIT_RESET_TIMEOUT,
+        }
+    
     @classmethod
     def validate_config(cls) -> bool:
         """验证配置完整性"""
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+LETDANCE 音乐关键词缓存
+按量化后的分析状态（面部情感 + 姿态主导情感 + 分箱后的拉班质量）缓存关键词，
+LRU + TTL淘汰，持久化为JSON文件，重启后继续使用
+"""
+
+import os
+import json
+import time
+import logging
+import threading
+from collections import OrderedDict
+from typing import Dict, Any, List, Optional
+
+from tools.expression_model import normalize_emotion_label
+
+# 配置日志
+logger = logging.getLogger(__name__)
+
+# 默认缓存文件路径，可通过环境变量覆盖
+DEFAULT_CACHE_PATH = os.getenv('LETDANCE_KEYWORD_CACHE', 'cache/keyword_cache.json')
+
+# 参与量化的拉班质量维度
+LABAN_QUALITIES = ('weight', 'time', 'flow', 'space')
+
+class KeywordCache:
+    """量化状态 -> 音乐关键词 的LRU缓存（带TTL，线程安全）"""
+
+    def __init__(self, cache_path: str = DEFAULT_CACHE_PATH, max_entries: int = 256,
+                 ttl: float = 1800.0, laban_step: float = 0.25):
+        """
+        Args:
+            cache_path: 持久化文件路径，为空时只在内存中缓存
+            max_entries: 最多缓存的状态数，超出时淘汰最久未使用的
+            ttl: 条目有效期（秒）
+            laban_step: 拉班质量分箱步长，越大越容易命中
+        """
+        self.cache_path = cache_path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.laban_step = laban_step
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0, 'expired': 0}
+
+        self._load()
+
+    def make_key(self, image_data: Optional[Dict], pose_data: Optional[Dict]) -> Optional[str]:
+        """
+        根据两个工具的结果生成量化状态键
+
+        姿态分析失败时返回None（没有足够的状态信息，不参与缓存）
+        """
+        if not pose_data or not pose_data.get('success') or not pose_data.get('data'):
+            return None
+
+        pose = pose_data['data']
+        laban = pose.get('average_laban_qualities') or {}
+        bins = ','.join(
+            f"{quality[0]}{round(laban.get(quality, 0.0) / self.laban_step):+d}"
+            for quality in LABAN_QUALITIES
+        )
+
+        return f"{self._image_emotion(image_data)}|{pose.get('dominant_emotion', '未知')}|{bins}"
+
+    def _image_emotion(self, image_data: Optional[Dict]) -> str:
+        """取图像分析的情感标签（归一到FER+类别）"""
+        if not image_data or not image_data.get('success') or not image_data.get('data'):
+            return 'unknown'
+
+        data = image_data['data']
+        structured = data.get('structured') or {}
+        label = normalize_emotion_label(structured.get('emotion')) or normalize_emotion_label(data.get('analysis'))
+        return label or 'unknown'
+
+    def get(self, key: Optional[str]) -> Optional[List[str]]:
+        """查询缓存，命中时返回关键词并刷新LRU顺序"""
+        if key is None:
+            return None
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._stats['misses'] += 1
+                return None
+
+            if time.time() - entry['created_at'] > self.ttl:
+                del self._entries[key]
+                self._stats['expired'] += 1
+                self._stats['misses'] += 1
+                return None
+
+            self._entries.move_to_end(key)
+            entry['hits'] += 1
+            self._stats['hits'] += 1
+            return list(entry['music_keywords'])
+
+    def put(self, key: Optional[str], music_keywords: List[str]) -> None:
+        """写入缓存并持久化"""
+        if key is None or not music_keywords:
+            return
+
+        with self._lock:
+            self._entries[key] = {
+                'music_keywords': list(music_keywords),
+                'created_at': time.time(),
+                'hits': 0
+            }
+            self._entries.move_to_end(key)
+            self._stats['stores'] += 1
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats['evictions'] += 1
+
+            self._save()
+
+    def clear(self) -> None:
+        """清空缓存"""
+        with self._lock:
+            self._entries.clear()
+            self._save()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取命中率等统计"""
+        with self._lock:
+            lookups = self._stats['hits'] + self._stats['misses']
+            return {
+                **self._stats,
+                'entries': len(self._entries),
+                'hit_rate': round(self._stats['hits'] / lookups, 3) if lookups else None,
+                'laban_step': self.laban_step,
+                'ttl': self.ttl
+            }
+
+    def _load(self) -> None:
+        """从文件加载未过期的条目"""
+        if not self.cache_path or not os.path.exists(self.cache_path):
+            return
+
+        try:
+            with open(self.cache_path, 'r', encoding='utf-8') as f:
+                stored = json.load(f)
+
+            now = time.time()
+            # 文件中按LRU顺序保存（最久未使用的在前）
+            for key, entry in stored.get('entries', []):
+                if now - entry.get('created_at', 0) <= self.ttl:
+                    self._entries[key] = entry
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+            logger.info(f"关键词缓存加载成功: {len(self._entries)}条")
+        except Exception as e:
+            logger.warning(f"关键词缓存加载失败，将重新建立: {e}")
+            self._entries.clear()
+
+    def _save(self) -> None:
+        """原子写入缓存文件（调用方需持有锁）"""
+        if not self.cache_path:
+            return
+
+        try:
+            cache_dir = os.path.dirname(self.cache_path)
+            if cache_dir:
+                os.makedirs(cache_dir, exist_ok=True)
+
+            temp_path = f"{self.cache_path}.tmp"
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump({'entries': list(self._entries.items())}, f, ensure_ascii=False)
+            os.replace(temp_path, self.cache_path)
+        except Exception as e:
+            logger.warning(f"关键词缓存保存失败: {e}")
+
+# 全局缓存实例
+_keyword_cache = None
+
+def get_keyword_cache(**config) -> KeywordCache:
+    """获取关键词缓存实例（单例模式，同一进程内的工作流共用）"""
+    global _keyword_cache
+    if _keyword_cache is None:
+        _keyword_cache = KeywordCache(**config)
+    return _keyword_cache
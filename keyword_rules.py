@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+LETDANCE 本地规则关键词生成
+根据姿态主导情感、拉班质量均值和（可选的）面部情感标签，在本地直接生成4个音乐关键词，
+不调用LLM。用于离线模式、LLM返回前的临时投影，以及Azure不可用时的降级关键词
+"""
+
+import logging
+from typing import Dict, List, Optional
+
+from tools.expression_model import normalize_emotion_label
+from tools.music_keywords_tool import MUSIC_KEYWORD_THEMES
+
+# 配置日志
+logger = logging.getLogger(__name__)
+
+# 默认音乐关键词（没有任何可用分析结果时使用）
+DEFAULT_KEYWORDS = ["ambient", "emotional", "calm", "contemplative"]
+
+# 姿态主导情感 -> 优先选用的音乐关键词
+POSE_EMOTION_KEYWORDS = {
+    '快乐/欢快': ['upbeat', 'cheerful', 'joyful', 'bright'],
+    '优雅/平静': ['ambient', 'peaceful', 'gentle', 'serene'],
+    '激情/兴奋': ['energetic', 'dynamic', 'passionate', 'intense'],
+    '忧郁/悲伤': ['melancholic', 'emotional', 'reflective', 'soft'],
+    '紧张/焦虑': ['dramatic', 'intense', 'moody', 'brooding'],
+    '放松/舒缓': ['relaxing', 'calm', 'soothing', 'mellow'],
+    '力量/决心': ['powerful', 'bold', 'strong', 'epic'],
+    '轻盈/飘逸': ['gentle', 'bright', 'tranquil', 'lively'],
+    '中性/自然': ['ambient', 'calm', 'contemplative', 'soft']
+}
+
+# 各情绪主题的拉班质量原型（与姿态工具情感模板同一坐标：weight轻-重、time慢-快、flow约束-自由、space间接-直接）
+THEME_LABAN_PROTOTYPES = {
+    'theme1': {'weight': 0.2, 'time': 0.5, 'flow': 0.7, 'space': 0.3},    # 快乐/兴奋
+    'theme2': {'weight': -0.4, 'time': -0.5, 'flow': 0.7, 'space': 0.0},  # 平静/舒缓
+    'theme3': {'weight': -0.6, 'time': -0.5, 'flow': -0.3, 'space': -0.4},  # 忧郁/深沉
+    'theme4': {'weight': 0.7, 'time': 0.5, 'flow': -0.2, 'space': 0.5}    # 强烈/激情
+}
+
+# 面部情感（FER+类别）-> 情绪主题
+IMAGE_EMOTION_THEMES = {
+    'happiness': 'theme1',
+    'surprise': 'theme1',
+    'neutral': 'theme2',
+    'sadness': 'theme3',
+    'contempt': 'theme3',
+    'anger': 'theme4',
+    'disgust': 'theme4',
+    'fear': 'theme4'
+}
+
+# 各信号对主题得分的权重
+POSE_EMOTION_WEIGHT = 1.0
+IMAGE_EMOTION_WEIGHT = 0.8
+
+def _keyword_theme(keyword: str) -> Optional[str]:
+    for theme, keywords in MUSIC_KEYWORD_THEMES.items():
+        if keyword in keywords:
+            return theme
+    return None
+
+def _pose_emotion_theme(emotion: Optional[str]) -> Optional[str]:
+    """姿态情感 -> 其优先关键词中占多数的主题"""
+    keywords = POSE_EMOTION_KEYWORDS.get(emotion)
+    if not keywords:
+        return None
+    themes = [_keyword_theme(keyword) for keyword in keywords]
+    return max(MUSIC_KEYWORD_THEMES, key=themes.count)
+
+def _image_emotion(image_data: Optional[Dict]) -> Optional[str]:
+    """取图像分析的情感标签（归一到FER+类别）"""
+    if not image_data or not image_data.get('success') or not image_data.get('data'):
+        return None
+
+    data = image_data['data']
+    structured = data.get('structured') or {}
+    return (normalize_emotion_label(structured.get('emotion'))
+            or normalize_emotion_label(data.get('emotion'))
+            or normalize_emotion_label(data.get('analysis')))
+
+def score_themes(pose_emotion: Optional[str], laban: Optional[Dict[str, float]],
+                 image_emotion: Optional[str] = None) -> Dict[str, float]:
+    """
+    计算各情绪主题的得分
+
+    拉班向量与主题原型的负平方距离为基础分，姿态情感和面部情感所属的主题再加权重
+    """
+    scores = {}
+    for theme, prototype in THEME_LABAN_PROTOTYPES.items():
+        if laban:
+            scores[theme] = -sum((laban.get(quality, 0.0) - value) ** 2 for quality, value in prototype.items())
+        else:
+            scores[theme] = 0.0
+
+    pose_theme = _pose_emotion_theme(pose_emotion)
+    if pose_theme:
+        scores[pose_theme] += POSE_EMOTION_WEIGHT
+
+    image_theme = IMAGE_EMOTION_THEMES.get(image_emotion)
+    if image_theme:
+        scores[image_theme] += IMAGE_EMOTION_WEIGHT
+
+    return scores
+
+def generate_keywords(pose_emotion: Optional[str], laban: Optional[Dict[str, float]],
+                      image_emotion: Optional[str] = None) -> List[str]:
+    """
+    生成4个词表内的音乐关键词：得分最高的主题取3个，第4个取次高主题
+
+    主题内优先选用姿态情感对应的关键词；第4个关键词在次高主题没有姿态优先词时，
+    先用剩余的姿态优先词，再按主题词表顺序补足。结果是确定性的
+    """
+    if not pose_emotion and not laban and not image_emotion:
+        return list(DEFAULT_KEYWORDS)
+
+    scores = score_themes(pose_emotion, laban, image_emotion)
+    primary, secondary = sorted(scores, key=scores.get, reverse=True)[:2]
+    preferred = POSE_EMOTION_KEYWORDS.get(pose_emotion, [])
+
+    candidates = [kw for kw in preferred if kw in MUSIC_KEYWORD_THEMES[primary]]
+    candidates += [kw for kw in MUSIC_KEYWORD_THEMES[primary] if kw not in candidates]
+    keywords = candidates[:3]
+
+    candidates = [kw for kw in preferred if kw in MUSIC_KEYWORD_THEMES[secondary]]
+    candidates += preferred + MUSIC_KEYWORD_THEMES[secondary]
+    keywords.append(next(kw for kw in candidates if kw not in keywords))
+
+    return keywords
+
+def rule_based_keywords(pose_data: Optional[Dict], image_data: Optional[Dict] = None) -> List[str]:
+    """根据工具结果生成本地规则关键词（工具结果格式与姿态/图像分析工具一致）"""
+    pose = {}
+    if pose_data and pose_data.get('success') and pose_data.get('data'):
+        pose = pose_data['data']
+
+    try:
+        return generate_keywords(pose.get('dominant_emotion'), pose.get('average_laban_qualities'),
+                                 _image_emotion(image_data))
+    except Exception as e:
+        logger.warning(f"规则关键词生成失败，使用默认关键词: {e}")
+        return list(DEFAULT_KEYWORDS)
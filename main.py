@@ -23,16 +23,20 @@ project_root = Path(__file__).parent
 sys.path.insert(0, str(project_root))
 
 # 导入音乐生成相关模块
-from client import MusicGenClient
-from microphone import play_async
+from client import create_music_client
+from microphone import play_async, StreamingPlayer
 
 # 导入LangChain工作流相关模块
 try:
     from langchain.agents import AgentExecutor, create_tool_calling_agent
     from langchain_core.prompts import ChatPromptTemplate
-    from langchain_core.messages import HumanMessage
     from langchain_openai import AzureChatOpenAI
     from tools import get_all_tools
+    from tools.result_compactor import ToolResultCompactor
+    from tools.circuit_breaker import get_circuit_breaker, start_latency_budget
+    from pipeline import DirectPipeline, LLMUsageTracker, keywords_from_agent_output
+    from keyword_cache import get_keyword_cache
+    from music_cache import get_music_cache
     from config.azure_config import AzureConfig
     LANGCHAIN_AVAILABLE = True
 except ImportError as e:
@@ -104,14 +108,28 @@ def check_dependencies() -> bool:
 class LetDanceWorkflow:
     """LETDANCE 智能分析工作流"""
     
-    def __init__(self):
+    # agent: 工具调用Agent；pipeline: 直接调用工具 + 一次LLM融合
+    WORKFLOW_MODES = ('agent', 'pipeline')
+    
+    def __init__(self, mode: str = 'agent'):
         if not LANGCHAIN_AVAILABLE:
             raise ImportError("LangChain依赖不可用，无法初始化智能分析工作流")
+        if mode not in self.WORKFLOW_MODES:
+            raise ValueError(f"不支持的工作流模式: {mode}，可选: {self.WORKFLOW_MODES}")
         
+        self.mode = mode
         self.tools = get_all_tools()
         self.llm = self._initialize_llm()
+        # Agent上下文中只放工具结果的精简投影
+        self.compactor = ToolResultCompactor()
         self.agent_executor = self._create_agent_executor()
-        self.music_client = MusicGenClient()
+        self.music_client = create_music_client()
+        # 音乐缓存：相同关键词集合（不计顺序）直接使用已生成的音乐
+        self.music_cache = get_music_cache()
+        # Azure调用共享熔断器（熔断时立即失败，不再等待超时重试）
+        self.breaker = get_circuit_breaker('azure', **AzureConfig.get_circuit_breaker_config())
+        self.pipeline = DirectPipeline(self.tools, self.llm, self.breaker, keyword_cache=get_keyword_cache())
+        self.usage_tracker = LLMUsageTracker()
         
     def _initialize_llm(self) -> AzureChatOpenAI:
         """初始化Azure OpenAI LLM"""
@@ -138,8 +156,9 @@ class LetDanceWorkflow:
 - 等待第一步完成后，使用 pose_analysis 工具进行实时姿态分析
 - 这将持续分析用户的肢体动作情感
 
-**第三步：生成音乐关键词**
-- 综合两种分析结果，生成4个英文音乐风格关键词
+**第三步：提交音乐关键词**
+- 综合两种分析结果，调用 submit_music_keywords 工具提交4个英文音乐风格关键词
+- 关键词只能从工具说明的词表中选择，提交后流程立即结束
 
 **重要提醒：**
 - 必须按顺序执行，不能同时调用两个摄像头工具
@@ -149,7 +168,9 @@ class LetDanceWorkflow:
             ("placeholder", "{agent_scratchpad}")
         ])
         
-        agent = create_tool_calling_agent(self.llm, self.tools, prompt)
+        agent = create_tool_calling_agent(
+            self.llm, self.tools, prompt, message_formatter=self.compactor.format_messages
+        )
         return AgentExecutor(
             agent=agent, 
             tools=self.tools, 
@@ -158,8 +179,59 @@ class LetDanceWorkflow:
             early_stopping_method="generate"
         )
     
-    def analyze_and_generate_music_keywords(self, duration: int = 10) -> Dict[str, Any]:
+    def analyze_and_generate_music_keywords(self, duration: int = 10, mode: Optional[str] = None) -> Dict[str, Any]:
         """执行完整的分析流程并生成音乐关键词"""
+        mode = mode or self.mode
+        
+        # 每轮开始新的延迟预算（姿态采集时长不计入Azure预算）
+        start_latency_budget(AzureConfig.ROUND_LATENCY_BUDGET + duration)
+        self.usage_tracker.reset()
+        start_time = time.time()
+        
+        if mode == 'pipeline':
+            result = self._analyze_with_pipeline(duration)
+        else:
+            result = self._analyze_with_agent(duration)
+        
+        result['mode'] = mode
+        result['metrics'] = {
+            'mode': mode,
+            'wall_time': round(time.time() - start_time, 3),
+            **self.usage_tracker.snapshot()
+        }
+        logging.info(f"⏱️ [{mode}] 本轮耗时{result['metrics']['wall_time']}s，"
+                     f"LLM调用{result['metrics']['llm_calls']}次，token {result['metrics']['total_tokens']}")
+        return result
+    
+    def _analyze_with_pipeline(self, duration: int) -> Dict[str, Any]:
+        """直接流水线模式：代码中调用两个工具，再用一次LLM融合生成关键词"""
+        try:
+            logging.info("开始LETDANCE智能分析流程（直接流水线模式）")
+            pipeline_result = self.pipeline.run(duration, callbacks=[self.usage_tracker])
+            
+            return {
+                'success': True,
+                'message': '流水线分析完成，音乐关键词已生成',
+                'agent_output': None,
+                'music_keywords': pipeline_result['music_keywords'],
+                'ready_for_music_generation': True,
+                'degraded': pipeline_result['fusion_fallback'],
+                'cache_hit': pipeline_result['cache_hit'],
+                'azure_metrics': self.breaker.get_metrics()
+            }
+            
+        except Exception as e:
+            logging.error(f"流水线分析异常: {e}")
+            return {
+                'success': False,
+                'message': f'流水线分析异常: {str(e)}',
+                'music_keywords': [],
+                'ready_for_music_generation': False,
+                'azure_metrics': self.breaker.get_metrics()
+            }
+    
+    def _analyze_with_agent(self, duration: int) -> Dict[str, Any]:
+        """Agent模式：由工具调用Agent决定调用顺序"""
         try:
             logging.info("开始LETDANCE智能分析流程")
             
@@ -174,22 +246,29 @@ class LetDanceWorkflow:
    - duration: {duration}
    - confidence_threshold: 0.5
 
-3. 基于两个分析结果生成4个英文音乐风格关键词。
+3. 基于两个分析结果，使用submit_music_keywords工具提交4个英文音乐风格关键词。
 
-请确保两个工具都被调用，然后提供最终的音乐关键词。"""
+请确保两个分析工具都被调用，最后通过submit_music_keywords提交关键词。"""
 
-            # 执行Agent工作流
-            result = self.agent_executor.invoke({"input": input_message})
+            # 执行Agent工作流（熔断器打开或预算耗尽时立即抛出）
+            compaction_stats = self.compactor.start_round()
+            result = self.breaker.call(
+                self.agent_executor.invoke, {"input": input_message},
+                {'callbacks': [self.usage_tracker]}, label='agent'
+            )
             
-            # 提取音乐关键词
-            music_keywords = self._extract_music_keywords(result['output'])
+            # 关键词由submit_music_keywords工具直接返回，无需再调用LLM提取
+            keyword_result = keywords_from_agent_output(result['output'])
             
             return {
                 'success': True,
                 'message': '智能分析完成，音乐关键词已生成',
                 'agent_output': result['output'],
-                'music_keywords': music_keywords,
-                'ready_for_music_generation': True
+                'music_keywords': keyword_result['music_keywords'],
+                'ready_for_music_generation': True,
+                'degraded': keyword_result['fallback'],
+                'context_compaction': self.compactor.summarize(compaction_stats),
+                'azure_metrics': self.breaker.get_metrics()
             }
             
         except Exception as e:
@@ -198,36 +277,25 @@ class LetDanceWorkflow:
                 'success': False,
                 'message': f'智能分析流程异常: {str(e)}',
                 'music_keywords': [],
-                'ready_for_music_generation': False
+                'ready_for_music_generation': False,
+                'azure_metrics': self.breaker.get_metrics()
             }
     
-    def _extract_music_keywords(self, agent_output: str) -> list:
-        """从Agent输出中提取音乐关键词"""
-        try:
-            extraction_prompt = f"""
-            从以下分析结果中提取4个音乐风格关键词。
-            
-            分析结果：
-            {agent_output}
-            
-            请只返回4个英文音乐风格关键词，用逗号分隔，例如：ambient, emotional, energetic, peaceful
-            """
-            
-            response = self.llm.invoke([HumanMessage(content=extraction_prompt)])
-            keywords_text = response.content.strip()
-            
-            # 解析关键词
-            keywords = [kw.strip() for kw in keywords_text.split(',') if kw.strip()]
-            return keywords[:4]  # 确保只返回4个关键词
-            
-        except Exception as e:
-            logging.error(f"关键词提取失败: {e}")
-            return ["ambient", "emotional", "calm", "contemplative"]  # 默认关键词
-    
     def generate_music(self, keywords: list) -> Dict[str, Any]:
         """使用类内部的音乐客户端生成音乐"""
         try:
-            # 检查音乐生成服务状态
+            cached_file = self.music_cache.get(keywords)
+            if cached_file:
+                logging.info(f"命中音乐缓存: {cached_file}")
+                play_async(cached_file)
+                return {
+                    'success': True,
+                    'message': '命中音乐缓存并已开始播放',
+                    'music_file': cached_file,
+                    'music_cache_hit': True
+                }
+            
+            # 检查音乐生成服务状态（使用缓存的健康状态，缓存有效期内不发起请求）
             if not self.music_client.check_health():
                 logging.warning("音乐生成服务不可用，跳过音乐生成")
                 return {'success': False, 'message': '音乐生成服务不可用'}
@@ -236,15 +304,20 @@ class LetDanceWorkflow:
             prompt = ", ".join(keywords)
             logging.info(f"开始生成音乐，关键词: {prompt}")
             
-            # 生成音乐
-            music_file = self.music_client.generate_music(prompt)
+            # 生成音乐（收到WAV头和第一段缓冲后即开始流式播放）
+            player = StreamingPlayer()
+            music_file = self.music_client.generate_music(prompt, player=player)
             
             if music_file and os.path.exists(music_file):
                 logging.info(f"音乐生成成功: {music_file}")
+                music_file = self.music_cache.put(keywords, music_file) or music_file
                 
-                # 异步播放音乐
-                play_thread = play_async(music_file)
-                logging.info("音乐开始播放")
+                if player.started and (player.is_playing() or player.wait(timeout=0)):
+                    logging.info("音乐已在下载过程中开始播放")
+                else:
+                    # 流式播放不可用时，下载完成后异步播放
+                    play_thread = play_async(music_file)
+                    logging.info("音乐开始播放")
                 
                 return {
                     'success': True,
@@ -259,10 +332,10 @@ class LetDanceWorkflow:
             logging.error(f"音乐生成异常: {e}")
             return {'success': False, 'message': f'音乐生成异常: {str(e)}'}
     
-    def run_complete_workflow(self, duration: int = 10) -> Dict[str, Any]:
+    def run_complete_workflow(self, duration: int = 10, mode: Optional[str] = None) -> Dict[str, Any]:
         """运行完整工作流：分析 -> 生成音乐关键词 -> 生成音乐"""
         # 步骤1: 智能分析并生成关键词
-        analysis_result = self.analyze_and_generate_music_keywords(duration)
+        analysis_result = self.analyze_and_generate_music_keywords(duration, mode)
         
         if not analysis_result['success']:
             return analysis_result
@@ -281,12 +354,12 @@ class LetDanceWorkflow:
 # 全局工作流实例
 workflow_instance = None
 
-def initialize_workflow():
-    """初始化智能分析工作流"""
+def initialize_workflow(mode: str = None):
+    """初始化智能分析工作流（mode默认读取环境变量 LETDANCE_WORKFLOW_MODE）"""
     global workflow_instance
     try:
         if LANGCHAIN_AVAILABLE:
-            workflow_instance = LetDanceWorkflow()
+            workflow_instance = LetDanceWorkflow(mode or os.getenv('LETDANCE_WORKFLOW_MODE', 'agent'))
             logging.info("智能分析工作流初始化成功")
             return True
         else:
@@ -296,8 +369,8 @@ def initialize_workflow():
         logging.error(f"智能分析工作流初始化失败: {e}")
         return False
 
-def start_intelligent_analysis(duration: int = 10):
-    """启动智能分析（图像+姿态+音乐生成）"""
+def start_intelligent_analysis(duration: int = 10, mode: str = None):
+    """启动智能分析（图像+姿态+音乐生成），mode可选 agent / pipeline"""
     global workflow_instance
     
     if workflow_instance is None:
@@ -309,7 +382,7 @@ def start_intelligent_analysis(duration: int = 10):
     
     try:
         logging.info("开始智能分析工作流...")
-        result = workflow_instance.run_complete_workflow(duration)
+        result = workflow_instance.run_complete_workflow(duration, mode)
         
         # 输出结果
         print("\n" + "="*50)
@@ -322,6 +395,10 @@ def start_intelligent_analysis(duration: int = 10):
             print("\n生成的音乐关键词:")
             print(", ".join(result['final_keywords']))
             
+            metrics = result['analysis_result'].get('metrics', {})
+            print(f"\n模式: {metrics.get('mode')}，耗时: {metrics.get('wall_time')}s，"
+                  f"LLM调用: {metrics.get('llm_calls')}次，token: {metrics.get('total_tokens')}")
+            
             if result['music_result']['success']:
                 print(f"\n🎵 音乐生成成功并已开始播放！")
                 print(f"音乐文件: {result['music_result']['music_file']}")
@@ -343,7 +420,7 @@ def generate_and_play_music(keywords: str = "ambient, emotional, calm, contempla
     
     try:
         # 初始化音乐生成客户端
-        music_client = MusicGenClient()
+        music_client = create_music_client()
         
         # 检查音乐生成服务状态
         if not music_client.check_health():
@@ -441,6 +518,7 @@ def main():
         print("- 访问 http://localhost:5000 使用Web界面")
         print("- 使用 generate_and_play_music('关键词') 生成音乐")
         print("- 使用 start_intelligent_analysis(10) 开始智能分析")
+        print("- 使用 start_intelligent_analysis(10, 'pipeline') 以直接流水线模式分析")
         
         while True:
             time.sleep(1)
@@ -8,19 +8,30 @@ LETDANCE 主Agent执行器
 import json
 import logging
 import os
+import time
+import threading
 from typing import Dict, Any, Optional
 from pprint import pformat
 
 from langchain.agents import AgentExecutor, create_tool_calling_agent
 from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.messages import HumanMessage
 from langchain_openai import AzureChatOpenAI
 
 from tools import get_all_tools
+from tools.result_compactor import ToolResultCompactor
+from tools.circuit_breaker import (
+    get_circuit_breaker, start_latency_budget, CircuitOpenError, LatencyBudgetExceeded
+)
+from keyword_cache import get_keyword_cache
+from pipeline import DirectPipeline, LLMUsageTracker, keywords_from_agent_output
+from keyword_rules import rule_based_keywords
+from speculative_music import SpeculativeMusicGenerator
+from music_cache import get_music_cache
+from music_queue import MusicGenerationQueue
 from config import *
 from config.azure_config import AzureConfig
-from client import MusicGenClient
-from microphone import play, play_async
+from client import create_music_client
+from microphone import play, play_async, StreamingPlayer, get_audio_engine
 
 # 配置日志
 logging.basicConfig(
@@ -32,11 +43,50 @@ logger = logging.getLogger(__name__)
 class LetDanceWorkflow:
     """LETDANCE 主工作流"""
     
-    def __init__(self):
+    # 工作流模式：agent(工具调用Agent决定调用顺序) / pipeline(代码直接调用工具 + 一次LLM融合)
+    #           / local(离线：本地表情模型 + 姿态分析 + 规则关键词，不调用Azure)
+    WORKFLOW_MODES = ('agent', 'pipeline', 'local')
+    
+    def __init__(self, mode: str = 'agent', use_keyword_cache: bool = True, speculative_music: bool = False,
+                 stream_playback: bool = True, use_music_cache: bool = True, use_music_queue: bool = False,
+                 audio_engine: bool = False):
+        if mode not in self.WORKFLOW_MODES:
+            raise ValueError(f"不支持的工作流模式: {mode}，可选: {self.WORKFLOW_MODES}")
+        
+        self.mode = mode
         self.tools = get_all_tools()
         self.llm = self._initialize_llm()
+        # Agent上下文中只放工具结果的精简投影，完整结果保留在intermediate_steps中
+        self.compactor = ToolResultCompactor()
         self.agent_executor = self._create_agent_executor()
-        self.music_client = MusicGenClient()
+        # 配置了多台音乐生成服务时按健康状态和延迟路由，并对慢请求发送对冲请求
+        self.music_client = create_music_client()
+        # Azure调用共享熔断器（图像分析、Agent、关键词提取共用）
+        self.breaker = get_circuit_breaker('azure', **AzureConfig.get_circuit_breaker_config())
+        # 关键词缓存：流水线模式在LLM融合前查询，两种模式的有效结果都会写入
+        self.keyword_cache = get_keyword_cache() if use_keyword_cache else None
+        self.pipeline = DirectPipeline(self.tools, self.llm, self.breaker, keyword_cache=self.keyword_cache)
+        # 推测式音乐生成：采集完成后用临时关键词提前生成，与关键词LLM调用并行
+        self.speculator = SpeculativeMusicGenerator(self.music_client) if speculative_music else None
+        # 常驻音频引擎：新一轮的音乐与正在播放的音乐交叉淡化切换；
+        # 引擎独占输出设备，启用时不再边下载边播放
+        self.audio_engine = get_audio_engine() if audio_engine else None
+        if self.audio_engine is not None and not self.audio_engine.running:
+            logger.warning("音频引擎启动失败，改用独立播放进程")
+            self.audio_engine = None
+        # 边下载边播放：收到WAV头和第一段缓冲后即开始播放
+        self.stream_playback = stream_playback and self.audio_engine is None
+        # 音乐缓存：相同关键词集合（不计顺序）直接使用已生成的音乐
+        self.music_cache = get_music_cache() if use_music_cache else None
+        # 音乐生成队列：后台线程执行生成，空闲时为每个情绪主题预取曲目（缓存由本类处理）
+        self.music_queue = MusicGenerationQueue(self.music_client) if use_music_queue else None
+        
+        # 按模式累计的耗时、LLM调用与token统计，用于对比两种模式（多轮可能并行完成）
+        self._stats_lock = threading.Lock()
+        self._mode_stats = {
+            mode_name: {'rounds': 0, 'wall_time': 0.0, 'llm_calls': 0, 'total_tokens': 0, 'vision_tokens': 0}
+            for mode_name in self.WORKFLOW_MODES
+        }
         
     def _initialize_llm(self) -> AzureChatOpenAI:
         """初始化Azure OpenAI LLM"""
@@ -63,8 +113,9 @@ class LetDanceWorkflow:
 - 等待第一步完成后，使用 pose_analysis 工具进行实时姿态分析
 - 这将持续分析用户的肢体动作情感
 
-**第三步：生成音乐关键词**
-- 综合两种分析结果，生成4个英文音乐风格关键词
+**第三步：提交音乐关键词**
+- 综合两种分析结果，调用 submit_music_keywords 工具提交4个英文音乐风格关键词
+- 关键词只能从工具说明的词表中选择，提交后流程立即结束
 
 **重要提醒：**
 - 必须按顺序执行，不能同时调用两个摄像头工具
@@ -74,15 +125,49 @@ class LetDanceWorkflow:
             ("placeholder", "{agent_scratchpad}")
         ])
         
-        agent = create_tool_calling_agent(self.llm, self.tools, prompt)
+        agent = create_tool_calling_agent(
+            self.llm, self.tools, prompt, message_formatter=self.compactor.format_messages
+        )
         return AgentExecutor(
             agent=agent, 
             tools=self.tools, 
             verbose=True,
             max_iterations=6,  # 增加迭代次数，确保有足够步骤
-            early_stopping_method="generate"
+            early_stopping_method="generate",
+            return_intermediate_steps=True
         )
     
+    def _get_tool(self, tool_name: str):
+        """按名称获取已注册的工具"""
+        for tool in self.tools:
+            if tool.name == tool_name:
+                return tool
+        raise ValueError(f"工具 '{tool_name}' 未注册")
+    
+    def _degraded_analysis(self, duration: int, reason: str) -> Dict[str, Any]:
+        """降级分析：跳过所有Azure调用，只做本地姿态分析"""
+        logger.warning(f"进入降级模式（{reason}），仅使用姿态分析生成关键词")
+        
+        pose_data = self._get_tool('pose_analysis').invoke({
+            'action': 'analyze_realtime',
+            'duration': duration,
+            'confidence_threshold': 0.5
+        })
+        music_keywords = rule_based_keywords(pose_data)
+        
+        return {
+            'success': True,
+            'message': f'降级模式：{reason}，已根据姿态生成音乐关键词',
+            'agent_output': None,
+            'pose_analysis': pose_data,
+            'image_analysis': None,
+            'laban_analysis_text': self._format_laban_analysis(pose_data) if pose_data else None,
+            'music_keywords': music_keywords,
+            'ready_for_music_generation': True,
+            'degraded': True,
+            'azure_metrics': self.breaker.get_metrics()
+        }
+    
     def _format_laban_analysis(self, pose_data: Dict) -> str:
         """格式化拉班动作理论分析结果"""
         if not pose_data or not pose_data.get('success'):
@@ -120,13 +205,203 @@ class LetDanceWorkflow:
 主导情感: {pose_data.get('data', {}).get('dominant_emotion', 'N/A')}
 """
     
-    def analyze_and_generate_music_keywords(self, duration: int = 10) -> Dict[str, Any]:
-        """执行完整的分析流程并生成音乐关键词"""
+    def analyze_and_generate_music_keywords(self, duration: int = 10, mode: Optional[str] = None) -> Dict[str, Any]:
+        """
+        执行完整的分析流程并生成音乐关键词
+        
+        Args:
+            duration: 姿态分析时长（秒）
+            mode: 本轮使用的工作流模式，默认使用初始化时的模式
+        """
+        return self.complete_round(self.capture_round(duration, mode))
+    
+    def capture_round(self, duration: int = 10, mode: Optional[str] = None) -> Dict[str, Any]:
+        """
+        分析轮次的采集阶段（占用摄像头）
+        
+        流水线/离线模式只运行摄像头工具，关键词生成留给complete_round；
+        Agent模式中LLM与工具调用交织，整轮分析都在本阶段完成。
+        
+        Returns:
+            交给complete_round的轮次状态
+        """
+        mode = mode or self.mode
+        if mode not in self.WORKFLOW_MODES:
+            raise ValueError(f"不支持的工作流模式: {mode}，可选: {self.WORKFLOW_MODES}")
+        
+        # 每轮开始新的延迟预算（姿态采集时长不计入Azure预算）
+        start_latency_budget(AzureConfig.ROUND_LATENCY_BUDGET + duration)
+        round_state = {
+            'mode': mode,
+            'start_time': time.time(),
+            # 每轮独立计数，流水线调度时多轮可以同时在途
+            'usage_tracker': LLMUsageTracker()
+        }
+        
+        if mode in ('pipeline', 'local'):
+            try:
+                logger.info(f"开始LETDANCE分析流程（{'直接流水线' if mode == 'pipeline' else '离线'}模式）")
+                round_state['tool_results'] = self.pipeline.capture(
+                    duration, image_backend='local' if mode == 'local' else 'azure'
+                )
+            except Exception as e:
+                logger.error(f"流水线采集异常: {e}")
+                round_state['result'] = {
+                    'success': False,
+                    'message': f'流水线分析异常: {str(e)}',
+                    'music_keywords': [],
+                    'ready_for_music_generation': False,
+                    'azure_metrics': self.breaker.get_metrics()
+                }
+        else:
+            round_state['result'] = self._analyze_with_agent(duration, round_state['usage_tracker'])
+        
+        return round_state
+    
+    def complete_round(self, round_state: Dict[str, Any]) -> Dict[str, Any]:
+        """分析轮次的生成阶段：生成关键词（或命中缓存）并记录指标，不占用摄像头"""
+        mode = round_state['mode']
+        tracker = round_state['usage_tracker']
+        
+        result = round_state.get('result')
+        if result is None and mode == 'local':
+            result = self._pipeline_result_to_analysis(self.pipeline.finish_local(round_state['tool_results']))
+        elif result is None:
+            result = self._analyze_with_pipeline(round_state['tool_results'], tracker)
+        
+        result['mode'] = mode
+        result['metrics'] = self._record_round_metrics(
+            mode, time.time() - round_state['start_time'], result, tracker.snapshot()
+        )
+        result['mode_comparison'] = self.get_mode_comparison()
+        return result
+    
+    def _record_round_metrics(self, mode: str, wall_time: float, result: Dict[str, Any],
+                              usage: Dict[str, int]) -> Dict[str, Any]:
+        """记录本轮耗时、LLM调用次数和token用量"""
+        
+        vision_tokens = 0
+        image_data = (result.get('image_analysis') or {}).get('data') or {}
+        if image_data.get('usage'):
+            vision_tokens = image_data['usage'].get('total_tokens', 0)
+        
+        metrics = {
+            'mode': mode,
+            'wall_time': round(wall_time, 3),
+            'cache_hit': bool(result.get('cache_hit')),
+            'vision_tokens': vision_tokens,
+            'context_tokens_saved': (result.get('context_compaction') or {}).get('tokens_saved', 0),
+            **usage
+        }
+        
+        # 只统计成功、未降级且未命中缓存的轮次，保证两种模式可比
+        if result.get('success') and not result.get('degraded') and not result.get('cache_hit'):
+            with self._stats_lock:
+                stats = self._mode_stats[mode]
+                stats['rounds'] += 1
+                stats['wall_time'] += wall_time
+                stats['llm_calls'] += usage['llm_calls']
+                stats['total_tokens'] += usage['total_tokens']
+                stats['vision_tokens'] += vision_tokens
+        
+        logger.info(f"⏱️ [{mode}] 本轮耗时{wall_time:.1f}s，LLM调用{usage['llm_calls']}次，token {usage['total_tokens']}")
+        return metrics
+    
+    def get_mode_comparison(self) -> Dict[str, Any]:
+        """获取agent与pipeline两种模式的平均耗时、LLM调用次数和token用量"""
+        comparison = {}
+        with self._stats_lock:
+            mode_stats = {mode_name: dict(stats) for mode_name, stats in self._mode_stats.items()}
+        
+        for mode_name, stats in mode_stats.items():
+            rounds = stats['rounds']
+            comparison[mode_name] = {
+                'rounds': rounds,
+                'avg_wall_time': round(stats['wall_time'] / rounds, 3) if rounds else None,
+                'avg_llm_calls': round(stats['llm_calls'] / rounds, 2) if rounds else None,
+                'avg_total_tokens': round(stats['total_tokens'] / rounds, 1) if rounds else None,
+                'avg_vision_tokens': round(stats['vision_tokens'] / rounds, 1) if rounds else None
+            }
+        return comparison
+    
+    def _analyze_with_pipeline(self, tool_results: Dict[str, Any], tracker: LLMUsageTracker) -> Dict[str, Any]:
+        """直接流水线模式：基于已采集的工具结果，用一次LLM融合生成关键词"""
         try:
-            logger.info("开始LETDANCE分析流程")
+            return self._pipeline_result_to_analysis(self.pipeline.finish(tool_results, callbacks=[tracker]))
             
-            # 构建更简单直接的提示词
-            input_message = f"""请按顺序执行以下分析：
+        except Exception as e:
+            logger.error(f"流水线分析异常: {e}")
+            return {
+                'success': False,
+                'message': f'流水线分析异常: {str(e)}',
+                'music_keywords': [],
+                'ready_for_music_generation': False,
+                'azure_metrics': self.breaker.get_metrics()
+            }
+    
+    def provisional_keywords(self, round_state: Dict[str, Any]) -> Optional[list]:
+        """
+        采集完成后立即可用的本地规则关键词（LLM返回前的临时结果）
+        
+        仅流水线模式需要；离线模式的最终关键词就是规则关键词，
+        Agent模式在采集阶段已完成整轮分析，两者都返回None
+        """
+        tool_results = round_state.get('tool_results')
+        if round_state['mode'] != 'pipeline' or not tool_results:
+            return None
+        return rule_based_keywords(tool_results['pose_analysis'], tool_results['image_analysis'])
+    
+    def start_speculative_music(self, round_state: Dict[str, Any]) -> None:
+        """采集完成后用临时关键词开始推测生成音乐（未启用推测或没有临时关键词时不做任何事）"""
+        if self.speculator is None:
+            return
+        
+        provisional = self.provisional_keywords(round_state)
+        # 临时关键词的音乐已在缓存中时无需推测生成
+        if provisional and not (self.music_cache and self.music_cache.contains(provisional)):
+            round_state['speculation'] = self.speculator.start(provisional)
+    
+    def discard_speculative_music(self, round_state: Dict[str, Any], reason: str = '') -> None:
+        """本轮不再生成音乐时取消或丢弃推测生成"""
+        speculation = round_state.get('speculation')
+        if speculation is not None:
+            self.speculator.discard(speculation, reason)
+    
+    def _pipeline_result_to_analysis(self, pipeline_result: Dict[str, Any]) -> Dict[str, Any]:
+        """将流水线结果整理为分析结果"""
+        pose_data = pipeline_result['pose_analysis']
+        
+        if pipeline_result.get('rule_based'):
+            message = '离线模式：已根据本地规则生成音乐关键词'
+        elif pipeline_result['cache_hit']:
+            message = '命中关键词缓存，跳过关键词生成'
+        else:
+            message = '流水线分析完成，音乐关键词已生成'
+        
+        return {
+            'success': True,
+            'message': message,
+            'agent_output': None,
+            'pose_analysis': pose_data,
+            'image_analysis': pipeline_result['image_analysis'],
+            'laban_analysis_text': self._format_laban_analysis(pose_data) if pose_data else None,
+            'music_keywords': pipeline_result['music_keywords'],
+            'ready_for_music_generation': True,
+            'degraded': pipeline_result['fusion_fallback'],
+            'cache_hit': pipeline_result['cache_hit'],
+            'rule_based': bool(pipeline_result.get('rule_based')),
+            'stage_times': {
+                'tools': pipeline_result['tools_time'],
+                'vision_wait': pipeline_result['vision_wait'],
+                'fusion': pipeline_result['fusion_time']
+            },
+            'shared_camera_stream': pipeline_result['shared_stream'],
+            'azure_metrics': self.breaker.get_metrics()
+        }
+    
+    def _agent_input(self, duration: int) -> str:
+        """构建Agent输入提示词"""
+        return f"""请按顺序执行以下分析：
 
 1. 使用image_analysis工具拍照并分析用户情感：
    - action: capture_and_analyze
@@ -137,42 +412,28 @@ class LetDanceWorkflow:
    - duration: {duration}
    - confidence_threshold: 0.5
 
-3. 基于两个分析结果生成4个英文音乐风格关键词。
-
-请确保两个工具都被调用，然后提供最终的音乐关键词。"""
+3. 基于两个分析结果，使用submit_music_keywords工具提交4个英文音乐风格关键词。
 
-            # 执行Agent工作流
-            result = self.agent_executor.invoke({"input": input_message})
-            
-            # 从Agent的中间步骤中提取工具结果
-            pose_data = None
-            image_data = None
+请确保两个分析工具都被调用，最后通过submit_music_keywords提交关键词。"""
+    
+    def _analyze_with_agent(self, duration: int, tracker: LLMUsageTracker) -> Dict[str, Any]:
+        """Agent模式：由工具调用Agent决定调用顺序"""
+        try:
+            logger.info("开始LETDANCE分析流程")
             
-            # 检查Agent执行历史中的工具调用结果
-            if hasattr(result, 'intermediate_steps'):
-                for step in result.intermediate_steps:
-                    if len(step) >= 2:
-                        action, observation = step[0], step[1]
-                        if hasattr(action, 'tool') and action.tool == 'pose_analysis':
-                            if isinstance(observation, dict):
-                                pose_data = observation
-                        elif hasattr(action, 'tool') and action.tool == 'image_analysis':
-                            if isinstance(observation, dict):
-                                image_data = observation
-
-            # 从Agent输出中提取音乐关键词
-            music_keywords = self._extract_music_keywords(result['output'])
+            # 执行Agent工作流（熔断器打开或预算耗尽时立即降级）
+            compaction_stats = self.compactor.start_round()
+            try:
+                result = self.breaker.call(
+                    self.agent_executor.invoke, {"input": self._agent_input(duration)},
+                    {'callbacks': [tracker]}, label='agent'
+                )
+            except (CircuitOpenError, LatencyBudgetExceeded) as e:
+                return self._degraded_analysis(duration, str(e))
             
-            return {
-                'success': True,
-                'message': '分析完成，音乐关键词已生成',
-                'agent_output': result['output'],
-                'pose_analysis': pose_data,
-                'image_analysis': image_data,
-                'laban_analysis_text': self._format_laban_analysis(pose_data) if pose_data else None,
-                'music_keywords': music_keywords,
-                'ready_for_music_generation': True
-            }
+            analysis = self._agent_result_to_analysis(result)
+            analysis['context_compaction'] = self.compactor.summarize(compaction_stats)
+            return analysis
             
         except Exception as e:
             logger.error(f"分析流程异常: {e}")
@@ -180,45 +441,117 @@ class LetDanceWorkflow:
                 'success': False,
                 'message': f'分析流程异常: {str(e)}',
                 'music_keywords': [],
-                'ready_for_music_generation': False
+                'ready_for_music_generation': False,
+                'azure_metrics': self.breaker.get_metrics()
             }
     
-    def _extract_music_keywords(self, agent_output: str) -> list:
-        """从Agent输出中提取音乐关键词"""
-        try:
-            # 使用LLM提取关键词
-            extraction_prompt = f"""
-            从以下分析结果中提取4个音乐风格关键词。
-            
-            分析结果：
-            {agent_output}
-            
-            请只返回4个英文音乐风格关键词，用逗号分隔，例如：ambient, emotional, energetic, peaceful
-            """
-            
-            response = self.llm.invoke([HumanMessage(content=extraction_prompt)])
-            keywords_text = response.content.strip()
-            
-            # 解析关键词
-            keywords = [kw.strip() for kw in keywords_text.split(',') if kw.strip()]
-            return keywords[:4]  # 确保只返回4个关键词
-            
-        except Exception as e:
-            logger.error(f"关键词提取失败: {e}")
-            return ["ambient", "emotional", "calm", "contemplative"]  # 默认关键词
+    def _agent_result_to_analysis(self, result: Dict[str, Any]) -> Dict[str, Any]:
+        """从Agent执行结果中整理工具结果和音乐关键词"""
+        # 从Agent的中间步骤中提取工具结果
+        pose_data = None
+        image_data = None
+        
+        # 检查Agent执行历史中的工具调用结果
+        if result.get('intermediate_steps'):
+            for step in result['intermediate_steps']:
+                if len(step) >= 2:
+                    action, observation = step[0], step[1]
+                    if hasattr(action, 'tool') and action.tool == 'pose_analysis':
+                        if isinstance(observation, dict):
+                            pose_data = observation
+                    elif hasattr(action, 'tool') and action.tool == 'image_analysis':
+                        if isinstance(observation, dict):
+                            image_data = observation
+
+        # 关键词由submit_music_keywords工具直接返回，无需再调用LLM提取
+        keyword_result = keywords_from_agent_output(result['output'], pose_data, image_data)
+        music_keywords = keyword_result['music_keywords']
+        
+        # Agent模式在LLM之前拿不到工具结果，无法查询缓存；只写入，供流水线模式命中
+        if self.keyword_cache is not None and not keyword_result['fallback']:
+            self.keyword_cache.put(self.keyword_cache.make_key(image_data, pose_data), music_keywords)
+        
+        return {
+            'success': True,
+            'message': '分析完成，音乐关键词已生成',
+            'agent_output': result['output'],
+            'pose_analysis': pose_data,
+            'image_analysis': image_data,
+            'laban_analysis_text': self._format_laban_analysis(pose_data) if pose_data else None,
+            'music_keywords': music_keywords,
+            'ready_for_music_generation': True,
+            'degraded': keyword_result['fallback'],
+            'azure_metrics': self.breaker.get_metrics()
+        }
     
-    def generate_music(self, keywords: list) -> Dict[str, Any]:
-        """音乐生成接口"""
+    def generate_music(self, keywords: list, speculation=None) -> Dict[str, Any]:
+        """
+        音乐生成接口
+        
+        Args:
+            keywords: 最终音乐关键词
+            speculation: 本轮的推测生成；关键词一致时直接使用其结果，否则丢弃后正常生成
+        """
         logger.info(f"音乐生成接口被调用，关键词: {keywords}")
         
         try:
+            cached_file = self.music_cache.get(keywords) if self.music_cache else None
+            if cached_file:
+                logger.info(f"🎼 命中音乐缓存: {cached_file}")
+                if speculation is not None:
+                    self.speculator.discard(speculation, '命中音乐缓存')
+                result = self._play_generated_music(cached_file, keywords)
+                result['music_cache_hit'] = True
+                return result
+            
+            if speculation is not None:
+                music_file = self.speculator.resolve(speculation, keywords)
+                if music_file:
+                    result = self._play_generated_music(self._cache_music(keywords, music_file), keywords)
+                    result['speculative'] = True
+                    return result
+            
             # 将关键词转换为音乐生成提示词
             prompt = ", ".join(keywords)
             logger.info(f"生成音乐提示词: {prompt}")
             
-            # 调用音乐生成客户端
-            music_file = self.music_client.generate_music(prompt)
+            # 调用音乐生成客户端（启用流式播放时，下载过程中即开始播放）
+            player = StreamingPlayer() if self.stream_playback else None
+            if self.music_queue is not None:
+                # 预取池中有同主题的曲目时立即播放，池在后台补充
+                track = self.music_queue.take_ready(keywords)
+                if track:
+                    # 取出的曲目按其生成关键词移入音乐缓存（受缓存容量限制），不在预取目录中累积
+                    music_file = self._cache_music(track['keywords'], track['music_file'])
+                    result = self._play_generated_music(music_file, keywords)
+                    result['pooled'] = True
+                    result['pooled_keywords'] = track['keywords']
+                    return result
+                # 正式任务有单独的工作线程，不排在预取之后；等待超时时放弃本次生成
+                music_file = self.music_queue.wait(self.music_queue.submit(keywords, player=player))
+            else:
+                music_file = self.music_client.generate_music(prompt, player=player)
+            return self._play_generated_music(self._cache_music(keywords, music_file), keywords, player)
             
+        except Exception as e:
+            logger.error(f"音乐生成失败: {e}")
+            return {
+                'success': False,
+                'message': f'音乐生成失败: {str(e)}',
+                'keywords_used': keywords,
+                'music_file': None
+            }
+    
+    def _cache_music(self, keywords: list, music_file: Optional[str]) -> Optional[str]:
+        """将生成的音乐移入音乐缓存，返回之后应使用的文件路径"""
+        if self.music_cache is None or not music_file:
+            return music_file
+        return self.music_cache.put(keywords, music_file) or music_file
+    
+    def _play_generated_music(self, music_file: Optional[str], keywords: list,
+                              player: Optional[StreamingPlayer] = None) -> Dict[str, Any]:
+        """检查生成的音乐文件并开始播放（已在下载过程中开始流式播放时不再重复播放）"""
+        try:
             # 检查音乐文件是否生成成功
             if music_file is None:
                 logger.error("音乐生成失败：外部服务返回空文件路径")
@@ -239,11 +572,30 @@ class LetDanceWorkflow:
                     'music_file': None
                 }
             
+            # 下载时已开始流式播放，且播放器仍在运行或已正常播完
+            if player is not None and player.started and (player.is_playing() or player.wait(timeout=0)):
+                logger.info(f"音乐已在下载过程中开始播放: {music_file}")
+                return {
+                    'success': True,
+                    'message': '音乐生成成功，已边下载边播放',
+                    'keywords_used': keywords,
+                    'music_file': music_file,
+                    'streamed_playback': True
+                }
+            
+            if self.audio_engine is not None and self.audio_engine.play(music_file):
+                return {
+                    'success': True,
+                    'message': '音乐生成成功，已切换到新音乐',
+                    'keywords_used': keywords,
+                    'music_file': music_file,
+                    'audio_engine': True
+                }
+            
             # 自动播放生成的音乐（异步播放，带验证）
             logger.info(f"开始播放音乐: {music_file}")
             
             # 启动异步播放并等待一小段时间验证
-            import time
             play_thread = play_async(music_file)
             
             # 等待0.5秒，让播放线程启动
@@ -276,16 +628,21 @@ class LetDanceWorkflow:
                 'music_file': None
             }
     
-    def run_complete_workflow(self, duration: int = 10) -> Dict[str, Any]:
+    def run_complete_workflow(self, duration: int = 10, mode: Optional[str] = None) -> Dict[str, Any]:
         """运行完整工作流：分析 -> 生成音乐关键词 -> 生成音乐"""
-        # 步骤1: 分析并生成关键词
-        analysis_result = self.analyze_and_generate_music_keywords(duration)
+        # 步骤1: 分析并生成关键词（启用推测时，采集完成后即开始用临时关键词生成音乐）
+        round_state = self.capture_round(duration, mode)
+        self.start_speculative_music(round_state)
+        analysis_result = self.complete_round(round_state)
         
         if not analysis_result['success']:
+            self.discard_speculative_music(round_state, '分析未成功')
             return analysis_result
         
         # 步骤2: 生成音乐
-        music_result = self.generate_music(analysis_result['music_keywords'])
+        music_result = self.generate_music(analysis_result['music_keywords'], round_state.get('speculation'))
+        if self.speculator is not None:
+            music_result['speculation_stats'] = self.speculator.get_stats()
         
         return {
             'success': True,
@@ -2,25 +2,49 @@
 # -*- coding: utf-8 -*-
 """
 音频播放模块 - 树莓派优化版
-支持多种音频播放方式，确保在树莓派上稳定运行
+支持多种音频播放方式，确保在树莓派上稳定运行；
+AudioEngine提供常驻的输出流与交叉淡化播放队列
 """
 
 import os
+import mmap
+import struct
 import logging
 import subprocess
 import threading
 import time
+from collections import deque
+
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
 
 # 配置日志
 logger = logging.getLogger(__name__)
 
-def play_with_aplay(audio_file: str, device: str = None):
+def _run_player(cmd: list, name: str, on_start=None) -> bool:
+    """启动播放进程并等待播放结束；进程启动后调用on_start（用于记录开始播放的延迟）"""
+    process = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    if on_start:
+        on_start()
+    _, stderr = process.communicate()
+    
+    if process.returncode == 0:
+        logger.info(f"{name}播放成功")
+        return True
+    logger.error(f"{name}播放失败: {stderr}")
+    return False
+
+def play_with_aplay(audio_file: str, device: str = None, on_start=None):
     """
     使用aplay命令播放音频
     
     Args:
         audio_file: 音频文件路径
         device: 音频输出设备（可选）
+        on_start: 播放进程启动后的回调（可选）
     """
     try:
         cmd = ['aplay']
@@ -29,88 +53,804 @@ def play_with_aplay(audio_file: str, device: str = None):
         cmd.append(audio_file)
         
         logger.info(f"使用aplay播放: {' '.join(cmd)}")
-        result = subprocess.run(cmd, capture_output=True, text=True)
-        
-        if result.returncode == 0:
-            logger.info("aplay播放成功")
-            return True
-        else:
-            logger.error(f"aplay播放失败: {result.stderr}")
-            return False
+        return _run_player(cmd, 'aplay', on_start)
             
     except Exception as e:
         logger.error(f"aplay播放异常: {e}")
         return False
 
-def play_with_pygame(audio_file: str, volume: float = 0.7):
+def _init_pygame_mixer(pygame, sample_rate: int, channels: int) -> bool:
+    """按16bit、指定采样率和声道数初始化mixer（格式相同时直接复用），返回mixer实际格式是否一致"""
+    mixer_format = (sample_rate, -16, channels)
+    if pygame.mixer.get_init() == mixer_format:
+        return True
+    
+    pygame.mixer.quit()
+    try:
+        # allowedchanges=0：设备不支持该格式时由SDL转换，mixer格式与文件数据保持一致
+        pygame.mixer.init(frequency=sample_rate, size=-16, channels=channels, buffer=512, allowedchanges=0)
+    except TypeError:
+        # pygame 1.x没有allowedchanges参数
+        pygame.mixer.init(frequency=sample_rate, size=-16, channels=channels, buffer=512)
+    return pygame.mixer.get_init() == mixer_format
+
+def play_with_pygame(audio_file: str, volume: float = 0.7, on_start=None, chunk_seconds: float = 1.0):
     """
     使用pygame播放音频（备用方式）
     
+    16bit PCM的WAV文件以内存映射方式按块送入mixer（始终排队下一块），
+    mixer按文件原始采样率和声道数初始化（不允许SDL改变格式），格式不变时直接复用，不做重采样；
+    其他文件或mixer无法按该格式打开时交给pygame.mixer.music播放。播放失败时关闭mixer，下次重新初始化
+    
     Args:
         audio_file: 音频文件路径
         volume: 音量 (0.0 - 1.0)
+        on_start: 开始播放后的回调（可选）
+        chunk_seconds: 每块时长（秒）
     """
     try:
         import pygame
+    except ImportError:
+        logger.error("pygame未安装，无法使用pygame播放")
+        return False
+    
+    try:
+        try:
+            wav = MappedWav(audio_file)
+        except (ValueError, OSError, struct.error):
+            wav = None
         
-        # 初始化pygame音频模块，使用适合树莓派的设置
-        pygame.mixer.pre_init(frequency=22050, size=-16, channels=2, buffer=512)
-        pygame.mixer.init()
-        
-        # 加载音频文件
-        pygame.mixer.music.load(audio_file)
-        
-        # 设置音量
-        pygame.mixer.music.set_volume(volume)
-        
-        # 播放音频
-        pygame.mixer.music.play()
+        # mixer无法按文件原始格式打开时，原始数据块会以错误的音调/速度播放，改用mixer.music（会转换格式）
+        if wav is not None and (wav.sample_width != 2 or wav.channels > 2
+                                or not _init_pygame_mixer(pygame, wav.sample_rate, wav.channels)):
+            wav.close()
+            wav = None
         
-        logger.info(f"pygame开始播放音频: {audio_file}")
+        if wav is None:
+            if not pygame.mixer.get_init():
+                # 初始化pygame音频模块，使用适合树莓派的设置
+                pygame.mixer.pre_init(frequency=22050, size=-16, channels=2, buffer=512)
+                pygame.mixer.init()
+            pygame.mixer.music.load(audio_file)
+            pygame.mixer.music.set_volume(volume)
+            pygame.mixer.music.play()
+            if on_start:
+                on_start()
+            logger.info(f"pygame开始播放音频: {audio_file}")
+            while pygame.mixer.music.get_busy():
+                time.sleep(0.1)
+            logger.info("pygame播放完成")
+            return True
         
-        # 等待播放完成
-        while pygame.mixer.music.get_busy():
-            time.sleep(0.1)
+        with wav:
+            channel = None
+            chunk_frames = max(1, int(wav.sample_rate * chunk_seconds))
+            for chunk in wav.chunks(chunk_frames):
+                sound = pygame.mixer.Sound(buffer=chunk)
+                if channel is None:
+                    channel = sound.play()
+                    if channel is None:
+                        raise RuntimeError("没有可用的mixer声道")
+                    channel.set_volume(volume)
+                    if on_start:
+                        on_start()
+                    logger.info(f"pygame开始分块播放音频: {audio_file}")
+                    continue
+                # 等到上一块开始播放、排队位置空出后再排入下一块
+                while channel.get_queue() is not None:
+                    time.sleep(0.05)
+                channel.queue(sound)
+            
+            while channel is not None and channel.get_busy():
+                time.sleep(0.1)
         
         logger.info("pygame播放完成")
         return True
         
-    except ImportError:
-        logger.error("pygame未安装，无法使用pygame播放")
-        return False
     except Exception as e:
         logger.error(f"pygame播放失败: {e}")
-        return False
-    finally:
         # 清理资源
         try:
             pygame.mixer.quit()
-        except:
+        except Exception:
             pass
+        return False
 
-def play_with_omxplayer(audio_file: str):
+def play_with_omxplayer(audio_file: str, on_start=None):
     """
     使用omxplayer播放音频（树莓派专用播放器）
     
     Args:
         audio_file: 音频文件路径
+        on_start: 播放进程启动后的回调（可选）
     """
     try:
         cmd = ['omxplayer', '--no-keys', audio_file]
         logger.info(f"使用omxplayer播放: {' '.join(cmd)}")
+        return _run_player(cmd, 'omxplayer', on_start)
+            
+    except Exception as e:
+        logger.error(f"omxplayer播放异常: {e}")
+        return False
+
+# 播放方式，按优先顺序尝试：名称 -> 播放函数(audio_file, volume, on_start)
+PLAYBACK_BACKENDS = {
+    'aplay': lambda audio_file, volume, on_start: play_with_aplay(audio_file, on_start=on_start),          # 最稳定
+    'aplay_hw': lambda audio_file, volume, on_start: play_with_aplay(audio_file, 'hw:0,0', on_start),     # 指定设备
+    'omxplayer': lambda audio_file, volume, on_start: play_with_omxplayer(audio_file, on_start),
+    'pygame': lambda audio_file, volume, on_start: play_with_pygame(audio_file, volume, on_start)         # 最后备选
+}
+# 各播放方式对应的aplay设备（流式播放使用与文件播放相同的设备）
+APLAY_DEVICES = {'aplay': None, 'aplay_hw': 'hw:0,0'}
+
+# 第一次探测成功的播放方式会被缓存，之后直接使用，失败时才重新探测
+_backend_lock = threading.Lock()
+_cached_backend = None
+_playback_stats = {
+    'plays': 0,
+    'failures': 0,
+    'probes': 0,
+    'invalidations': 0,
+    'start_latency': 0.0,
+    'last_start_latency': None
+}
+
+def get_audio_backend():
+    """当前缓存的播放方式（尚未探测时为None）"""
+    with _backend_lock:
+        return _cached_backend
+
+def reset_audio_backend():
+    """清除缓存的播放方式，下次播放时重新探测（例如更换了音频设备）"""
+    global _cached_backend
+    with _backend_lock:
+        _cached_backend = None
+
+def get_playback_stats():
+    """获取播放统计：当前播放方式、探测次数与开始播放的延迟"""
+    with _backend_lock:
+        stats = dict(_playback_stats)
+        stats['backend'] = _cached_backend
+    
+    stats['avg_start_latency'] = round(stats['start_latency'] / stats['plays'], 4) if stats['plays'] else None
+    stats['start_latency'] = round(stats['start_latency'], 4)
+    return stats
+
+class StreamingPlayer:
+    """
+    边下载边播放：播放线程跟随读取正在写入的临时文件，送入从标准输入读取WAV数据的aplay
+    
+    收到WAV头和第一段缓冲后即可开始播放，无需等待整首音乐下载完成；
+    下载线程只写文件并通知写入进度，不会因为aplay缓冲区写满而被拖到播放速度
+    """
+    
+    # 播放线程每次从文件读取的字节数
+    READ_SIZE = 32 * 1024
+    
+    def __init__(self, device: str = None):
+        """
+        Args:
+            device: 音频输出设备（可选）
+        """
+        self.device = device
+        self.process = None
+        self.failed = False
+        self.started_at = None
+        self._source = None
+        self._thread = None
+        self._condition = threading.Condition()
+        self._available = 0
+        self._ended = False
+    
+    @property
+    def started(self) -> bool:
+        return self.process is not None and not self.failed
+    
+    def start(self, source_path: str) -> bool:
+        """
+        启动aplay进程和播放线程
         
-        result = subprocess.run(cmd, capture_output=True, text=True)
+        Args:
+            source_path: 正在写入的音频文件（下载完成后被改名或移动也不影响已打开的文件）
+        """
+        # 未指定设备时使用文件播放探测到的aplay设备
+        device = self.device or APLAY_DEVICES.get(get_audio_backend())
+        cmd = ['aplay', '-q']
+        if device:
+            cmd.extend(['-D', device])
+        cmd.append('-')
         
-        if result.returncode == 0:
-            logger.info("omxplayer播放成功")
-            return True
+        try:
+            self._source = open(source_path, 'rb')
+            self.process = subprocess.Popen(
+                cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE
+            )
+        except Exception as e:
+            logger.error(f"流式播放启动失败: {e}")
+            if self._source is not None:
+                self._source.close()
+            self.failed = True
+            return False
+        
+        self.started_at = time.time()
+        self._thread = threading.Thread(target=self._pump, name='streaming-player', daemon=True)
+        self._thread.start()
+        logger.info(f"流式播放已启动: {' '.join(cmd)}")
+        return True
+    
+    def advance(self, available: int) -> bool:
+        """通知文件中已写入available字节（调用前需flush），播放器已退出时返回False"""
+        if not self.started:
+            return False
+        
+        with self._condition:
+            self._available = available
+            self._condition.notify_all()
+        return True
+    
+    def _pump(self):
+        """播放线程：把文件中已写入的数据送入aplay，追上写入进度时等待"""
+        position = 0
+        try:
+            while True:
+                with self._condition:
+                    self._condition.wait_for(
+                        lambda: self._available > position or self._ended or self.failed
+                    )
+                    available, ended = self._available, self._ended
+                if self.failed:
+                    return
+                if position >= available:
+                    if ended:
+                        break
+                    continue
+                
+                chunk = self._source.read(min(available - position, self.READ_SIZE))
+                if not chunk:
+                    break
+                position += len(chunk)
+                self.process.stdin.write(chunk)
+        except (BrokenPipeError, OSError, ValueError) as e:
+            if not self.failed:
+                logger.error(f"流式播放中断: {e}")
+                self.failed = True
+        finally:
+            self._source.close()
+            try:
+                self.process.stdin.close()
+            except (BrokenPipeError, OSError):
+                pass
+    
+    def end(self):
+        """数据写完（播放线程送完剩余数据后关闭aplay的标准输入，aplay播放完缓冲的数据后自行退出）"""
+        with self._condition:
+            self._ended = True
+            self._condition.notify_all()
+    
+    def abort(self):
+        """立即停止播放"""
+        with self._condition:
+            self.failed = True
+            self._condition.notify_all()
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+    
+    def is_playing(self) -> bool:
+        """播放器是否仍在运行"""
+        return self.started and self.process.poll() is None
+    
+    def wait(self, timeout: float = None) -> bool:
+        """等待播放结束，返回是否正常播放完成"""
+        if not self.started:
+            return False
+        
+        try:
+            returncode = self.process.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            return False
+        
+        if returncode != 0:
+            logger.error(f"流式播放失败: {self.process.stderr.read().decode(errors='ignore')}")
+            return False
+        return True
+
+# 音频引擎输出声道数，以及每次写入输出流的帧数（约46ms@44.1kHz），也是音量/切换等控制生效的粒度
+ENGINE_CHANNELS = 2
+ENGINE_BLOCK_FRAMES = 2048
+
+# 输出进程退出后的重启策略：等待时间从ENGINE_RESTART_BACKOFF秒开始逐次翻倍，
+# 连续重启ENGINE_MAX_RESTARTS次仍失败则停止引擎；输出稳定运行ENGINE_RESTART_RESET秒后重新计数
+ENGINE_RESTART_BACKOFF = 0.5
+ENGINE_MAX_RESTARTS = 5
+ENGINE_RESTART_RESET = 30.0
+
+class MappedWav:
+    """
+    内存映射的WAV文件：只解析头部，音频数据按帧区间切片读取，
+    常驻内存只与读取的块大小有关，不随曲目长度增长
+    """
+    
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, 'rb')
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._parse()
+        except Exception:
+            self.close()
+            raise
+    
+    def _parse(self):
+        if self._map[:4] != b'RIFF' or self._map[8:12] != b'WAVE':
+            raise ValueError(f"不是WAV文件: {self.path}")
+        
+        fmt = None
+        position = 12
+        size = len(self._map)
+        while position + 8 <= size:
+            chunk_id = self._map[position:position + 4]
+            chunk_size = struct.unpack('<I', self._map[position + 4:position + 8])[0]
+            if chunk_id == b'fmt ':
+                fmt = struct.unpack('<HHIIHH', self._map[position + 8:position + 24])
+            elif chunk_id == b'data':
+                if fmt is None:
+                    break
+                self.data_offset = position + 8
+                # 流式写出的WAV头中data长度可能是占位值，以文件实际大小为准
+                data_size = min(chunk_size, size - self.data_offset)
+                audio_format, self.channels, self.sample_rate, _, self.block_align, bits = fmt
+                if audio_format not in (1, 0xFFFE):
+                    raise ValueError(f"只支持PCM格式的WAV: {self.path}")
+                self.sample_width = bits // 8
+                self.frames = data_size // self.block_align
+                return
+            position += 8 + chunk_size + (chunk_size & 1)
+        raise ValueError(f"WAV文件缺少fmt或data块: {self.path}")
+    
+    @property
+    def duration(self) -> float:
+        return self.frames / self.sample_rate
+    
+    def read(self, start_frame: int, frames: int) -> bytes:
+        """读取[start_frame, start_frame + frames)的原始PCM数据（超出末尾时截断）"""
+        start = self.data_offset + max(0, start_frame) * self.block_align
+        end = self.data_offset + min(self.frames, start_frame + frames) * self.block_align
+        return self._map[start:end] if end > start else b''
+    
+    def chunks(self, chunk_frames: int):
+        """按固定帧数依次产出原始PCM数据块"""
+        for start in range(0, self.frames, chunk_frames):
+            yield self.read(start, chunk_frames)
+    
+    def close(self):
+        if getattr(self, '_map', None) is not None:
+            self._map.close()
+            self._map = None
+        self._file.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.close()
+
+def pcm_to_float(raw: bytes, sample_width: int, channels: int):
+    """原始PCM -> float32双声道数组（形状(帧数, 2)，取值[-1, 1]），单声道复制，多声道取前两个"""
+    if sample_width == 1:
+        samples = (np.frombuffer(raw, dtype=np.uint8).astype(np.float32) - 128) / 128
+    elif sample_width == 2:
+        samples = np.frombuffer(raw, dtype='<i2').astype(np.float32) / 32768
+    elif sample_width == 3:
+        bytes_ = np.frombuffer(raw, dtype=np.uint8).reshape(-1, 3).astype(np.int32)
+        values = bytes_[:, 0] | (bytes_[:, 1] << 8) | (bytes_[:, 2] << 16)
+        samples = np.where(values >= 1 << 23, values - (1 << 24), values).astype(np.float32) / (1 << 23)
+    elif sample_width == 4:
+        samples = np.frombuffer(raw, dtype='<i4').astype(np.float32) / (1 << 31)
+    else:
+        raise ValueError(f"不支持的采样位宽: {sample_width * 8}bit")
+    
+    samples = samples[:len(samples) // channels * channels].reshape(-1, channels)
+    if channels == 1:
+        return np.repeat(samples, 2, axis=1)
+    return samples[:, :2]
+
+class _Voice:
+    """
+    引擎中正在播放的一条音轨：从内存映射的WAV按块读取，带淡入淡出增益；
+    采样率与输出不同时按块线性插值重采样
+    """
+    
+    def __init__(self, audio_file: str, source: MappedWav, output_rate: int, gain: float = 1.0, delay: int = 0):
+        self.audio_file = audio_file
+        self.source = source
+        self.ratio = source.sample_rate / output_rate
+        # 以输出采样率计的总帧数与已播放帧数
+        self.length = int(source.frames / self.ratio)
+        self.position = 0
+        self._source_position = 0.0
+        self.gain = gain
+        self.target = gain
+        self.step = 0.0
+        # 开始前的静音帧数（无交叉淡化时让下一首恰好接在上一首末尾）
+        self.delay = delay
+    
+    @property
+    def remaining(self) -> int:
+        return self.delay + self.length - self.position
+    
+    @property
+    def finished(self) -> bool:
+        return self.remaining <= 0 or (self.target == 0 and self.gain <= 0)
+    
+    def fade_to(self, target: float, frames: int):
+        """在frames帧内把增益线性变化到target"""
+        self.target = target
+        if frames <= 0:
+            self.gain = target
+            self.step = 0.0
+        else:
+            self.step = (target - self.gain) / frames
+    
+    def _read(self, frames: int):
+        """读取接下来最多frames个输出帧（float32双声道）"""
+        frames = min(frames, self.length - self.position)
+        if frames <= 0:
+            return None
+        
+        source = self.source
+        if self.ratio == 1:
+            chunk = pcm_to_float(source.read(self.position, frames), source.sample_width, source.channels)
         else:
-            logger.error(f"omxplayer播放失败: {result.stderr}")
+            positions = self._source_position + np.arange(frames) * self.ratio
+            first = int(positions[0])
+            block = pcm_to_float(source.read(first, int(positions[-1]) - first + 2),
+                                 source.sample_width, source.channels)
+            offsets = positions - first
+            low = np.minimum(offsets.astype(np.int64), len(block) - 1)
+            high = np.minimum(low + 1, len(block) - 1)
+            weight = (offsets - low).astype(np.float32)[:, None]
+            chunk = block[low] * (1 - weight) + block[high] * weight
+            self._source_position = positions[-1] + self.ratio
+        
+        self.position += len(chunk)
+        return chunk
+    
+    def render(self, out, frames: int):
+        """把接下来frames帧叠加到out上"""
+        offset = min(self.delay, frames)
+        self.delay -= offset
+        chunk = self._read(frames - offset)
+        if chunk is None or not len(chunk):
+            return
+        
+        if self.step:
+            gains = self.gain + self.step * np.arange(1, len(chunk) + 1, dtype=np.float32)
+            gains = np.clip(gains, min(self.gain, self.target), max(self.gain, self.target))
+            self.gain = float(gains[-1])
+            if self.gain == self.target:
+                self.step = 0.0
+            out[offset:offset + len(chunk)] += chunk * gains[:, None]
+        elif self.gain:
+            out[offset:offset + len(chunk)] += chunk * self.gain
+    
+    def close(self):
+        self.source.close()
+
+class AudioEngine:
+    """
+    常驻音频引擎：一个长期运行的aplay进程持续接收PCM数据，引擎线程负责混音
+    
+    - 播放队列：当前曲目结束前开始下一首，按crossfade秒交叉淡化（为0时无缝衔接）
+    - 控制：play（淡入新曲目替换当前）、enqueue、skip、stop、set_volume
+    - 空闲时输出静音，输出流不中断，切换曲目不需要启动新进程
+    - 曲目以内存映射方式按块读取，常驻内存不随曲目长度增长
+    """
+    
+    def __init__(self, device: str = None, crossfade: float = 2.0, volume: float = 0.7,
+                 sample_rate: int = None):
+        """
+        Args:
+            device: aplay输出设备，未指定时使用文件播放探测到的设备
+            crossfade: 曲目切换的交叉淡化时长（秒）
+            volume: 主音量 (0.0 - 1.0)
+            sample_rate: 输出采样率；未指定时使用第一首曲目的采样率，
+                         之后采样率相同的曲目不需要重采样
+        """
+        self.device = device
+        self.crossfade = crossfade
+        self.volume = volume
+        self.sample_rate = sample_rate
+        
+        self.process = None
+        self.running = False
+        self._thread = None
+        self._lock = threading.Lock()
+        self._output_ready = threading.Event()
+        self._voices = []
+        self._current = None
+        self._queue = deque()
+        self._output_volume = volume
+        self._output_started_at = None
+        self._consecutive_restarts = 0
+        self._stats = {'tracks_started': 0, 'transitions': 0, 'resampled_tracks': 0, 'output_restarts': 0}
+    
+    def _crossfade_frames(self, crossfade: float = None) -> int:
+        return int((self.crossfade if crossfade is None else crossfade) * self.sample_rate)
+    
+    def start(self) -> bool:
+        """启动混音线程（指定了采样率时同时打开输出，否则在第一首曲目加入时打开）"""
+        if self.running:
+            return True
+        if not NUMPY_AVAILABLE:
+            logger.error("numpy未安装，无法使用音频引擎")
+            return False
+        if self.sample_rate and not self._open_output():
             return False
+        
+        self.running = True
+        self._thread = threading.Thread(target=self._mix_loop, name='audio-engine', daemon=True)
+        self._thread.start()
+        logger.info(f"🔊 音频引擎已启动（交叉淡化{self.crossfade}秒）")
+        return True
+    
+    def _open_output(self) -> bool:
+        device = self.device or APLAY_DEVICES.get(get_audio_backend())
+        cmd = ['aplay', '-q', '-t', 'raw', '-f', 'S16_LE', '-c', str(ENGINE_CHANNELS),
+               '-r', str(self.sample_rate), '--buffer-time=200000']
+        if device:
+            cmd.extend(['-D', device])
+        cmd.append('-')
+        
+        try:
+            self.process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                                            stderr=subprocess.DEVNULL)
+            self._output_started_at = time.time()
+            self._output_ready.set()
+            logger.info(f"音频引擎输出: {' '.join(cmd)}")
+            return True
+        except Exception as e:
+            logger.error(f"音频引擎输出启动失败: {e}")
+            return False
+    
+    def _open(self, audio_file: str):
+        """打开曲目；输出尚未打开时按该曲目的采样率打开"""
+        try:
+            source = MappedWav(audio_file)
+        except Exception as e:
+            logger.error(f"音频引擎无法加载{audio_file}: {e}")
+            return None
+        
+        with self._lock:
+            if self.process is None:
+                self.sample_rate = self.sample_rate or source.sample_rate
+                if not self._open_output():
+                    source.close()
+                    return None
+            if source.sample_rate != self.sample_rate:
+                self._stats['resampled_tracks'] += 1
+                logger.info(f"曲目采样率{source.sample_rate}Hz与输出{self.sample_rate}Hz不同，播放时重采样")
+        return source
+    
+    def play(self, audio_file: str, crossfade: float = None) -> bool:
+        """
+        立即切换到新曲目：当前曲目淡出、新曲目淡入，清空等待队列
+        
+        Args:
+            audio_file: WAV文件路径
+            crossfade: 本次切换的交叉淡化时长（秒），默认使用引擎配置
+        """
+        if not self.running:
+            return False
+        source = self._open(audio_file)
+        if source is None:
+            return False
+        
+        fade_frames = self._crossfade_frames(crossfade)
+        with self._lock:
+            self._clear_queue()
+            for voice in self._voices:
+                voice.fade_to(0.0, fade_frames)
+            self._start_voice(audio_file, source, fade_frames if self._voices else 0)
+        logger.info(f"🎵 音频引擎切换到: {audio_file}")
+        return True
+    
+    def enqueue(self, audio_file: str) -> bool:
+        """加入等待队列，当前曲目结束时衔接播放"""
+        if not self.running:
+            return False
+        source = self._open(audio_file)
+        if source is None:
+            return False
+        
+        with self._lock:
+            self._queue.append((audio_file, source))
+        logger.info(f"音频引擎队列加入: {audio_file}")
+        return True
+    
+    def skip(self) -> bool:
+        """跳到队列中的下一首（队列为空时淡出当前曲目）"""
+        with self._lock:
+            if self._current is None:
+                return False
+            fade_frames = min(self._crossfade_frames(), self._current.remaining)
+            self._current.fade_to(0.0, fade_frames)
+            self._current = None
+            if self._queue:
+                audio_file, source = self._queue.popleft()
+                self._start_voice(audio_file, source, fade_frames)
+        return True
+    
+    def stop(self, fade: float = 0.05):
+        """淡出所有曲目并清空队列（引擎继续运行）"""
+        with self._lock:
+            self._clear_queue()
+            for voice in self._voices:
+                voice.fade_to(0.0, int(fade * (self.sample_rate or 0)))
+            self._current = None
+    
+    def set_volume(self, volume: float):
+        """设置主音量 (0.0 - 1.0)，在下一个输出块内平滑过渡"""
+        self.volume = min(1.0, max(0.0, volume))
+    
+    def set_crossfade(self, crossfade: float):
+        """设置交叉淡化时长（秒），0为无缝衔接"""
+        self.crossfade = max(0.0, crossfade)
+    
+    def _clear_queue(self):
+        """清空等待队列并关闭其中的文件（调用方需持有锁）"""
+        while self._queue:
+            _, source = self._queue.popleft()
+            source.close()
+    
+    def _start_voice(self, audio_file: str, source: MappedWav, fade_frames: int, delay: int = 0):
+        """开始播放一首曲目（调用方需持有锁）"""
+        voice = _Voice(audio_file, source, self.sample_rate, gain=0.0 if fade_frames else 1.0, delay=delay)
+        if fade_frames:
+            voice.fade_to(1.0, fade_frames)
+        if self._voices:
+            self._stats['transitions'] += 1
+        self._voices.append(voice)
+        self._current = voice
+        self._stats['tracks_started'] += 1
+    
+    def _advance(self, frames: int):
+        """当前曲目即将结束时开始队列中的下一首（调用方需持有锁）"""
+        if not self._queue:
+            return
+        
+        current = self._current
+        fade_frames = self._crossfade_frames()
+        if current is not None and current.remaining > max(fade_frames, frames):
+            return
+        
+        audio_file, source = self._queue.popleft()
+        if current is None:
+            self._start_voice(audio_file, source, 0)
+        elif fade_frames:
+            fade_frames = min(fade_frames, current.remaining)
+            current.fade_to(0.0, fade_frames)
+            self._start_voice(audio_file, source, fade_frames)
+        else:
+            # 无交叉淡化：下一首从当前曲目最后一帧之后开始，中间没有静音
+            self._start_voice(audio_file, source, 0, delay=current.remaining)
+    
+    def _render(self, frames: int):
+        """混合一个输出块，返回16bit PCM数据"""
+        block = np.zeros((frames, ENGINE_CHANNELS), dtype=np.float32)
+        with self._lock:
+            self._advance(frames)
+            for voice in self._voices:
+                voice.render(block, frames)
             
-    except Exception as e:
-        logger.error(f"omxplayer播放异常: {e}")
-        return False
+            active = []
+            for voice in self._voices:
+                if voice.finished:
+                    voice.close()
+                else:
+                    active.append(voice)
+            self._voices = active
+            if self._current is not None and self._current not in self._voices:
+                self._current = None
+        
+        # 音量变化在一个块内线性过渡，避免爆音
+        if self.volume != self._output_volume:
+            block *= np.linspace(self._output_volume, self.volume, frames, dtype=np.float32)[:, None]
+            self._output_volume = self.volume
+        else:
+            block *= self.volume
+        return (np.clip(block, -1.0, 1.0) * 32767).astype('<i2').tobytes()
+    
+    def _mix_loop(self):
+        """混音线程：持续向输出进程写入数据，写满aplay缓冲区时阻塞，以此控制节奏"""
+        while self.running:
+            if not self._output_ready.wait(timeout=0.5):
+                continue
+            
+            pcm = self._render(ENGINE_BLOCK_FRAMES)
+            try:
+                self.process.stdin.write(pcm)
+            except (BrokenPipeError, OSError, ValueError) as e:
+                if not self.running:
+                    break
+                if not self._restart_output(e) and self.running:
+                    self._stop_after_output_failure()
+    
+    def _restart_output(self, error) -> bool:
+        """输出进程退出后按指数退避重新启动，连续失败过多时返回False"""
+        if time.time() - self._output_started_at >= ENGINE_RESTART_RESET:
+            self._consecutive_restarts = 0
+        if self._consecutive_restarts >= ENGINE_MAX_RESTARTS:
+            logger.error(f"音频引擎输出连续{ENGINE_MAX_RESTARTS}次启动后立即退出，引擎停止")
+            return False
+        
+        delay = ENGINE_RESTART_BACKOFF * 2 ** self._consecutive_restarts
+        self._consecutive_restarts += 1
+        with self._lock:
+            self._stats['output_restarts'] += 1
+        logger.error(f"音频引擎输出中断: {error}，{delay:.1f}秒后重新启动输出")
+        time.sleep(delay)
+        return self.running and self._open_output()
+    
+    def _stop_after_output_failure(self):
+        """输出无法恢复：停止引擎并关闭曲目文件，调用方改用独立播放进程"""
+        logger.error("音频引擎输出无法恢复，改用独立播放进程")
+        self.running = False
+        with self._lock:
+            self._clear_queue()
+            for voice in self._voices:
+                voice.close()
+            self._voices = []
+            self._current = None
+    
+    def status(self) -> dict:
+        """获取引擎状态：当前曲目与播放进度、队列、音量和切换统计"""
+        with self._lock:
+            current = self._current
+            return {
+                'running': self.running,
+                'sample_rate': self.sample_rate,
+                'current': current.audio_file if current else None,
+                'position': round(current.position / self.sample_rate, 2) if current else None,
+                'duration': round(current.length / self.sample_rate, 2) if current else None,
+                'queued': [audio_file for audio_file, _ in self._queue],
+                'voices': len(self._voices),
+                'volume': self.volume,
+                'crossfade': self.crossfade,
+                **self._stats
+            }
+    
+    def shutdown(self):
+        """停止混音线程、关闭输出进程和所有曲目文件"""
+        self.running = False
+        self._output_ready.set()
+        if self._thread is not None:
+            self._thread.join(timeout=2)
+        if self.process is not None:
+            try:
+                self.process.stdin.close()
+            except (BrokenPipeError, OSError):
+                pass
+            self.process.terminate()
+        with self._lock:
+            self._clear_queue()
+            for voice in self._voices:
+                voice.close()
+            self._voices = []
+            self._current = None
+
+# 全局音频引擎实例
+_audio_engine = None
+_audio_engine_lock = threading.Lock()
+
+def get_audio_engine(**config) -> AudioEngine:
+    """获取并启动音频引擎（单例模式，进程内共用一个输出流）"""
+    global _audio_engine
+    with _audio_engine_lock:
+        if _audio_engine is None:
+            _audio_engine = AudioEngine(**config)
+        if not _audio_engine.running:
+            _audio_engine.start()
+        return _audio_engine
 
 def detect_audio_devices():
     """检测可用的音频输出设备"""
@@ -141,33 +881,47 @@ def play(audio_file: str, volume: float = 0.7):
         logger.error(f"音频文件不存在: {audio_file}")
         return False
     
+    global _cached_backend
+    requested_at = time.time()
     logger.info(f"开始播放音频: {audio_file}")
     
-    # 检测音频设备
-    detect_audio_devices()
-    
-    # 尝试多种播放方式
-    
-    # 方式1: 使用aplay（最稳定）
-    logger.info("尝试使用aplay播放...")
-    if play_with_aplay(audio_file):
-        return True
-    
-    # 方式2: 使用aplay指定设备
-    logger.info("尝试使用aplay指定设备播放...")
-    if play_with_aplay(audio_file, 'hw:0,0'):
-        return True
+    with _backend_lock:
+        cached = _cached_backend
     
-    # 方式3: 使用omxplayer
-    logger.info("尝试使用omxplayer播放...")
-    if play_with_omxplayer(audio_file):
-        return True
+    if cached:
+        candidates = [cached] + [name for name in PLAYBACK_BACKENDS if name != cached]
+    else:
+        # 首次播放（或缓存失效）时检测音频设备并依次尝试各种播放方式
+        detect_audio_devices()
+        candidates = list(PLAYBACK_BACKENDS)
+        with _backend_lock:
+            _playback_stats['probes'] += 1
     
-    # 方式4: 使用pygame（最后备选）
-    logger.info("尝试使用pygame播放...")
-    if play_with_pygame(audio_file, volume):
-        return True
+    for name in candidates:
+        started = {}
+        logger.info(f"尝试使用{name}播放...")
+        if PLAYBACK_BACKENDS[name](audio_file, volume, lambda: started.setdefault('at', time.time())):
+            start_latency = started.get('at', requested_at) - requested_at
+            with _backend_lock:
+                if _cached_backend != name:
+                    logger.info(f"🔊 播放方式已缓存: {name}")
+                _cached_backend = name
+                _playback_stats['plays'] += 1
+                _playback_stats['start_latency'] += start_latency
+                _playback_stats['last_start_latency'] = round(start_latency, 4)
+            return True
+        
+        if name == cached:
+            # 缓存的播放方式失败，清除缓存并尝试其他方式
+            logger.warning(f"缓存的播放方式{name}失败，重新探测")
+            with _backend_lock:
+                if _cached_backend == name:
+                    _cached_backend = None
+                _playback_stats['invalidations'] += 1
+                _playback_stats['probes'] += 1
     
+    with _backend_lock:
+        _playback_stats['failures'] += 1
     logger.error("所有播放方式都失败了")
     return False
 
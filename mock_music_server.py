@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+LETDANCE 本地音乐生成服务替身
+实现与音乐生成服务相同的接口（/health、POST /generate_music），用正弦波合成代替模型生成，
+用于在没有GPU服务的情况下调试客户端：
+- 按请求体的format字段或Accept头协商返回格式（wav/flac/opus，压缩格式需要ffmpeg）
+- 单个提示词返回音频本身，多个提示词返回zip压缩包
+- 可配置生成延迟、音频大小和失败率，配合music_load_test.py在本机压测客户端
+
+用法:
+    python mock_music_server.py --port 5000
+    python mock_music_server.py --formats wav      # 只返回WAV，测试未压缩路径
+    python mock_music_server.py --latency 3 --jitter 1 --failure-rate 0.1 --payload-kb 2048
+"""
+
+import io
+import json
+import math
+import time
+import wave
+import array
+import shutil
+import random
+import zipfile
+import hashlib
+import threading
+import functools
+import logging
+import argparse
+import subprocess
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Optional
+
+# 配置日志
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+SAMPLE_RATE = 44100
+CHANNELS = 2
+
+# 格式 -> (Content-Type, 压缩包内的扩展名, ffmpeg编码参数)
+FORMATS = {
+    'wav': ('audio/wav', 'wav', None),
+    'flac': ('audio/flac', 'flac', ['-c:a', 'flac', '-f', 'flac']),
+    'opus': ('audio/ogg', 'opus', ['-c:a', 'libopus', '-b:a', '96k', '-f', 'ogg'])
+}
+FORMAT_MIME_TYPES = {
+    'audio/wav': 'wav', 'audio/x-wav': 'wav', 'audio/wave': 'wav',
+    'audio/flac': 'flac', 'audio/x-flac': 'flac',
+    'audio/ogg': 'opus', 'audio/opus': 'opus'
+}
+FFMPEG_AVAILABLE = shutil.which('ffmpeg') is not None
+
+# 默认配置：无延迟、10秒音乐、不注入故障
+DEFAULT_CONFIG = {
+    'duration': 10.0,
+    'formats': ['wav', 'flac', 'opus'],
+    'latency': 0.0,             # 每个请求的基础生成延迟（秒）
+    'latency_per_track': 0.0,   # 批量请求中每多一首增加的延迟（秒）
+    'jitter': 0.0,              # 延迟的随机波动幅度（秒，均匀分布）
+    'stall_rate': 0.0,          # 请求额外卡顿的概率（模拟长尾延迟）
+    'stall_time': 0.0,          # 卡顿时额外增加的延迟（秒）
+    'failure_rate': 0.0,        # 返回503的概率
+    'drop_rate': 0.0,           # 发送一半响应体后断开连接的概率
+    'health_failure_rate': 0.0  # 健康检查返回503的概率
+}
+
+def payload_duration(payload_kb: float) -> float:
+    """WAV大小（KB）-> 对应的音乐时长（秒）"""
+    return payload_kb * 1024 / (SAMPLE_RATE * CHANNELS * 2)
+
+def synthesize_wav(prompt: str, duration: float) -> bytes:
+    """按提示词合成一段和弦（不同提示词音高不同），返回16bit立体声WAV"""
+    seed = int(hashlib.md5(prompt.encode('utf-8')).hexdigest()[:8], 16)
+    return render_chord(seed % 12, duration)
+
+@functools.lru_cache(maxsize=48)
+def render_chord(note: int, duration: float) -> bytes:
+    """合成以第note个半音为根音的大三和弦（同一音高和时长只合成一次）"""
+    root = 220.0 * 2 ** (note / 12)
+    frequencies = [root, root * 5 / 4, root * 3 / 2]
+
+    frames = int(SAMPLE_RATE * duration)
+    samples = array.array('h')
+    for n in range(frames):
+        t = n / SAMPLE_RATE
+        # 首尾淡入淡出，避免爆音
+        envelope = min(1.0, t / 0.05, (duration - t) / 0.05)
+        value = int(8000 * envelope * sum(math.sin(2 * math.pi * f * t) for f in frequencies) / len(frequencies))
+        samples.extend((value, value))
+
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as wav:
+        wav.setnchannels(CHANNELS)
+        wav.setsampwidth(2)
+        wav.setframerate(SAMPLE_RATE)
+        wav.writeframes(samples.tobytes())
+    return buffer.getvalue()
+
+@functools.lru_cache(maxsize=48)
+def encode_audio(wav_bytes: bytes, audio_format: str) -> bytes:
+    """用ffmpeg把WAV编码为压缩格式"""
+    encode_args = FORMATS[audio_format][2]
+    if encode_args is None:
+        return wav_bytes
+
+    result = subprocess.run(
+        ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-f', 'wav', '-i', 'pipe:0'] + encode_args + ['pipe:1'],
+        input=wav_bytes, capture_output=True, check=True
+    )
+    return result.stdout
+
+def parse_accept(accept: str) -> List[str]:
+    """解析Accept头，按q值从高到低返回可识别的格式"""
+    candidates = []
+    for index, part in enumerate(accept.split(',')):
+        fields = [field.strip() for field in part.split(';')]
+        audio_format = FORMAT_MIME_TYPES.get(fields[0].lower())
+        if audio_format is None:
+            continue
+        quality = 1.0
+        for field in fields[1:]:
+            if field.startswith('q='):
+                try:
+                    quality = float(field[2:])
+                except ValueError:
+                    quality = 0.0
+        candidates.append((-quality, index, audio_format))
+    return [audio_format for _, _, audio_format in sorted(candidates)]
+
+def choose_format(requested: Optional[str], accept: str, supported: List[str]) -> str:
+    """请求体的format字段优先，其次是Accept头，都不支持时返回WAV"""
+    preferences = ([requested] if requested else []) + parse_accept(accept)
+    for audio_format in preferences:
+        if audio_format in supported:
+            return audio_format
+    return 'wav'
+
+class MockMusicHandler(BaseHTTPRequestHandler):
+    """音乐生成接口的替身实现"""
+
+    # 保持长连接，客户端连接池的效果才能体现出来
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if self.path == '/health':
+            if random.random() < self.server.config['health_failure_rate']:
+                self._send(503, 'application/json', b'{"status": "unavailable"}')
+                return
+            self._send(200, 'application/json', json.dumps({'status': 'ok', 'mock': True}).encode('utf-8'))
+        elif self.path == '/stats':
+            self._send(200, 'application/json', json.dumps(self.server.get_stats()).encode('utf-8'))
+        else:
+            self._send(404, 'application/json', b'{"error": "not found"}')
+
+    def do_POST(self):
+        if self.path != '/generate_music':
+            self._send(404, 'application/json', b'{"error": "not found"}')
+            return
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            payload = json.loads(self.rfile.read(length) or b'{}')
+            prompts = payload.get('prompts') or []
+        except (ValueError, json.JSONDecodeError):
+            self._send(400, 'application/json', b'{"error": "invalid json"}')
+            return
+        if not prompts:
+            self._send(400, 'application/json', b'{"error": "prompts required"}')
+            return
+
+        config = self.server.config
+        audio_format = choose_format(payload.get('format'), self.headers.get('Accept', ''), config['formats'])
+        content_type, extension, _ = FORMATS[audio_format]
+
+        start = time.time()
+        self.server.count('requests')
+        # 模拟生成耗时
+        delay = config['latency'] + config['latency_per_track'] * (len(prompts) - 1)
+        delay += random.uniform(-config['jitter'], config['jitter'])
+        if random.random() < config['stall_rate']:
+            delay += config['stall_time']
+        if delay > 0:
+            time.sleep(delay)
+
+        if random.random() < config['failure_rate']:
+            self.server.count('failures')
+            logger.info(f"💥 注入失败（503）: {prompts}")
+            self._send(503, 'application/json', b'{"error": "injected failure"}')
+            return
+
+        try:
+            tracks = [encode_audio(synthesize_wav(prompt, config['duration']), audio_format) for prompt in prompts]
+        except subprocess.CalledProcessError as e:
+            logger.error(f"❌ 编码{audio_format}失败: {e.stderr.decode(errors='ignore')}")
+            self._send(500, 'application/json', b'{"error": "encode failed"}')
+            return
+
+        if len(tracks) == 1:
+            body = tracks[0]
+        else:
+            buffer = io.BytesIO()
+            with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED) as archive:
+                for index, track in enumerate(tracks):
+                    archive.writestr(f"track_{index:02d}.{extension}", track)
+            body = buffer.getvalue()
+            content_type = 'application/zip'
+
+        if random.random() < config['drop_rate']:
+            self.server.count('drops')
+            logger.info(f"💥 注入断连: {prompts}")
+            self._send(200, content_type, body, drop=True)
+            return
+
+        self.server.count('tracks', len(prompts))
+        self.server.count('bytes_sent', len(body))
+        logger.info(f"🎵 生成{len(prompts)}首（{audio_format}，{len(body) / 1024:.0f}KB），"
+                    f"用时{time.time() - start:.2f}秒: {prompts}")
+        self._send(200, content_type, body)
+
+    def _send(self, status: int, content_type: str, body: bytes, drop: bool = False):
+        """
+        分块写出响应体，让客户端的流式下载/播放路径也能被测试到
+
+        Args:
+            drop: 只发送一半响应体就断开连接（模拟传输中断）
+        """
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        end = len(body) // 2 if drop else len(body)
+        try:
+            for offset in range(0, end, 32 * 1024):
+                self.wfile.write(body[offset:min(offset + 32 * 1024, end)])
+        except (BrokenPipeError, ConnectionResetError):
+            # 客户端提前断开（例如请求被取消）
+            pass
+        if drop:
+            self.close_connection = True
+
+    def log_message(self, format, *args):
+        # 请求日志由do_POST输出
+        pass
+
+class MockMusicServer(ThreadingHTTPServer):
+    """带配置与请求统计的服务替身"""
+
+    daemon_threads = True
+
+    def __init__(self, address, **config):
+        super().__init__(address, MockMusicHandler)
+        self.config = {**DEFAULT_CONFIG, **config}
+        if not FFMPEG_AVAILABLE and any(fmt != 'wav' for fmt in self.config['formats']):
+            logger.warning("⚠️ 未找到ffmpeg，只返回WAV")
+            self.config['formats'] = ['wav']
+        self._lock = threading.Lock()
+        self._stats = {'requests': 0, 'tracks': 0, 'failures': 0, 'drops': 0, 'bytes_sent': 0}
+
+    def count(self, key: str, amount: int = 1) -> None:
+        with self._lock:
+            self._stats[key] += amount
+
+    def get_stats(self) -> dict:
+        """获取请求数、生成曲目数、注入故障数与发送字节数"""
+        with self._lock:
+            return dict(self._stats)
+
+def start_server(host: str = '127.0.0.1', port: int = 0, **config) -> MockMusicServer:
+    """
+    预先合成音频后在后台线程启动服务替身（压测脚本使用）
+
+    Args:
+        port: 监听端口，为0时自动选择空闲端口（通过server.server_address获取）
+        **config: 覆盖DEFAULT_CONFIG中的配置
+
+    Returns:
+        服务实例，用完后调用shutdown()
+    """
+    server = MockMusicServer((host, port), **config)
+    # 预先合成所有音高，首次请求不会因为合成而变慢
+    for note in range(12):
+        render_chord(note, server.config['duration'])
+    threading.Thread(target=server.serve_forever, name='mock-music-server', daemon=True).start()
+    return server
+
+def main():
+    """启动本地音乐生成服务替身"""
+    parser = argparse.ArgumentParser(description='LETDANCE 本地音乐生成服务替身')
+    parser.add_argument('--host', default='127.0.0.1', help='监听地址')
+    parser.add_argument('--port', type=int, default=5000, help='监听端口')
+    parser.add_argument('--duration', type=float, default=DEFAULT_CONFIG['duration'], help='每首音乐的时长（秒）')
+    parser.add_argument('--payload-kb', type=float, help='每首WAV的大小（KB），设置后忽略--duration')
+    parser.add_argument('--formats', default='wav,flac,opus', help='支持返回的格式，逗号分隔')
+    parser.add_argument('--latency', type=float, default=0.0, help='每个请求的基础生成延迟（秒）')
+    parser.add_argument('--latency-per-track', type=float, default=0.0, help='批量请求中每多一首增加的延迟（秒）')
+    parser.add_argument('--jitter', type=float, default=0.0, help='延迟的随机波动幅度（秒）')
+    parser.add_argument('--stall-rate', type=float, default=0.0, help='请求额外卡顿的概率（长尾延迟）')
+    parser.add_argument('--stall-time', type=float, default=0.0, help='卡顿时额外增加的延迟（秒）')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='返回503的概率')
+    parser.add_argument('--drop-rate', type=float, default=0.0, help='响应体发送一半后断开的概率')
+    parser.add_argument('--health-failure-rate', type=float, default=0.0, help='健康检查返回503的概率')
+    args = parser.parse_args()
+
+    formats = [fmt.strip() for fmt in args.formats.split(',') if fmt.strip() in FORMATS]
+    server = MockMusicServer(
+        (args.host, args.port),
+        duration=payload_duration(args.payload_kb) if args.payload_kb else args.duration,
+        formats=formats or ['wav'],
+        latency=args.latency,
+        latency_per_track=args.latency_per_track,
+        jitter=args.jitter,
+        stall_rate=args.stall_rate,
+        stall_time=args.stall_time,
+        failure_rate=args.failure_rate,
+        drop_rate=args.drop_rate,
+        health_failure_rate=args.health_failure_rate
+    )
+    logger.info(f"🚀 音乐生成服务替身已启动: http://{args.host}:{args.port}（配置: {server.config}）")
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("⏹️ 服务已停止")
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+LETDANCE 音乐缓存
+按归一化后的关键词集合（小写、去重、排序）缓存生成的音乐，命中时无需重新生成；
+音频文件按内容哈希存放（相同内容只存一份），元数据索引持久化为JSON，
+超出磁盘预算时按LRU淘汰
+"""
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Dict, Any, List, Optional
+
+# 配置日志
+logger = logging.getLogger(__name__)
+
+# 默认缓存目录与磁盘预算，可通过环境变量覆盖
+DEFAULT_CACHE_DIR = os.getenv('LETDANCE_MUSIC_CACHE', 'cache/music')
+DEFAULT_MAX_BYTES = int(os.getenv('LETDANCE_MUSIC_CACHE_MB', '512')) * 1024 * 1024
+
+def normalize_keywords(keywords: List[str]) -> str:
+    """关键词集合 -> 缓存键（顺序不同、大小写不同或重复的关键词视为同一集合）"""
+    return ','.join(sorted({str(keyword).strip().lower() for keyword in keywords if str(keyword).strip()}))
+
+class MusicCache:
+    """关键词集合 -> 音乐文件 的内容寻址缓存（LRU + 磁盘预算，线程安全）"""
+
+    def __init__(self, cache_dir: str = DEFAULT_CACHE_DIR, max_bytes: int = DEFAULT_MAX_BYTES):
+        """
+        Args:
+            cache_dir: 缓存目录（音频存放在objects/下，索引为index.json）
+            max_bytes: 磁盘预算（字节），超出时淘汰最久未使用的条目
+        """
+        self.cache_dir = cache_dir
+        self.objects_dir = os.path.join(cache_dir, 'objects')
+        self.index_path = os.path.join(cache_dir, 'index.json')
+        self.max_bytes = max_bytes
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0}
+
+        self._load()
+
+    def _object_path(self, digest: str) -> str:
+        return os.path.join(self.objects_dir, digest[:2], f"{digest}.wav")
+
+    def get(self, keywords: List[str]) -> Optional[str]:
+        """查询缓存，命中时返回音乐文件路径并刷新LRU顺序"""
+        key = normalize_keywords(keywords)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or not os.path.exists(self._object_path(entry['sha256'])):
+                if entry is not None:
+                    # 文件被外部删除，清理失效条目
+                    del self._entries[key]
+                    self._save()
+                self._stats['misses'] += 1
+                return None
+
+            self._entries.move_to_end(key)
+            entry['last_used'] = time.time()
+            entry['hits'] += 1
+            self._stats['hits'] += 1
+            self._save()
+            return self._object_path(entry['sha256'])
+
+    def contains(self, keywords: List[str]) -> bool:
+        """是否已缓存（不计入命中统计，不刷新LRU顺序）"""
+        with self._lock:
+            entry = self._entries.get(normalize_keywords(keywords))
+            return entry is not None and os.path.exists(self._object_path(entry['sha256']))
+
+    def put(self, keywords: List[str], music_file: str) -> Optional[str]:
+        """
+        将生成的音乐移入缓存
+
+        Returns:
+            缓存中的文件路径（原文件已移走）；失败时返回None，原文件保持不变
+        """
+        key = normalize_keywords(keywords)
+        if not key or not music_file or not os.path.exists(music_file):
+            return None
+        if os.path.getsize(music_file) > self.max_bytes:
+            logger.warning(f"音乐文件超出缓存磁盘预算，不缓存: {music_file}")
+            return None
+
+        try:
+            digest = self._hash_file(music_file)
+            object_path = self._object_path(digest)
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+
+            with self._lock:
+                if os.path.exists(object_path):
+                    # 相同内容已存在，只保留一份
+                    os.remove(music_file)
+                else:
+                    shutil.move(music_file, object_path)
+
+                previous = self._entries.get(key)
+                now = time.time()
+                self._entries[key] = {
+                    'sha256': digest,
+                    'size': os.path.getsize(object_path),
+                    'keywords': key.split(','),
+                    'created_at': now,
+                    'last_used': now,
+                    'hits': 0
+                }
+                self._entries.move_to_end(key)
+                self._stats['stores'] += 1
+
+                if previous is not None and previous['sha256'] != digest:
+                    self._remove_unreferenced(previous['sha256'])
+                self._evict()
+                self._save()
+
+            logger.info(f"🎼 音乐已缓存 [{key}]: {object_path}")
+            return object_path
+        except Exception as e:
+            logger.warning(f"音乐缓存写入失败: {e}")
+            return None
+
+    def _hash_file(self, path: str) -> str:
+        """分块计算文件SHA-256"""
+        sha256 = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                sha256.update(block)
+        return sha256.hexdigest()
+
+    def _total_bytes(self) -> int:
+        """缓存占用的磁盘空间（相同内容只计一次）"""
+        return sum({entry['sha256']: entry['size'] for entry in self._entries.values()}.values())
+
+    def _evict(self) -> None:
+        """超出磁盘预算时淘汰最久未使用的条目，并删除不再被引用的音频文件（调用方需持有锁）"""
+        while self._entries and self._total_bytes() > self.max_bytes:
+            key, entry = self._entries.popitem(last=False)
+            self._stats['evictions'] += 1
+            self._remove_unreferenced(entry['sha256'])
+            logger.info(f"🧹 音乐缓存淘汰 [{key}]")
+
+    def _remove_unreferenced(self, digest: str) -> None:
+        """没有条目再引用该音频时删除文件（调用方需持有锁）"""
+        if any(entry['sha256'] == digest for entry in self._entries.values()):
+            return
+        try:
+            os.remove(self._object_path(digest))
+        except OSError:
+            pass
+
+    def clear(self) -> None:
+        """清空缓存并删除所有音频文件"""
+        with self._lock:
+            self._entries.clear()
+            shutil.rmtree(self.objects_dir, ignore_errors=True)
+            self._save()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取命中率与磁盘占用"""
+        with self._lock:
+            lookups = self._stats['hits'] + self._stats['misses']
+            return {
+                **self._stats,
+                'entries': len(self._entries),
+                'hit_rate': round(self._stats['hits'] / lookups, 3) if lookups else None,
+                'total_mb': round(self._total_bytes() / 1024 / 1024, 1),
+                'max_mb': round(self.max_bytes / 1024 / 1024, 1)
+            }
+
+    def _load(self) -> None:
+        """加载索引，跳过音频文件已不存在的条目"""
+        if not os.path.exists(self.index_path):
+            return
+
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                stored = json.load(f)
+
+            # 文件中按LRU顺序保存（最久未使用的在前）
+            for key, entry in stored.get('entries', []):
+                if os.path.exists(self._object_path(entry['sha256'])):
+                    self._entries[key] = entry
+
+            self._evict()
+            logger.info(f"音乐缓存加载成功: {len(self._entries)}条")
+        except Exception as e:
+            logger.warning(f"音乐缓存索引加载失败，将重新建立: {e}")
+            self._entries.clear()
+
+    def _save(self) -> None:
+        """原子写入索引文件（调用方需持有锁）"""
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            temp_path = f"{self.index_path}.tmp"
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump({'entries': list(self._entries.items())}, f, ensure_ascii=False)
+            os.replace(temp_path, self.index_path)
+        except Exception as e:
+            logger.warning(f"音乐缓存索引保存失败: {e}")
+
+# 全局缓存实例
+_music_cache = None
+
+def get_music_cache(**config) -> MusicCache:
+    """获取音乐缓存实例（单例模式，同一进程内的工作流共用）"""
+    global _music_cache
+    if _music_cache is None:
+        _music_cache = MusicCache(**config)
+    return _music_cache
@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+LETDANCE 音乐生成客户端压测
+以指定并发驱动MusicGenClient，统计吞吐量与延迟分位数（完整下载延迟、可开始播放的延迟），
+用于在本机调整连接池、超时和流式下载参数
+
+用法:
+    # 内置服务替身（mock_music_server.py），模拟3±1秒生成延迟和5%失败
+    python music_load_test.py --requests 40 --concurrency 4 --latency 3 --jitter 1 --failure-rate 0.05
+    # 3台服务替身，其中一台慢5秒，观察路由与对冲的效果
+    python music_load_test.py --backends 3 --slow-latency 5 --requests 60 --concurrency 4
+    # 压测真实服务（多台用逗号分隔）
+    python music_load_test.py --server http://192.168.19.126:5000 --requests 10 --concurrency 2
+"""
+
+import os
+import json
+import math
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Optional
+
+from client import MusicGenClient, TransferStats, AUDIO_FORMATS, create_music_client
+import mock_music_server
+
+class PlaybackProbe:
+    """代替StreamingPlayer接收流式数据，只记录可以开始播放的时刻（不实际播放）"""
+
+    def __init__(self):
+        self.started_at = None
+        self.bytes_received = 0
+
+    @property
+    def started(self) -> bool:
+        return self.started_at is not None
+
+    def start(self, source_path: str) -> bool:
+        self.started_at = time.time()
+        return True
+
+    def advance(self, available: int) -> bool:
+        self.bytes_received = available
+        return True
+
+    def end(self):
+        pass
+
+    def abort(self):
+        pass
+
+def percentile(values: List[float], p: float) -> Optional[float]:
+    """最近秩法计算分位数"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, math.ceil(p / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+def summarize_latencies(values: List[float]) -> Dict[str, Any]:
+    """延迟分布：平均值与p50/p90/p95/p99/最大值（秒）"""
+    if not values:
+        return {'count': 0}
+    return {
+        'count': len(values),
+        'mean': round(sum(values) / len(values), 3),
+        'p50': round(percentile(values, 50), 3),
+        'p90': round(percentile(values, 90), 3),
+        'p95': round(percentile(values, 95), 3),
+        'p99': round(percentile(values, 99), 3),
+        'max': round(max(values), 3)
+    }
+
+def run_request(client: MusicGenClient, index: int, output_dir: str, stream: bool) -> Dict[str, Any]:
+    """发送一个生成请求，返回耗时与结果"""
+    probe = PlaybackProbe() if stream else None
+    start = time.time()
+    music_file = client.generate_music(f"load test {index}", output_dir=output_dir, player=probe)
+    finished = time.time()
+
+    return {
+        'index': index,
+        'success': music_file is not None,
+        'latency': finished - start,
+        'playback_latency': probe.started_at - start if probe and probe.started else None,
+        'bytes': os.path.getsize(music_file) if music_file else 0
+    }
+
+def run_batches(client: MusicGenClient, total: int, batch_size: int, concurrency: int,
+                output_dir: str) -> List[Dict[str, Any]]:
+    """批量模式：每个请求携带batch_size个提示词，按批并发"""
+    prompt_batches = [
+        [f"load test {index}" for index in range(start, min(start + batch_size, total))]
+        for start in range(0, total, batch_size)
+    ]
+
+    def run_batch(prompts):
+        return client.generate_many(prompts, output_dir=output_dir, batch_size=batch_size)
+
+    results = []
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for batch_results in executor.map(run_batch, prompt_batches):
+            for result in batch_results:
+                results.append({
+                    'index': len(results),
+                    'success': result['success'],
+                    # 整批一起返回，每首的延迟即整批耗时
+                    'latency': result['batch_time'],
+                    'playback_latency': None,
+                    'bytes': os.path.getsize(result['music_file']) if result['success'] else 0
+                })
+    return results
+
+def run_load_test(client: MusicGenClient, total: int, concurrency: int, stream: bool = True,
+                  batch_size: int = 1, output_dir: str = None) -> Dict[str, Any]:
+    """
+    以固定并发发送total个生成请求
+
+    Args:
+        client: 被测客户端
+        total: 曲目总数
+        concurrency: 同时在途的请求数
+        stream: 是否经过流式播放路径（记录可开始播放的延迟）
+        batch_size: 大于1时使用generate_many批量生成
+        output_dir: 音乐输出目录
+
+    Returns:
+        吞吐量、成功率与延迟分布
+    """
+    start = time.time()
+    if batch_size > 1:
+        results = run_batches(client, total, batch_size, concurrency, output_dir)
+    else:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = [executor.submit(run_request, client, index, output_dir, stream) for index in range(total)]
+            results = [future.result() for future in futures]
+    wall_time = time.time() - start
+
+    succeeded = [result for result in results if result['success']]
+    return {
+        'requests': total,
+        'concurrency': concurrency,
+        'batch_size': batch_size,
+        'wall_time': round(wall_time, 3),
+        'success_rate': round(len(succeeded) / total, 3) if total else None,
+        'throughput': round(len(succeeded) / wall_time, 3) if wall_time > 0 else None,
+        'mb_per_second': round(sum(result['bytes'] for result in succeeded) / 1024 / 1024 / wall_time, 3)
+        if wall_time > 0 else None,
+        'latency': summarize_latencies([result['latency'] for result in succeeded]),
+        'playback_latency': summarize_latencies(
+            [result['playback_latency'] for result in succeeded if result['playback_latency'] is not None]
+        ),
+        'transfer': client.get_transfer_stats(),
+        # 多台服务时的路由与对冲统计
+        'routing': client.get_stats() if hasattr(client, 'backends') else None
+    }
+
+def print_report(report: Dict[str, Any]) -> None:
+    """打印压测结果"""
+    print("\n📊 压测结果")
+    print(f"请求数: {report['requests']}  并发: {report['concurrency']}  每批: {report['batch_size']}")
+    print(f"总耗时: {report['wall_time']}秒  成功率: {report['success_rate']}")
+    print(f"吞吐量: {report['throughput']}首/秒  {report['mb_per_second']}MB/秒")
+    for name, label in (('latency', '完整下载延迟'), ('playback_latency', '可开始播放延迟')):
+        stats = report[name]
+        if stats['count']:
+            print(f"{label}(秒): 平均{stats['mean']}  p50 {stats['p50']}  p90 {stats['p90']}  "
+                  f"p95 {stats['p95']}  p99 {stats['p99']}  最大{stats['max']}")
+    print(f"传输: {report['transfer']}")
+    if report['routing']:
+        routing = report['routing']
+        print(f"对冲: {routing['hedged']}次，其中{routing['hedge_wins']}次对冲请求先完成")
+        for backend in routing['backends']:
+            print(f"  {backend['url']}: 请求{backend['requests']}  失败{backend['failures']}  "
+                  f"EWMA {backend['ewma']}  p95 {backend['p95']}")
+    if 'server' in report:
+        print(f"服务替身: {report['server']}")
+
+def reset_transfer_stats(client) -> None:
+    """清空传输统计（预热请求不计入）"""
+    for music_client in [backend.client for backend in getattr(client, 'backends', [])] or [client]:
+        music_client.transfer_stats = TransferStats()
+
+def main():
+    """命令行入口"""
+    parser = argparse.ArgumentParser(description='LETDANCE 音乐生成客户端压测')
+    parser.add_argument('--server', help='音乐生成服务地址（多台用逗号分隔）；不指定时在本进程启动服务替身')
+    parser.add_argument('--requests', type=int, default=20, help='生成曲目总数')
+    parser.add_argument('--concurrency', type=int, default=4, help='并发请求数')
+    parser.add_argument('--warmup', type=int, default=1, help='正式计时前的预热请求数')
+    parser.add_argument('--batch-size', type=int, default=1, help='每个请求携带的提示词数（>1时使用批量生成）')
+    parser.add_argument('--no-stream', action='store_true', help='不经过流式播放路径')
+    parser.add_argument('--format', default='wav', choices=list(AUDIO_FORMATS), help='请求的传输格式')
+    parser.add_argument('--pool-maxsize', type=int, help='客户端连接池大小（默认等于并发数）')
+    parser.add_argument('--max-retries', type=int, default=2, help='客户端连接重试次数')
+    parser.add_argument('--connect-timeout', type=float, default=5, help='建立连接超时（秒）')
+    parser.add_argument('--read-timeout', type=float, default=120, help='等待生成结果超时（秒）')
+    parser.add_argument('--no-hedge', action='store_true', help='多台服务时不发送对冲请求')
+    parser.add_argument('--hedge-min-samples', type=int, default=10, help='按p95对冲前每台服务需要的延迟样本数')
+    parser.add_argument('--keep-files', action='store_true', help='保留生成的音乐文件')
+    parser.add_argument('--json', help='把结果写入JSON文件')
+
+    mock = parser.add_argument_group('服务替身配置（未指定--server时生效）')
+    mock.add_argument('--latency', type=float, default=0.5, help='基础生成延迟（秒）')
+    mock.add_argument('--latency-per-track', type=float, default=0.0, help='批量请求中每多一首增加的延迟（秒）')
+    mock.add_argument('--jitter', type=float, default=0.2, help='延迟波动幅度（秒）')
+    mock.add_argument('--stall-rate', type=float, default=0.0, help='请求额外卡顿的概率（长尾延迟）')
+    mock.add_argument('--stall-time', type=float, default=0.0, help='卡顿时额外增加的延迟（秒）')
+    mock.add_argument('--failure-rate', type=float, default=0.0, help='返回503的概率')
+    mock.add_argument('--drop-rate', type=float, default=0.0, help='响应体发送一半后断开的概率')
+    mock.add_argument('--payload-kb', type=float, default=1024, help='每首WAV的大小（KB）')
+    mock.add_argument('--backends', type=int, default=1, help='启动的服务替身数量')
+    mock.add_argument('--slow-latency', type=float, help='第一台服务替身的基础延迟（模拟一台慢的GPU主机）')
+    args = parser.parse_args()
+
+    servers = []
+    if args.server:
+        server_urls = [url.strip() for url in args.server.split(',') if url.strip()]
+    else:
+        # 服务替身的逐请求日志会淹没压测输出
+        logging.getLogger(mock_music_server.__name__).setLevel(logging.WARNING)
+        for index in range(args.backends):
+            slow = index == 0 and args.slow_latency is not None
+            servers.append(mock_music_server.start_server(
+                duration=mock_music_server.payload_duration(args.payload_kb),
+                latency=args.slow_latency if slow else args.latency,
+                latency_per_track=args.latency_per_track,
+                jitter=args.jitter,
+                stall_rate=args.stall_rate,
+                stall_time=args.stall_time,
+                failure_rate=args.failure_rate,
+                drop_rate=args.drop_rate
+            ))
+        server_urls = [f"http://{host}:{port}" for host, port in (server.server_address[:2] for server in servers)]
+        print(f"🚀 已启动服务替身: {server_urls}")
+
+    pool_options = {} if len(server_urls) == 1 else {
+        'hedge': not args.no_hedge, 'hedge_min_samples': args.hedge_min_samples
+    }
+    client = create_music_client(
+        server_urls,
+        **pool_options,
+        pool_maxsize=args.pool_maxsize or args.concurrency,
+        max_retries=args.max_retries,
+        audio_format=args.format,
+        connect_timeout=args.connect_timeout,
+        read_timeout=args.read_timeout
+    )
+    output_dir = tempfile.mkdtemp(prefix='letdance_load_')
+
+    try:
+        for index in range(args.warmup):
+            run_request(client, -1 - index, output_dir, stream=False)
+        # 预热请求不计入统计
+        reset_transfer_stats(client)
+        warmup_stats = [server.get_stats() for server in servers]
+
+        report = run_load_test(
+            client, args.requests, args.concurrency,
+            stream=not args.no_stream, batch_size=args.batch_size, output_dir=output_dir
+        )
+        if servers:
+            report['server'] = [
+                {key: value - before.get(key, 0) for key, value in server.get_stats().items()}
+                for server, before in zip(servers, warmup_stats)
+            ]
+
+        print_report(report)
+        if args.json:
+            with open(args.json, 'w', encoding='utf-8') as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+            print(f"结果已保存: {args.json}")
+    finally:
+        client.close()
+        for server in servers:
+            server.shutdown()
+            server.server_close()
+        if args.keep_files:
+            print(f"音乐文件保留在: {output_dir}")
+        else:
+            shutil.rmtree(output_dir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
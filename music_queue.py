@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+LETDANCE 音乐生成队列
+音乐生成放到后台工作线程中执行：每个任务有唯一ID和结果future，等待结果有超时；
+为每个情绪主题预先生成几首音乐（主题预取池），预取使用单独的工作线程，
+只在没有排队或进行中的正式任务时开始，不与正式任务争用生成服务；
+新一轮可以直接从池中取出播放，取出后在后台补充
+"""
+
+import os
+import time
+import uuid
+import queue
+import shutil
+import logging
+import threading
+import itertools
+from collections import deque
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from typing import Dict, Any, List, Optional
+
+from tools.music_keywords_tool import MUSIC_KEYWORD_THEMES
+
+# 配置日志
+logger = logging.getLogger(__name__)
+
+# 预取的音乐存放目录（启动时清空，池中的曲目不跨进程保留）
+POOL_OUTPUT_DIR = os.path.join('generated_music', 'pool')
+
+# 任务优先级：数值越小越先执行（正式任务与预取任务分别排队，预取只在空闲时执行）
+PRIORITY_ROUND = 0
+PRIORITY_PREFETCH = 10
+
+# 等待正式任务结果的默认超时（秒）
+DEFAULT_JOB_TIMEOUT = 150.0
+
+def keywords_theme(keywords: List[str]) -> Optional[str]:
+    """关键词所属的主要情绪主题（包含关键词最多的主题，相同时按主题顺序取前者）"""
+    themes = [
+        theme for keyword in keywords for theme, theme_keywords in MUSIC_KEYWORD_THEMES.items()
+        if str(keyword).lower() in theme_keywords
+    ]
+    if not themes:
+        return None
+    return max(MUSIC_KEYWORD_THEMES, key=themes.count)
+
+class MusicJob:
+    """一个音乐生成任务"""
+
+    def __init__(self, keywords: List[str], priority: int = PRIORITY_ROUND, player=None,
+                 theme: Optional[str] = None, prompts: Optional[List[List[str]]] = None):
+        self.job_id = uuid.uuid4().hex
+        self.keywords = list(keywords)
+        self.priority = priority
+        self.player = player
+        # 预取任务：为theme批量生成prompts中的每组关键词
+        self.theme = theme
+        self.prompts = prompts
+        self.future = Future()
+        # 调用方等待超时后放弃的任务，生成结果不再使用
+        self.abandoned = False
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+    @property
+    def is_prefetch(self) -> bool:
+        return self.prompts is not None
+
+class MusicGenerationQueue:
+    """音乐生成任务队列 + 主题预取池（线程安全）"""
+
+    def __init__(self, client, music_cache=None, workers: int = 1, pool_size: int = 2,
+                 pool_dir: str = POOL_OUTPUT_DIR, job_timeout: float = DEFAULT_JOB_TIMEOUT):
+        """
+        Args:
+            client: 音乐生成客户端（MusicGenClient）
+            music_cache: 可选的音乐缓存，正式任务先查缓存，生成结果写入缓存
+            workers: 正式任务的工作线程数（音乐生成服务通常一次只处理一个请求）
+            pool_size: 每个情绪主题预先准备的曲目数，为0时不预取
+            pool_dir: 预取曲目存放目录
+            job_timeout: wait()等待正式任务结果的默认超时（秒）
+        """
+        self.client = client
+        self.music_cache = music_cache
+        self.pool_size = pool_size
+        self.pool_dir = pool_dir
+        self.job_timeout = job_timeout
+
+        # 预取任务单独排队、单独执行，等到没有排队或进行中的正式任务时才开始（服务通常一次只处理一个请求）
+        self._queue = queue.PriorityQueue()
+        self._prefetch_queue = queue.PriorityQueue()
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._round_jobs = 0
+        self._pool = {theme: deque() for theme in MUSIC_KEYWORD_THEMES}
+        self._refilling = {theme: 0 for theme in MUSIC_KEYWORD_THEMES}
+        self._rotation = {theme: 0 for theme in MUSIC_KEYWORD_THEMES}
+        # 上一次取出、仍留在预取目录中的曲目（未移入音乐缓存时在下次取出时删除）
+        self._last_taken = None
+        self._stats = {
+            'submitted': 0, 'completed': 0, 'failed': 0, 'timeouts': 0,
+            'pool_hits': 0, 'pool_misses': 0, 'prefetched': 0,
+            'wait_time': 0.0, 'run_time': 0.0
+        }
+
+        shutil.rmtree(self.pool_dir, ignore_errors=True)
+        self._workers = []
+        for index in range(workers):
+            self._start_worker(self._queue, f'music-queue-{index}')
+        if pool_size > 0:
+            self._start_worker(self._prefetch_queue, 'music-prefetch')
+
+    def _start_worker(self, job_queue: queue.PriorityQueue, name: str) -> None:
+        worker = threading.Thread(target=self._worker_loop, args=(job_queue,), name=name, daemon=True)
+        worker.start()
+        self._workers.append((worker, job_queue))
+
+    def submit(self, keywords: List[str], player=None) -> MusicJob:
+        """
+        提交正式生成任务（优先于预取任务执行）
+
+        Returns:
+            任务对象，job.future.result()为生成的音乐文件路径（失败时为None）
+        """
+        job = MusicJob(keywords, PRIORITY_ROUND, player)
+        with self._lock:
+            self._round_jobs += 1
+            self._stats['submitted'] += 1
+        self._enqueue(job)
+        logger.info(f"🎵 音乐生成任务已排队 [{job.job_id[:8]}]: {keywords}")
+        return job
+
+    def wait(self, job: MusicJob, timeout: Optional[float] = None) -> Optional[str]:
+        """
+        等待正式任务完成；超时时放弃该任务（未开始的不再执行，进行中的完成后丢弃结果）
+
+        Returns:
+            生成的音乐文件路径，失败或超时时为None
+        """
+        timeout = self.job_timeout if timeout is None else timeout
+        try:
+            return job.future.result(timeout=timeout)
+        except FutureTimeoutError:
+            job.abandoned = True
+            if job.player is not None:
+                job.player.abort()
+            started = not job.future.cancel()
+            with self._lock:
+                self._stats['timeouts'] += 1
+            logger.error(f"⏰ 音乐生成任务 [{job.job_id[:8]}] 超过{timeout}秒未完成，"
+                         f"{'完成后丢弃结果' if started else '已取消'}")
+            return None
+
+    def _enqueue(self, job: MusicJob) -> None:
+        job_queue = self._prefetch_queue if job.is_prefetch else self._queue
+        job_queue.put((job.priority, next(self._sequence), job))
+
+    def take_ready(self, keywords: List[str]) -> Optional[Dict[str, Any]]:
+        """
+        从预取池中取出与关键词同主题的一首音乐，并在后台补充该主题
+
+        Returns:
+            {'theme', 'keywords', 'music_file'}，池中没有可用曲目时返回None
+        """
+        theme = keywords_theme(keywords)
+        if theme is None:
+            return None
+
+        track = None
+        with self._lock:
+            pool = self._pool[theme]
+            while pool:
+                candidate = pool.popleft()
+                if os.path.exists(candidate['music_file']):
+                    track = candidate
+                    break
+            self._stats['pool_hits' if track else 'pool_misses'] += 1
+            if track:
+                stale, self._last_taken = self._last_taken, track['music_file']
+            else:
+                stale = None
+
+        # 取出的曲目通常由调用方移入音乐缓存；仍留在预取目录中的上一首已播放过，删除以免目录无限增长
+        if stale and os.path.exists(stale):
+            try:
+                os.remove(stale)
+            except OSError as e:
+                logger.warning(f"删除已使用的预取音乐失败: {e}")
+
+        self._schedule_refill(theme)
+        if track:
+            logger.info(f"⚡ 从预取池取出[{theme}]音乐: {track['music_file']}")
+        return track
+
+    def start_prefetch(self) -> None:
+        """为所有主题补足预取池（在空闲时由工作线程执行）"""
+        for theme in MUSIC_KEYWORD_THEMES:
+            self._schedule_refill(theme)
+
+    def _schedule_refill(self, theme: str) -> None:
+        """主题池中已有 + 正在补充的曲目不足pool_size时，提交一个批量预取任务"""
+        if self.pool_size <= 0:
+            return
+
+        with self._lock:
+            deficit = self.pool_size - len(self._pool[theme]) - self._refilling[theme]
+            if deficit <= 0:
+                return
+            self._refilling[theme] += deficit
+            prompts = [self._next_prefetch_keywords(theme) for _ in range(deficit)]
+
+        self._enqueue(MusicJob([], PRIORITY_PREFETCH, theme=theme, prompts=prompts))
+
+    def _next_prefetch_keywords(self, theme: str) -> List[str]:
+        """轮换选取主题词表中的4个关键词，使池中的曲目各不相同（调用方需持有锁）"""
+        words = MUSIC_KEYWORD_THEMES[theme]
+        start = self._rotation[theme] * 4 % len(words)
+        self._rotation[theme] += 1
+        return [words[(start + offset) % len(words)] for offset in range(4)]
+
+    def _worker_loop(self, job_queue: queue.PriorityQueue) -> None:
+        while True:
+            _, _, job = job_queue.get()
+            if job is None:
+                break
+            if job.is_prefetch:
+                self._wait_idle()
+            if not job.future.set_running_or_notify_cancel():
+                # 等待超时后被取消的任务
+                self._job_done(job)
+                job_queue.task_done()
+                continue
+
+            job.started_at = time.time()
+            try:
+                if job.is_prefetch:
+                    self._run_prefetch(job)
+                else:
+                    job.future.set_result(self._run_job(job))
+            except Exception as e:
+                logger.error(f"音乐生成任务异常 [{job.job_id[:8]}]: {e}")
+                if not job.future.done():
+                    job.future.set_exception(e)
+            finally:
+                job.finished_at = time.time()
+                self._record_job(job)
+                self._job_done(job)
+                job_queue.task_done()
+
+    def _wait_idle(self) -> None:
+        """等到没有排队或进行中的正式任务（预取任务开始前调用）"""
+        with self._idle:
+            if self._round_jobs:
+                logger.info("⏸️ 有正式任务进行中，预取等待空闲")
+            self._idle.wait_for(lambda: self._round_jobs == 0)
+
+    def _job_done(self, job: MusicJob) -> None:
+        """正式任务结束（完成、失败或被取消），全部结束时唤醒等待空闲的预取"""
+        if job.is_prefetch:
+            return
+        with self._idle:
+            self._round_jobs -= 1
+            if self._round_jobs == 0:
+                self._idle.notify_all()
+
+    def _run_job(self, job: MusicJob) -> Optional[str]:
+        """执行正式任务：先查缓存，未命中时生成并写入缓存"""
+        if self.music_cache is not None:
+            cached_file = self.music_cache.get(job.keywords)
+            if cached_file:
+                return cached_file
+
+        music_file = self.client.generate_music(", ".join(job.keywords), player=job.player)
+        if music_file and self.music_cache is not None:
+            music_file = self.music_cache.put(job.keywords, music_file) or music_file
+        elif music_file and job.abandoned and os.path.exists(music_file):
+            # 调用方已放弃且无缓存可用，结果不会再被使用
+            os.remove(music_file)
+            return None
+        return music_file
+
+    def _run_prefetch(self, job: MusicJob) -> None:
+        """执行预取任务：一次批量请求生成该主题缺少的曲目"""
+        try:
+            results = self.client.generate_many(
+                [", ".join(keywords) for keywords in job.prompts],
+                output_dir=self.pool_dir, batch_size=len(job.prompts)
+            )
+            tracks = [
+                {'theme': job.theme, 'keywords': keywords, 'music_file': result['music_file']}
+                for keywords, result in zip(job.prompts, results) if result['success']
+            ]
+            with self._lock:
+                self._pool[job.theme].extend(tracks)
+                self._stats['prefetched'] += len(tracks)
+            logger.info(f"🎼 [{job.theme}]预取完成: {len(tracks)}/{len(job.prompts)}首")
+            job.future.set_result(tracks)
+        finally:
+            with self._lock:
+                self._refilling[job.theme] -= len(job.prompts)
+
+    def _record_job(self, job: MusicJob) -> None:
+        if job.is_prefetch:
+            return
+
+        failed = job.future.exception() is not None or job.future.result() is None
+        with self._lock:
+            if job.abandoned:
+                return
+            self._stats['failed' if failed else 'completed'] += 1
+            self._stats['wait_time'] += job.started_at - job.created_at
+            self._stats['run_time'] += job.finished_at - job.started_at
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取任务数、排队/执行耗时与预取池状态"""
+        with self._lock:
+            stats = dict(self._stats)
+            pool = {theme: len(tracks) for theme, tracks in self._pool.items()}
+            round_jobs = self._round_jobs
+
+        finished = stats['completed'] + stats['failed']
+        pool_lookups = stats['pool_hits'] + stats['pool_misses']
+        return {
+            'submitted': stats['submitted'],
+            'completed': stats['completed'],
+            'failed': stats['failed'],
+            'timeouts': stats['timeouts'],
+            'pending': self._queue.qsize(),
+            'pending_prefetch': self._prefetch_queue.qsize(),
+            'round_jobs_in_flight': round_jobs,
+            'avg_wait_time': round(stats['wait_time'] / finished, 2) if finished else None,
+            'avg_run_time': round(stats['run_time'] / finished, 2) if finished else None,
+            'prefetched': stats['prefetched'],
+            'pool_hits': stats['pool_hits'],
+            'pool_hit_rate': round(stats['pool_hits'] / pool_lookups, 3) if pool_lookups else None,
+            'pool': pool
+        }
+
+    def shutdown(self) -> None:
+        """停止工作线程（正在执行的任务会先完成）"""
+        for _, job_queue in self._workers:
+            # 哨兵排在所有任务之后
+            job_queue.put((PRIORITY_PREFETCH + 1, next(self._sequence), None))
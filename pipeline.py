@@ -0,0 +1,389 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+LETDANCE 直接流水线
+不经过工具调用Agent：代码中直接依次调用图像/姿态工具，再用一次LLM调用融合生成音乐关键词
+"""
+
+import time
+import asyncio
+import logging
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Optional
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.messages import HumanMessage
+from langchain_core.outputs import LLMResult
+
+from tools.circuit_breaker import current_latency_budget
+from tools.music_keywords_tool import MusicKeywords, MUSIC_KEYWORD_VOCABULARY, validate_music_keywords
+from keyword_rules import rule_based_keywords
+
+# 配置日志
+logger = logging.getLogger(__name__)
+
+# 图像分析提示词
+IMAGE_ANALYSIS_PROMPT = '分析用户情感状态和表情'
+
+# 融合提示词：只包含两个工具的摘要字段
+FUSION_PROMPT = """根据以下用户情感分析结果，生成4个英文音乐风格关键词。
+
+面部情感: {image_summary}
+肢体情感: {pose_summary}
+
+关键词只能从以下词表中选择: {vocabulary}"""
+
+def parse_keywords(text: str) -> List[str]:
+    """解析逗号分隔的关键词文本"""
+    keywords = [kw.strip() for kw in text.replace('，', ',').split(',') if kw.strip()]
+    return keywords[:4]  # 确保只返回4个关键词
+
+def complete_keywords(keywords: List[str], fallback: List[str]) -> List[str]:
+    """校验后不足4个关键词时，用降级关键词补足"""
+    completed = list(keywords)
+    for keyword in fallback:
+        if len(completed) >= 4:
+            break
+        if keyword not in completed:
+            completed.append(keyword)
+    return completed[:4]
+
+def keywords_from_agent_output(output: Any, pose_data: Optional[Dict] = None,
+                               image_data: Optional[Dict] = None) -> Dict[str, Any]:
+    """
+    从Agent最终输出中取得关键词，不再额外调用LLM
+
+    正常情况下输出是submit_music_keywords工具的结果；若Agent直接回复了文本，
+    则按逗号解析并用词表校验，都无效时退回本地规则关键词。
+
+    Returns:
+        {'music_keywords': [...], 'fallback': 是否使用了降级关键词}
+    """
+    fallback_keywords = rule_based_keywords(pose_data, image_data)
+
+    if isinstance(output, dict):
+        keywords = output.get('music_keywords') if output.get('success') else None
+    else:
+        keywords = validate_music_keywords(parse_keywords(str(output or '')))
+
+    if not keywords:
+        logger.warning(f"Agent未给出有效的音乐关键词，使用降级关键词: {output}")
+        return {'music_keywords': fallback_keywords, 'fallback': True}
+
+    return {'music_keywords': complete_keywords(keywords, fallback_keywords), 'fallback': False}
+
+class LLMUsageTracker(BaseCallbackHandler):
+    """统计LLM调用次数和token用量（作为LangChain回调传入）"""
+
+    def __init__(self):
+        super().__init__()
+        self.reset()
+
+    def reset(self):
+        """清零计数"""
+        self.llm_calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+
+    def on_llm_end(self, response: LLMResult, **kwargs: Any) -> None:
+        self.llm_calls += 1
+
+        usage = (response.llm_output or {}).get('token_usage') or {}
+        if usage:
+            self.prompt_tokens += usage.get('prompt_tokens', 0) or 0
+            self.completion_tokens += usage.get('completion_tokens', 0) or 0
+            return
+
+        # 部分版本只在消息的usage_metadata中返回用量
+        for generations in response.generations:
+            for generation in generations:
+                metadata = getattr(getattr(generation, 'message', None), 'usage_metadata', None) or {}
+                self.prompt_tokens += metadata.get('input_tokens', 0)
+                self.completion_tokens += metadata.get('output_tokens', 0)
+
+    def snapshot(self) -> Dict[str, int]:
+        """获取当前计数"""
+        return {
+            'llm_calls': self.llm_calls,
+            'prompt_tokens': self.prompt_tokens,
+            'completion_tokens': self.completion_tokens,
+            'total_tokens': self.prompt_tokens + self.completion_tokens
+        }
+
+class DirectPipeline:
+    """直接流水线：图像分析 + 姿态分析 -> 一次LLM融合"""
+
+    def __init__(self, tools: List, llm, breaker=None, concurrent_capture: bool = True, keyword_cache=None):
+        self.tools = {tool.name: tool for tool in tools}
+        self.llm = llm
+        self.breaker = breaker
+        # 量化状态关键词缓存，命中时跳过LLM融合
+        self.keyword_cache = keyword_cache
+        # 融合步骤直接输出结构化关键词（函数调用 + 词表校验）
+        self.structured_llm = llm.with_structured_output(MusicKeywords, method='function_calling')
+        # 是否使用组合采集阶段（摄像头只打开一次，视觉分析与姿态采集并发）
+        self.concurrent_capture = concurrent_capture
+
+    def run_tools(self, duration: int = 10, image_backend: str = 'azure') -> Dict[str, Any]:
+        """按固定顺序直接调用两个摄像头工具（共用摄像头，不能并发）"""
+        image_data = self.tools['image_analysis'].invoke({
+            'action': 'capture_and_analyze',
+            'analysis_prompt': IMAGE_ANALYSIS_PROMPT,
+            'backend': image_backend
+        })
+        pose_data = self.tools['pose_analysis'].invoke({
+            'action': 'analyze_realtime',
+            'duration': duration,
+            'confidence_threshold': 0.5
+        })
+        return {'image_analysis': image_data, 'pose_analysis': pose_data}
+
+    def run_tools_concurrent(self, duration: int = 10, stop_event: Optional[threading.Event] = None,
+                             image_backend: str = 'azure') -> Dict[str, Any]:
+        """
+        组合采集阶段：只打开一次摄像头，姿态分析立即开始，
+        首帧交给后台线程做视觉分析，与剩余的姿态采集时间重叠
+        """
+        image_tool = self.tools['image_analysis']
+        pose_tool = self.tools['pose_analysis']
+
+        executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='vision')
+        futures = []
+
+        def on_first_frame(frame):
+            # 复制上下文，让后台线程沿用本轮的延迟预算
+            context = contextvars.copy_context()
+            futures.append(executor.submit(
+                context.run, image_tool.analyze_frame, frame, IMAGE_ANALYSIS_PROMPT, backend=image_backend
+            ))
+
+        try:
+            pose_data = pose_tool.analyze_realtime(
+                duration, confidence_threshold=0.5, frame_callback=on_first_frame, release_wait=0,
+                stop_event=stop_event
+            )
+            pose_done = time.time()
+
+            if futures:
+                image_data = futures[0].result()
+            else:
+                # 姿态阶段没有拿到画面（如YOLO不可用），退回单独拍照
+                logger.warning("组合采集未获得首帧，改为单独拍照分析")
+                image_data = image_tool.invoke({
+                    'action': 'capture_and_analyze',
+                    'analysis_prompt': IMAGE_ANALYSIS_PROMPT,
+                    'backend': image_backend
+                })
+        finally:
+            executor.shutdown(wait=False)
+
+        # 姿态结束后仍需等待视觉结果的时间；为0表示视觉延迟已完全被姿态采集掩盖
+        vision_wait = time.time() - pose_done
+        logger.info(f"📷 组合采集完成，姿态结束后等待视觉结果{vision_wait:.2f}s")
+
+        return {
+            'image_analysis': image_data,
+            'pose_analysis': pose_data,
+            'vision_wait': round(vision_wait, 3),
+            'shared_stream': bool(futures)
+        }
+
+    def _summarize_image(self, image_data: Optional[Dict]) -> str:
+        """提取图像分析的摘要字段"""
+        if not image_data or not image_data.get('success') or not image_data.get('data'):
+            return '不可用'
+
+        data = image_data['data']
+        structured = data.get('structured')
+        if structured:
+            summary = f"{structured['emotion']}（置信度{structured['confidence']:.2f}）"
+            if structured.get('expression_cues'):
+                summary += f"，线索: {'; '.join(structured['expression_cues'])}"
+            if structured.get('music_keywords'):
+                summary += f"，建议风格: {', '.join(structured['music_keywords'])}"
+            return summary
+
+        return (data.get('analysis') or '不可用')[:300]
+
+    def _summarize_pose(self, pose_data: Optional[Dict]) -> str:
+        """提取姿态分析的摘要字段"""
+        if not pose_data or not pose_data.get('success') or not pose_data.get('data'):
+            return '不可用'
+
+        data = pose_data['data']
+        laban = data.get('average_laban_qualities') or {}
+        laban_text = ', '.join(f"{k}={v:.2f}" for k, v in laban.items())
+        return f"{data.get('dominant_emotion', '未知')}（拉班均值: {laban_text}；分布: {data.get('emotion_distribution', {})}）"
+
+    def _fusion_request(self, image_data: Optional[Dict], pose_data: Optional[Dict],
+                        callbacks: Optional[List] = None):
+        """构建融合请求：消息、回调配置和按剩余预算设置的超时参数"""
+        prompt = FUSION_PROMPT.format(
+            image_summary=self._summarize_image(image_data),
+            pose_summary=self._summarize_pose(pose_data),
+            vocabulary=', '.join(MUSIC_KEYWORD_VOCABULARY)
+        )
+
+        # 按本轮剩余预算设置请求超时
+        budget = current_latency_budget()
+        invoke_kwargs = {'timeout': max(budget.remaining(), 1.0)} if budget else {}
+        config = {'callbacks': callbacks} if callbacks else None
+        return [HumanMessage(content=prompt)], config, invoke_kwargs
+
+    def fuse(self, image_data: Optional[Dict], pose_data: Optional[Dict],
+             callbacks: Optional[List] = None) -> Dict[str, Any]:
+        """
+        用一次LLM调用融合两个分析结果，失败时退回本地规则关键词
+        
+        Returns:
+            {'music_keywords': [...], 'fallback': 是否使用了降级关键词}
+        """
+        messages, config, invoke_kwargs = self._fusion_request(image_data, pose_data, callbacks)
+
+        try:
+            # 词表校验失败时解析器直接抛出异常，走降级关键词
+            if self.breaker is not None:
+                response = self.breaker.call(
+                    self.structured_llm.invoke, messages, config, label='fusion', **invoke_kwargs
+                )
+            else:
+                response = self.structured_llm.invoke(messages, config, **invoke_kwargs)
+
+            return {
+                'music_keywords': complete_keywords(response.keywords, rule_based_keywords(pose_data, image_data)),
+                'fallback': False
+            }
+
+        except Exception as e:
+            logger.error(f"关键词融合失败: {e}")
+
+        return {'music_keywords': rule_based_keywords(pose_data, image_data), 'fallback': True}
+
+    async def afuse(self, image_data: Optional[Dict], pose_data: Optional[Dict],
+                    callbacks: Optional[List] = None) -> Dict[str, Any]:
+        """fuse的异步版本（取消时直接向上抛出CancelledError）"""
+        messages, config, invoke_kwargs = self._fusion_request(image_data, pose_data, callbacks)
+
+        try:
+            if self.breaker is not None:
+                response = await self.breaker.acall(
+                    self.structured_llm.ainvoke, messages, config, label='fusion', **invoke_kwargs
+                )
+            else:
+                response = await self.structured_llm.ainvoke(messages, config, **invoke_kwargs)
+
+            return {
+                'music_keywords': complete_keywords(response.keywords, rule_based_keywords(pose_data, image_data)),
+                'fallback': False
+            }
+
+        except Exception as e:
+            logger.error(f"关键词融合失败: {e}")
+
+        return {'music_keywords': rule_based_keywords(pose_data, image_data), 'fallback': True}
+
+    def capture(self, duration: int = 10, stop_event: Optional[threading.Event] = None,
+                image_backend: str = 'azure') -> Dict[str, Any]:
+        """
+        采集阶段：占用摄像头运行图像与姿态分析
+
+        Args:
+            stop_event: 被设置时姿态采集提前结束（仅组合采集阶段支持）
+            image_backend: 图像分析后端（azure/local/auto），离线模式使用local
+        """
+        start_time = time.time()
+        if self.concurrent_capture:
+            tool_results = self.run_tools_concurrent(duration, stop_event, image_backend)
+        else:
+            tool_results = self.run_tools(duration, image_backend)
+        tool_results['tools_time'] = round(time.time() - start_time, 3)
+        return tool_results
+
+    def _lookup_cache(self, tool_results: Dict[str, Any]):
+        """查询关键词缓存，返回(缓存键, 命中的关键词或None)"""
+        cache_key = None
+        if self.keyword_cache:
+            cache_key = self.keyword_cache.make_key(tool_results['image_analysis'], tool_results['pose_analysis'])
+        cached_keywords = self.keyword_cache.get(cache_key) if cache_key else None
+
+        if cached_keywords:
+            logger.info(f"🗃️ 命中关键词缓存 [{cache_key}]: {cached_keywords}")
+        return cache_key, cached_keywords
+
+    def _finish_result(self, tool_results: Dict[str, Any], cache_key: Optional[str],
+                       cached_keywords: Optional[List[str]], fusion: Dict[str, Any],
+                       start_time: float) -> Dict[str, Any]:
+        """写入缓存并汇总生成阶段结果"""
+        # 降级关键词不写入缓存，避免Azure恢复后仍返回降级结果
+        if cache_key and not cached_keywords and not fusion['fallback']:
+            self.keyword_cache.put(cache_key, fusion['music_keywords'])
+
+        return {
+            'image_analysis': tool_results['image_analysis'],
+            'pose_analysis': tool_results['pose_analysis'],
+            'music_keywords': fusion['music_keywords'],
+            'fusion_fallback': fusion['fallback'],
+            'cache_hit': cached_keywords is not None,
+            'cache_key': cache_key,
+            'tools_time': tool_results['tools_time'],
+            'vision_wait': tool_results.get('vision_wait'),
+            'shared_stream': tool_results.get('shared_stream', False),
+            'fusion_time': round(time.time() - start_time, 3)
+        }
+
+    def finish(self, tool_results: Dict[str, Any], callbacks: Optional[List] = None) -> Dict[str, Any]:
+        """生成阶段：查询关键词缓存，未命中时用一次LLM融合（不占用摄像头）"""
+        start_time = time.time()
+        cache_key, cached_keywords = self._lookup_cache(tool_results)
+
+        if cached_keywords:
+            fusion = {'music_keywords': cached_keywords, 'fallback': False}
+        else:
+            fusion = self.fuse(tool_results['image_analysis'], tool_results['pose_analysis'], callbacks)
+
+        return self._finish_result(tool_results, cache_key, cached_keywords, fusion, start_time)
+
+    async def afinish(self, tool_results: Dict[str, Any], callbacks: Optional[List] = None,
+                      timeout: Optional[float] = None) -> Dict[str, Any]:
+        """
+        finish的异步版本
+
+        Args:
+            timeout: 融合阶段截止时间（秒），超时后退回本地规则关键词
+        """
+        start_time = time.time()
+        cache_key, cached_keywords = self._lookup_cache(tool_results)
+        pose_data = tool_results['pose_analysis']
+
+        if cached_keywords:
+            fusion = {'music_keywords': cached_keywords, 'fallback': False}
+        else:
+            try:
+                fusion = await asyncio.wait_for(
+                    self.afuse(tool_results['image_analysis'], pose_data, callbacks), timeout=timeout
+                )
+            except asyncio.TimeoutError:
+                logger.warning(f"⏰ 关键词融合超过{timeout}秒，使用本地规则关键词")
+                if self.breaker is not None:
+                    self.breaker.record_failure('fusion', time.time() - start_time)
+                fusion = {'music_keywords': rule_based_keywords(pose_data, tool_results['image_analysis']),
+                          'fallback': True}
+
+        return self._finish_result(tool_results, cache_key, cached_keywords, fusion, start_time)
+
+    def finish_local(self, tool_results: Dict[str, Any]) -> Dict[str, Any]:
+        """离线生成阶段：只用本地规则生成关键词，不调用LLM，也不写入关键词缓存"""
+        start_time = time.time()
+        fusion = {
+            'music_keywords': rule_based_keywords(tool_results['pose_analysis'], tool_results['image_analysis']),
+            'fallback': False
+        }
+        result = self._finish_result(tool_results, None, None, fusion, start_time)
+        result['rule_based'] = True
+        return result
+
+    def run(self, duration: int = 10, callbacks: Optional[List] = None) -> Dict[str, Any]:
+        """执行完整流水线"""
+        return self.finish(self.capture(duration), callbacks)
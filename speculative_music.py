@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+LETDANCE 推测式音乐生成
+采集完成后用本地规则关键词（临时关键词）提前开始生成音乐，与LLM关键词生成并行；
+最终关键词与临时关键词一致时直接使用推测结果，否则取消或丢弃
+"""
+
+import os
+import time
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Optional
+
+# 配置日志
+logger = logging.getLogger(__name__)
+
+# 推测生成的音乐单独存放，丢弃时删除文件不会误删正式生成的音乐
+SPECULATIVE_OUTPUT_DIR = os.path.join('generated_music', 'speculative')
+
+class Speculation:
+    """一次推测生成（同步future或asyncio任务）"""
+
+    def __init__(self, keywords: List[str]):
+        self.keywords = list(keywords)
+        self.started_at = time.time()
+        self.finished_at = None
+        self.future = None
+        self.task = None
+        self.resolved = False
+
+    @property
+    def generation_time(self) -> Optional[float]:
+        if self.finished_at is None:
+            return None
+        return self.finished_at - self.started_at
+
+class SpeculativeMusicGenerator:
+    """推测式音乐生成器（统计命中率与节省时间，线程安全）"""
+
+    def __init__(self, client, async_client=None, min_overlap: int = 4, max_workers: int = 1):
+        """
+        Args:
+            client: 同步音乐生成客户端（MusicGenClient）
+            async_client: 异步音乐生成客户端（AsyncMusicGenClient），异步工作流使用
+            min_overlap: 最终关键词与临时关键词至少有几个相同（不计顺序）才算命中
+            max_workers: 同时进行的推测生成数
+        """
+        self.client = client
+        self.async_client = async_client
+        self.min_overlap = min_overlap
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='speculative-music')
+
+        self._lock = threading.Lock()
+        self._stats = {
+            'started': 0,
+            'hits': 0,
+            'failed_hits': 0,
+            'misses': 0,
+            'cancelled': 0,
+            'discarded': 0,
+            'time_saved': 0.0,
+            'wasted_time': 0.0
+        }
+
+    def matches(self, speculation: Speculation, final_keywords: List[str]) -> bool:
+        """最终关键词是否与推测使用的关键词一致（不计顺序）"""
+        overlap = len(set(speculation.keywords) & set(final_keywords))
+        return overlap >= min(self.min_overlap, len(final_keywords))
+
+    def _generate(self, speculation: Speculation) -> Optional[str]:
+        try:
+            return self.client.generate_music(", ".join(speculation.keywords), output_dir=SPECULATIVE_OUTPUT_DIR)
+        finally:
+            speculation.finished_at = time.time()
+
+    def start(self, keywords: List[str]) -> Speculation:
+        """在后台线程开始推测生成"""
+        speculation = Speculation(keywords)
+        speculation.future = self._executor.submit(self._generate, speculation)
+        self._count('started')
+        logger.info(f"🔮 开始推测生成音乐: {keywords}")
+        return speculation
+
+    def resolve(self, speculation: Speculation, final_keywords: List[str]) -> Optional[str]:
+        """
+        用最终关键词结算推测生成
+
+        Returns:
+            命中时返回推测生成的音乐文件（推测失败时为None）；未命中时返回None，由调用方正常生成
+        """
+        resolved_at = time.time()
+        if not self.matches(speculation, final_keywords):
+            self.discard(speculation, reason=f'关键词不一致 {speculation.keywords} -> {final_keywords}')
+            return None
+
+        speculation.resolved = True
+        music_file = speculation.future.result()
+        self._record_hit(speculation, resolved_at, music_file)
+        return music_file
+
+    def discard(self, speculation: Speculation, reason: str = '') -> None:
+        """取消或丢弃推测生成（已在进行的同步请求无法中断，完成后删除文件）"""
+        if speculation.resolved:
+            return
+        speculation.resolved = True
+
+        cancelled = False
+        if speculation.future is not None:
+            cancelled = speculation.future.cancel()
+            if not cancelled:
+                speculation.future.add_done_callback(
+                    lambda future: self._discard_result(speculation, None if future.exception() else future.result())
+                )
+        elif speculation.task is not None and not speculation.task.done():
+            speculation.task.cancel()
+            cancelled = True
+        elif speculation.task is not None and not speculation.task.cancelled():
+            task = speculation.task
+            self._discard_result(speculation, None if task.exception() else task.result())
+
+        with self._lock:
+            self._stats['misses'] += 1
+            self._stats['cancelled' if cancelled else 'discarded'] += 1
+            if cancelled:
+                self._stats['wasted_time'] += time.time() - speculation.started_at
+
+        logger.info(f"🗑️ 推测生成未命中（{'已取消' if cancelled else '完成后丢弃'}）: {reason}")
+
+    def _discard_result(self, speculation: Speculation, music_file: Optional[str]) -> None:
+        with self._lock:
+            self._stats['wasted_time'] += speculation.generation_time or 0.0
+
+        if music_file and os.path.exists(music_file):
+            try:
+                os.remove(music_file)
+            except OSError as e:
+                logger.warning(f"删除丢弃的推测音乐失败: {e}")
+
+    def _record_hit(self, speculation: Speculation, resolved_at: float, music_file: Optional[str]) -> None:
+        """
+        命中时节省的时间：最终关键词出来时推测已经运行的时长，不超过整次生成耗时
+
+        推测生成本身失败时调用方仍需完整生成，计入failed_hits，不计节省时间
+        """
+        if not music_file:
+            with self._lock:
+                self._stats['failed_hits'] += 1
+                self._stats['wasted_time'] += speculation.generation_time or 0.0
+            logger.warning("🎯 推测生成命中，但推测生成本身失败")
+            return
+
+        time_saved = min(speculation.generation_time or 0.0, resolved_at - speculation.started_at)
+        with self._lock:
+            self._stats['hits'] += 1
+            self._stats['time_saved'] += time_saved
+        logger.info(f"🎯 推测生成命中，节省{time_saved:.1f}秒: {music_file}")
+
+    async def _agenerate(self, speculation: Speculation) -> Optional[str]:
+        try:
+            return await self.async_client.generate_music(
+                ", ".join(speculation.keywords), output_dir=SPECULATIVE_OUTPUT_DIR
+            )
+        finally:
+            speculation.finished_at = time.time()
+
+    def astart(self, keywords: List[str]) -> Speculation:
+        """在事件循环中开始推测生成（需在协程中调用）"""
+        if self.async_client is None:
+            raise ValueError("未提供异步音乐生成客户端")
+
+        speculation = Speculation(keywords)
+        speculation.task = asyncio.create_task(self._agenerate(speculation))
+        self._count('started')
+        logger.info(f"🔮 开始推测生成音乐（异步）: {keywords}")
+        return speculation
+
+    async def aresolve(self, speculation: Speculation, final_keywords: List[str]) -> Optional[str]:
+        """resolve的异步版本，未命中时直接取消请求"""
+        resolved_at = time.time()
+        if not self.matches(speculation, final_keywords):
+            self.discard(speculation, reason=f'关键词不一致 {speculation.keywords} -> {final_keywords}')
+            return None
+
+        speculation.resolved = True
+        music_file = await speculation.task
+        self._record_hit(speculation, resolved_at, music_file)
+        return music_file
+
+    def _count(self, key: str) -> None:
+        with self._lock:
+            self._stats[key] += 1
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取命中率、累计节省时间和浪费的生成时间"""
+        with self._lock:
+            stats = dict(self._stats)
+
+        resolved = stats['hits'] + stats['failed_hits'] + stats['misses']
+        stats['hit_rate'] = round(stats['hits'] / resolved, 3) if resolved else None
+        stats['avg_time_saved'] = round(stats['time_saved'] / stats['hits'], 2) if stats['hits'] else None
+        stats['time_saved'] = round(stats['time_saved'], 2)
+        stats['wasted_time'] = round(stats['wasted_time'], 2)
+        return stats
+
+    def shutdown(self) -> None:
+        """关闭后台线程池（不等待进行中的推测生成）"""
+        self._executor.shutdown(wait=False)
@@ -5,11 +5,15 @@ LangChain工具集合
 
 from .image_analysis_tool import ImageAnalysisTool
 from .pose_analysis_tool import PoseAnalysisTool
+from .music_keywords_tool import SubmitMusicKeywordsTool, MusicKeywords, validate_music_keywords
 from .registry import get_all_tools, get_tool, get_tools_info, get_tool_registry
 
 __all__ = [
     'ImageAnalysisTool',
     'PoseAnalysisTool', 
+    'SubmitMusicKeywordsTool',
+    'MusicKeywords',
+    'validate_music_keywords',
     'get_all_tools',
     'get_tool',
     'get_tools_info',
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+LETDANCE 摄像头采集控制
+Agent模式下摄像头工具在Agent的执行线程中运行，取消协程不会让它们停下；
+轮次通过上下文共享一个采集控制对象，取消或超时时通知工具提前结束，并等待摄像头释放
+"""
+
+import logging
+import threading
+import contextvars
+from typing import Optional
+
+# 配置日志
+logger = logging.getLogger(__name__)
+
+class CaptureControl:
+    """一轮分析的摄像头采集控制（线程安全）"""
+
+    def __init__(self):
+        self.stop_event = threading.Event()
+        self._condition = threading.Condition()
+        self._active = 0
+
+    def acquire(self) -> bool:
+        """工具打开摄像头前调用；已要求停止时返回False，工具不应再打开摄像头"""
+        with self._condition:
+            if self.stop_event.is_set():
+                return False
+            self._active += 1
+            return True
+
+    def release(self):
+        """工具释放摄像头后调用"""
+        with self._condition:
+            self._active -= 1
+            self._condition.notify_all()
+
+    def stop_and_wait(self, timeout: Optional[float] = None) -> bool:
+        """
+        通知正在采集的工具提前结束，并等待摄像头全部释放
+
+        Returns:
+            超时前摄像头是否已全部释放
+        """
+        with self._condition:
+            self.stop_event.set()
+            released = self._condition.wait_for(lambda: self._active == 0, timeout)
+        if not released:
+            logger.warning(f"⏰ 等待摄像头释放超过{timeout}秒")
+        return released
+
+# 当前轮次的采集控制（工具在Agent执行线程中运行时随上下文传入）
+_current_control: contextvars.ContextVar = contextvars.ContextVar('letdance_capture_control', default=None)
+
+def start_capture_control() -> CaptureControl:
+    """为当前上下文开始新一轮采集控制"""
+    control = CaptureControl()
+    _current_control.set(control)
+    return control
+
+def current_capture_control() -> Optional[CaptureControl]:
+    """获取当前轮次的采集控制（未设置时为None）"""
+    return _current_control.get()
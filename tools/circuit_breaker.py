@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+LETDANCE 熔断器与延迟预算
+Azure调用共享熔断器：连续失败后快速失败，避免一次慢请求拖住整轮投影
+"""
+
+import time
+import asyncio
+import logging
+import threading
+import contextvars
+from typing import Optional, Dict, Any, Callable
+
+# 配置日志
+logger = logging.getLogger(__name__)
+
+# 默认熔断参数
+DEFAULT_FAILURE_THRESHOLD = 3
+DEFAULT_RESET_TIMEOUT = 30.0
+
+class CircuitOpenError(Exception):
+    """熔断器打开时抛出"""
+
+class LatencyBudgetExceeded(Exception):
+    """本轮延迟预算耗尽时抛出"""
+
+class LatencyBudget:
+    """单轮分析的延迟预算"""
+
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+        self.start_time = time.time()
+
+    def elapsed(self) -> float:
+        """已用时间（秒）"""
+        return time.time() - self.start_time
+
+    def remaining(self) -> float:
+        """剩余时间（秒），不小于0"""
+        return max(0.0, self.seconds - self.elapsed())
+
+    def expired(self) -> bool:
+        """预算是否已耗尽"""
+        return self.remaining() <= 0
+
+# 当前轮次的延迟预算（同一线程/协程内的工具调用共享）
+_current_budget: contextvars.ContextVar = contextvars.ContextVar('letdance_latency_budget', default=None)
+
+def start_latency_budget(seconds: Optional[float]) -> Optional[LatencyBudget]:
+    """开始新一轮延迟预算，seconds为None时不限时"""
+    budget = LatencyBudget(seconds) if seconds else None
+    _current_budget.set(budget)
+    return budget
+
+def current_latency_budget() -> Optional[LatencyBudget]:
+    """获取当前轮次的延迟预算"""
+    return _current_budget.get()
+
+# 当前上下文持有的半开探测名额 {熔断器名称: 探测编号}
+# 外层调用（如整个agent执行器）拿到探测名额后，其中嵌套的Azure调用（视觉、融合）共享该名额
+_held_probes: contextvars.ContextVar = contextvars.ContextVar('letdance_breaker_probes', default={})
+
+class CircuitBreaker:
+    """
+    熔断器（closed -> open -> half_open）
+
+    - closed: 正常放行，连续失败达到阈值后打开
+    - open: 直接短路，reset_timeout 后进入 half_open
+    - half_open: 只放行一个探测请求，成功则关闭，失败则重新打开；
+      探测请求内部嵌套的调用（同一上下文）同样放行
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name: str, failure_threshold: int = DEFAULT_FAILURE_THRESHOLD,
+                 reset_timeout: float = DEFAULT_RESET_TIMEOUT):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._consecutive_failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._probe_id = 0
+        self._metrics = {}
+        self._state_changes = 0
+
+    def configure(self, failure_threshold: Optional[int] = None, reset_timeout: Optional[float] = None):
+        """更新熔断参数"""
+        with self._lock:
+            if failure_threshold is not None:
+                self.failure_threshold = failure_threshold
+            if reset_timeout is not None:
+                self.reset_timeout = reset_timeout
+
+    @property
+    def state(self) -> str:
+        """当前状态（会根据时间自动从open转为half_open）"""
+        with self._lock:
+            self._refresh_state()
+            return self._state
+
+    def _refresh_state(self):
+        if self._state == self.OPEN and time.time() - self._opened_at >= self.reset_timeout:
+            self._set_state(self.HALF_OPEN)
+
+    def _set_state(self, state: str):
+        if self._state != state:
+            logger.info(f"熔断器[{self.name}] 状态变化: {self._state} -> {state}")
+            self._state = state
+            self._state_changes += 1
+            if state == self.OPEN:
+                self._opened_at = time.time()
+            self._probe_in_flight = False
+
+    def _label_metrics(self, label: str) -> Dict[str, Any]:
+        if label not in self._metrics:
+            self._metrics[label] = {
+                'successes': 0,
+                'failures': 0,
+                'short_circuits': 0,
+                'total_latency': 0.0,
+                'last_latency': None
+            }
+        return self._metrics[label]
+
+    def allow_request(self, label: str = 'default') -> bool:
+        """判断是否放行请求，不放行时计入短路次数"""
+        with self._lock:
+            self._refresh_state()
+
+            if self._state == self.CLOSED:
+                return True
+
+            if self._state == self.HALF_OPEN:
+                if not self._probe_in_flight:
+                    self._probe_in_flight = True
+                    self._probe_id += 1
+                    return True
+                if _held_probes.get().get(self.name) == self._probe_id:
+                    return True
+
+            self._label_metrics(label)['short_circuits'] += 1
+            return False
+
+    def record_success(self, label: str = 'default', latency: Optional[float] = None):
+        """记录一次成功调用"""
+        with self._lock:
+            metrics = self._label_metrics(label)
+            metrics['successes'] += 1
+            if latency is not None:
+                metrics['total_latency'] += latency
+                metrics['last_latency'] = round(latency, 3)
+
+            self._consecutive_failures = 0
+            self._set_state(self.CLOSED)
+
+    def record_failure(self, label: str = 'default', latency: Optional[float] = None):
+        """记录一次失败调用"""
+        with self._lock:
+            metrics = self._label_metrics(label)
+            metrics['failures'] += 1
+            if latency is not None:
+                metrics['total_latency'] += latency
+                metrics['last_latency'] = round(latency, 3)
+
+            self._consecutive_failures += 1
+            if self._state == self.HALF_OPEN or self._consecutive_failures >= self.failure_threshold:
+                self._set_state(self.OPEN)
+
+    def call(self, func: Callable, *args, label: str = 'default', **kwargs):
+        """
+        在熔断器和当前延迟预算保护下执行调用
+
+        调用完成时若已超出本轮预算，结果照常返回，但按慢调用计入失败
+
+        Raises:
+            CircuitOpenError: 熔断器打开
+            LatencyBudgetExceeded: 本轮预算在调用前已耗尽
+        """
+        budget, probe_token = self._before_call(label)
+
+        start_time = time.time()
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            self.record_failure(label, time.time() - start_time)
+            raise
+        finally:
+            self._release_probe(probe_token)
+
+        self._after_call(label, budget, time.time() - start_time)
+        return result
+
+    async def acall(self, func: Callable, *args, label: str = 'default', **kwargs):
+        """
+        call的异步版本，func为协程函数
+
+        调用被取消（如被新一轮取代或外层超时）时不计入成败，由调用方决定是否记为失败
+        """
+        budget, probe_token = self._before_call(label)
+
+        start_time = time.time()
+        try:
+            result = await func(*args, **kwargs)
+        except asyncio.CancelledError:
+            # 释放半开状态下的探测名额，避免熔断器卡在half_open
+            with self._lock:
+                if self._state == self.HALF_OPEN:
+                    self._probe_in_flight = False
+            raise
+        except Exception:
+            self.record_failure(label, time.time() - start_time)
+            raise
+        finally:
+            self._release_probe(probe_token)
+
+        self._after_call(label, budget, time.time() - start_time)
+        return result
+
+    def _before_call(self, label: str):
+        """调用前检查延迟预算和熔断状态，返回当前预算和探测名额标记（非探测调用时为None）"""
+        budget = current_latency_budget()
+        if budget is not None and budget.expired():
+            with self._lock:
+                self._label_metrics(label)['short_circuits'] += 1
+            raise LatencyBudgetExceeded(f"延迟预算已耗尽({budget.seconds}s)")
+
+        if not self.allow_request(label):
+            raise CircuitOpenError(f"熔断器[{self.name}]已打开")
+
+        with self._lock:
+            if self._state != self.HALF_OPEN:
+                return budget, None
+            probe_id = self._probe_id
+        # 在当前上下文中标记持有探测名额，调用内部的嵌套调用据此放行
+        return budget, _held_probes.set({**_held_probes.get(), self.name: probe_id})
+
+    def _release_probe(self, probe_token):
+        """调用结束后清除当前上下文的探测名额标记"""
+        if probe_token is not None:
+            _held_probes.reset(probe_token)
+
+    def _after_call(self, label: str, budget: Optional[LatencyBudget], latency: float):
+        """调用返回后按是否超出预算记录成败"""
+        if budget is not None and budget.expired():
+            # 调用虽然返回但已超出本轮预算，按慢调用失败处理
+            logger.warning(f"熔断器[{self.name}] {label} 调用耗时{latency:.1f}s，超出本轮延迟预算")
+            self.record_failure(label, latency)
+        else:
+            self.record_success(label, latency)
+
+    def get_metrics(self) -> Dict[str, Any]:
+        """获取熔断器指标"""
+        with self._lock:
+            self._refresh_state()
+            calls = {}
+            for label, metrics in self._metrics.items():
+                completed = metrics['successes'] + metrics['failures']
+                calls[label] = {
+                    'successes': metrics['successes'],
+                    'failures': metrics['failures'],
+                    'short_circuits': metrics['short_circuits'],
+                    'avg_latency': round(metrics['total_latency'] / completed, 3) if completed else None,
+                    'last_latency': metrics['last_latency']
+                }
+
+            return {
+                'name': self.name,
+                'state': self._state,
+                'consecutive_failures': self._consecutive_failures,
+                'failure_threshold': self.failure_threshold,
+                'reset_timeout': self.reset_timeout,
+                'state_changes': self._state_changes,
+                'calls': calls
+            }
+
+# 全局熔断器实例
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+def get_circuit_breaker(name: str = 'azure', **config) -> CircuitBreaker:
+    """获取指定名称的共享熔断器（单例模式），传入配置时更新参数"""
+    with _breakers_lock:
+        if name not in _breakers:
+            _breakers[name] = CircuitBreaker(name)
+        breaker = _breakers[name]
+
+    if config:
+        breaker.configure(**config)
+    return breaker
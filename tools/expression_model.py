@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+LETDANCE 本地表情识别模型
+OpenCV人脸检测 + ONNX表情分类器（FER+），在CPU上几十毫秒内给出情感标签
+"""
+
+import os
+import time
+import logging
+import numpy as np
+from typing import Optional, Dict, Any, List, Tuple
+
+import cv2
+
+try:
+    import onnxruntime as ort
+    ONNXRUNTIME_AVAILABLE = True
+except ImportError:
+    ONNXRUNTIME_AVAILABLE = False
+    logging.warning("onnxruntime未安装，本地表情识别将不可用")
+
+# 配置日志
+logger = logging.getLogger(__name__)
+
+# 默认模型路径（ONNX Model Zoo: emotion-ferplus-8.onnx），可通过环境变量覆盖
+DEFAULT_MODEL_PATH = os.getenv('LETDANCE_EXPRESSION_MODEL', 'models/emotion-ferplus-8.onnx')
+
+# FER+ 输出类别
+FERPLUS_LABELS = ['neutral', 'happiness', 'surprise', 'sadness', 'anger', 'disgust', 'fear', 'contempt']
+
+# 情感标签同义词，用于把Azure分析文本归一到FER+类别以计算一致率
+EMOTION_SYNONYMS = {
+    'happiness': ['happiness', 'happy', 'joy', 'cheerful', 'smile', '快乐', '开心', '高兴', '愉快', '喜悦', '微笑'],
+    'sadness': ['sadness', 'sad', 'melanchol', 'sorrow', '悲伤', '难过', '伤心', '忧郁', '沮丧'],
+    'surprise': ['surprise', 'surprised', 'astonish', '惊讶', '吃惊', '惊喜'],
+    'anger': ['anger', 'angry', 'furious', '愤怒', '生气', '恼怒'],
+    'fear': ['fear', 'afraid', 'scared', 'anxious', '恐惧', '害怕', '紧张', '焦虑'],
+    'disgust': ['disgust', '厌恶', '反感'],
+    'contempt': ['contempt', '轻蔑', '不屑'],
+    'neutral': ['neutral', 'calm', 'peaceful', '平静', '中性', '放松', '淡定']
+}
+
+def normalize_emotion_label(text: Optional[str]) -> Optional[str]:
+    """将情感文本归一到FER+类别（取文本中最先出现的同义词）"""
+    if not text:
+        return None
+
+    lowered = text.lower()
+    best_label, best_pos = None, None
+    for label, synonyms in EMOTION_SYNONYMS.items():
+        for synonym in synonyms:
+            pos = lowered.find(synonym)
+            if pos != -1 and (best_pos is None or pos < best_pos):
+                best_label, best_pos = label, pos
+    return best_label
+
+class LocalExpressionClassifier:
+    """本地CPU表情分类器（延迟加载）"""
+
+    INPUT_SIZE = 64
+
+    def __init__(self, model_path: str = DEFAULT_MODEL_PATH, labels: Optional[List[str]] = None,
+                 num_threads: int = 1):
+        self.model_path = model_path
+        self.labels = labels or FERPLUS_LABELS
+        # 默认单线程推理，避免与YOLO姿态推理争抢CPU
+        self.num_threads = num_threads
+
+        self._session = None
+        self._input_name = None
+        self._face_detector = None
+        self._load_failed = False
+
+    def _load(self) -> bool:
+        """加载人脸检测器和ONNX模型"""
+        if self._session is not None:
+            return True
+        if self._load_failed:
+            return False
+
+        if not ONNXRUNTIME_AVAILABLE:
+            logger.error("onnxruntime未安装，请运行: pip install onnxruntime")
+            self._load_failed = True
+            return False
+
+        if not os.path.exists(self.model_path):
+            logger.error(f"表情模型文件不存在: {self.model_path}")
+            self._load_failed = True
+            return False
+
+        try:
+            options = ort.SessionOptions()
+            options.intra_op_num_threads = self.num_threads
+            options.inter_op_num_threads = 1
+            self._session = ort.InferenceSession(
+                self.model_path, sess_options=options, providers=['CPUExecutionProvider']
+            )
+            self._input_name = self._session.get_inputs()[0].name
+
+            cascade_path = os.path.join(cv2.data.haarcascades, 'haarcascade_frontalface_default.xml')
+            self._face_detector = cv2.CascadeClassifier(cascade_path)
+
+            logger.info(f"本地表情模型加载成功: {self.model_path}")
+            return True
+        except Exception as e:
+            logger.error(f"本地表情模型加载失败: {e}")
+            self._session = None
+            self._load_failed = True
+            return False
+
+    def is_available(self) -> bool:
+        """本地模型是否可用"""
+        return self._load()
+
+    def _detect_face(self, gray) -> Optional[Tuple[int, int, int, int]]:
+        """检测最大的人脸区域"""
+        faces = self._face_detector.detectMultiScale(gray, scaleFactor=1.2, minNeighbors=5, minSize=(48, 48))
+        if len(faces) == 0:
+            return None
+        return tuple(max(faces, key=lambda f: f[2] * f[3]))
+
+    def _preprocess(self, face_gray) -> np.ndarray:
+        """缩放为模型输入 [1, 1, 64, 64]"""
+        face = cv2.resize(face_gray, (self.INPUT_SIZE, self.INPUT_SIZE), interpolation=cv2.INTER_AREA)
+        return face.astype(np.float32)[np.newaxis, np.newaxis, :, :]
+
+    def classify(self, frame) -> Dict[str, Any]:
+        """
+        识别图像中人物的表情
+
+        Args:
+            frame: OpenCV BGR图像帧
+
+        Returns:
+            包含emotion、confidence、emotion_scores和耗时的结果字典
+        """
+        start_time = time.time()
+
+        if frame is None or not self._load():
+            return {
+                'success': False,
+                'message': '本地表情模型不可用',
+                'emotion': None,
+                'confidence': 0.0,
+                'total_time': round(time.time() - start_time, 4)
+            }
+
+        try:
+            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if frame.ndim == 3 else frame
+            face_box = self._detect_face(gray)
+            if face_box is None:
+                return {
+                    'success': False,
+                    'message': '未检测到人脸',
+                    'emotion': None,
+                    'confidence': 0.0,
+                    'face_detected': False,
+                    'total_time': round(time.time() - start_time, 4)
+                }
+
+            x, y, w, h = face_box
+            logits = self._session.run(None, {self._input_name: self._preprocess(gray[y:y + h, x:x + w])})[0][0]
+
+            # softmax
+            exp_scores = np.exp(logits - np.max(logits))
+            probabilities = exp_scores / exp_scores.sum()
+            best_index = int(np.argmax(probabilities))
+
+            return {
+                'success': True,
+                'message': '本地表情识别完成',
+                'emotion': self.labels[best_index],
+                'confidence': float(probabilities[best_index]),
+                'emotion_scores': {label: round(float(p), 4) for label, p in zip(self.labels, probabilities)},
+                'face_detected': True,
+                'face_box': [int(v) for v in face_box],
+                'total_time': round(time.time() - start_time, 4)
+            }
+
+        except Exception as e:
+            logger.error(f"本地表情识别失败: {e}")
+            return {
+                'success': False,
+                'message': f'本地表情识别失败: {str(e)}',
+                'emotion': None,
+                'confidence': 0.0,
+                'total_time': round(time.time() - start_time, 4)
+            }
@@ -7,17 +7,20 @@ LETDANCE 图像分析工具
 
 import os
 import cv2
+import glob
 import json
 import time
 import base64
+import asyncio
 import logging
+import re
 import numpy as np
 from datetime import datetime
-from typing import Optional, Dict, List, Type, Any
+from typing import Optional, Dict, List, Type, Any, Callable
 
 from langchain_core.tools import BaseTool
 from langchain_core.callbacks import CallbackManagerForToolRun
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, ValidationError, field_validator
 
 try:
     from openai import AzureOpenAI
@@ -26,10 +29,30 @@ except ImportError:
     AZURE_AVAILABLE = False
     logging.warning("Azure OpenAI未安装，图像分析功能将不可用")
 
+try:
+    import httpx
+    from openai import AsyncAzureOpenAI
+    ASYNC_AZURE_AVAILABLE = True
+except ImportError:
+    ASYNC_AZURE_AVAILABLE = False
+
 # 导入图像存储管理器
 from .image_storage_utils import storage_manager
+from .circuit_breaker import get_circuit_breaker, current_latency_budget
+from .capture_control import current_capture_control
+from .expression_model import LocalExpressionClassifier, normalize_emotion_label
 
 # Azure OpenAI配置已直接填入，无需导入config
+AZURE_ENDPOINT = "https://ai-philxia4932ai122623990161.openai.azure.com/"
+AZURE_API_KEY = "ES3vLOAy8MUTMui8udIAk2vZO1Fo7qCBHKlaAvcprOXicYTkjzwbJQQJ99BDACHYHv6XJ3w3AAAAACOG4FT8"
+AZURE_API_VERSION = "2024-02-15-preview"
+AZURE_VISION_MODEL = "gpt-4.1"
+
+# 默认分析提示词
+DEFAULT_ANALYSIS_PROMPT = "请分析这张图片中的人物情感状态，并根据情感推荐合适的音乐风格。包括：1.人物表情和肢体语言分析 2.情感状态判断 3.音乐风格推荐"
+
+# 批量分析支持的图像格式
+BATCH_IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
 
 # 配置日志
 logger = logging.getLogger(__name__)
@@ -50,17 +73,113 @@ def ensure_json_serializable(obj):
     else:
         return str(obj)
 
+class VisionAnalysisResult(BaseModel):
+    """视觉分析结构化结果"""
+    emotion: str = Field(description="人物主要情感，英文小写单词，如 happiness, sadness, neutral, surprise, anger, fear")
+    confidence: float = Field(description="情感判断置信度，0到1之间")
+    expression_cues: List[str] = Field(default_factory=list, description="支持判断的表情/肢体线索，最多5条简短描述")
+    music_keywords: List[str] = Field(default_factory=list, description="推荐的4个英文音乐风格关键词")
+    
+    @field_validator('emotion')
+    @classmethod
+    def _normalize_emotion(cls, value: str) -> str:
+        value = value.strip().lower()
+        if not value:
+            raise ValueError('emotion不能为空')
+        return value
+    
+    @field_validator('confidence')
+    @classmethod
+    def _clamp_confidence(cls, value: float) -> float:
+        return max(0.0, min(1.0, float(value)))
+    
+    @field_validator('expression_cues')
+    @classmethod
+    def _limit_cues(cls, value: List[str]) -> List[str]:
+        return [cue.strip() for cue in value if cue and cue.strip()][:5]
+    
+    @field_validator('music_keywords')
+    @classmethod
+    def _normalize_keywords(cls, value: List[str]) -> List[str]:
+        keywords = []
+        for keyword in value:
+            keyword = keyword.strip().lower()
+            if keyword and keyword not in keywords:
+                keywords.append(keyword)
+        return keywords[:4]
+
+# 结构化输出指令（附加在分析提示词之后）
+STRUCTURED_OUTPUT_INSTRUCTION = (
+    "\n\n请只输出一个JSON对象，不要输出任何其他文字。JSON必须符合以下schema：\n"
+    + json.dumps(VisionAnalysisResult.model_json_schema(), ensure_ascii=False)
+)
+
+def parse_vision_analysis(text: Optional[str]) -> Dict[str, Any]:
+    """
+    解析并校验视觉分析JSON，失败时从文本中推断情感作为兜底
+    
+    Returns:
+        {'structured': dict, 'structured_valid': bool}
+    """
+    if text:
+        candidates = [text]
+        json_match = re.search(r'\{.*\}', text, re.DOTALL)
+        if json_match and json_match.group() != text:
+            candidates.append(json_match.group())
+        
+        for candidate in candidates:
+            try:
+                parsed = VisionAnalysisResult.model_validate_json(candidate)
+                return {'structured': parsed.model_dump(), 'structured_valid': True}
+            except ValidationError:
+                continue
+    
+    logger.warning("视觉分析结果不符合JSON schema，使用文本兜底解析")
+    return {
+        'structured': {
+            'emotion': normalize_emotion_label(text) or 'neutral',
+            'confidence': 0.0,
+            'expression_cues': [],
+            'music_keywords': []
+        },
+        'structured_valid': False
+    }
+
 class ImageAnalysisInput(BaseModel):
     """图像分析工具输入模型"""
     action: str = Field(
-        description="操作类型：'capture_and_analyze'(拍照并分析), 'analyze_file'(分析文件), 'get_summary'(获取汇总)"
+        description="操作类型：'capture_and_analyze'(拍照并分析), 'analyze_file'(分析文件), 'analyze_batch'(批量分析目录), 'get_summary'(获取汇总)"
     )
     image_path: Optional[str] = Field(
         default=None,
-        description="图像文件路径（当action为analyze_file时必需）"
+        description="图像文件路径（当action为analyze_file时必需）；action为analyze_batch时为目录或通配符，如 data/images/image_analysis"
+    )
+    output_path: Optional[str] = Field(
+        default=None,
+        description="批量分析结果JSONL文件路径（analyze_batch使用，已存在时跳过已成功分析的图像）"
+    )
+    max_concurrency: Optional[int] = Field(
+        default=8,
+        description="批量分析最大并发请求数"
+    )
+    stream: Optional[bool] = Field(
+        default=False,
+        description="是否流式返回分析结果（部分文本通过回调实时输出，并记录首token时间）"
+    )
+    structured: Optional[bool] = Field(
+        default=True,
+        description="是否要求模型按JSON schema返回（emotion/confidence/expression_cues/music_keywords）"
+    )
+    backend: Optional[str] = Field(
+        default="azure",
+        description="分析后端：'azure'(GPT视觉分析), 'local'(本地CPU表情模型), 'auto'(先本地，置信度不足时升级到Azure)"
+    )
+    escalation_threshold: Optional[float] = Field(
+        default=0.6,
+        description="auto模式下本地结果置信度低于该值时升级到Azure"
     )
     analysis_prompt: Optional[str] = Field(
-        default="请分析这张图片中的人物情感状态，并根据情感推荐合适的音乐风格。包括：1.人物表情和肢体语言分析 2.情感状态判断 3.音乐风格推荐",
+        default=DEFAULT_ANALYSIS_PROMPT,
         description="自定义分析提示词"
     )
 
@@ -72,12 +191,18 @@ class ImageAnalysisTool(BaseTool):
     图像分析工具，支持以下功能：
     1. 拍照并分析：从摄像头拍照并进行AI分析
     2. 分析文件：分析指定的图像文件
-    3. 获取汇总：获取分析结果汇总
+    3. 批量分析：并发分析目录中的所有图像，结果逐条写入JSONL
+    4. 获取汇总：获取分析结果汇总
     
     使用示例：
     - {"action": "capture_and_analyze"} - 拍照并分析情感
+    - {"action": "capture_and_analyze", "stream": true} - 拍照并流式分析（更快得到首个结果）
+    - {"action": "capture_and_analyze", "backend": "auto"} - 先用本地表情模型，置信度不足再用Azure
     - {"action": "analyze_file", "image_path": "photo.jpg"} - 分析指定文件
+    - {"action": "analyze_batch", "image_path": "data/images/image_analysis"} - 批量分析目录
     - {"action": "get_summary"} - 获取分析汇总
+    
+    默认返回结构化结果 data.structured：emotion、confidence、expression_cues、music_keywords
     """
     args_schema: Type[BaseModel] = ImageAnalysisInput
     # 移除 return_direct，让Agent能够处理工具输出
@@ -88,6 +213,13 @@ class ImageAnalysisTool(BaseTool):
         self._azure_client = None
         self._camera_manager = None
         self._analysis_results = []
+        self._stream_callback = None
+        self._local_classifier = None
+        self._backend_stats = {
+            'local': {'calls': 0, 'successes': 0, 'total_time': 0.0},
+            'azure': {'calls': 0, 'successes': 0, 'total_time': 0.0}
+        }
+        self._agreement_stats = {'compared': 0, 'agreed': 0}
     
     def _get_camera_manager(self):
         """获取摄像头管理器（简化版，直接使用OpenCV）"""
@@ -111,11 +243,7 @@ class ImageAnalysisTool(BaseTool):
                 except ImportError:
                     logger.warning("代理管理器未找到，使用默认网络设置")
                 
-                self._azure_client = AzureOpenAI(
-                    azure_endpoint="https://ai-philxia4932ai122623990161.openai.azure.com/",
-                    api_key="ES3vLOAy8MUTMui8udIAk2vZO1Fo7qCBHKlaAvcprOXicYTkjzwbJQQJ99BDACHYHv6XJ3w3AAAAACOG4FT8",
-                    api_version="2024-02-15-preview"
-                )
+                self._azure_client = AzureOpenAI(**self._azure_client_kwargs())
                 logger.info("Azure OpenAI客户端初始化成功")
             except Exception as e:
                 logger.error(f"Azure OpenAI客户端初始化失败: {e}")
@@ -123,6 +251,14 @@ class ImageAnalysisTool(BaseTool):
         
         return self._azure_client if self._azure_client is not False else None
     
+    def _azure_client_kwargs(self) -> Dict[str, Any]:
+        """Azure OpenAI客户端公共参数（同步和异步客户端共用）"""
+        return {
+            'azure_endpoint': AZURE_ENDPOINT,
+            'api_key': AZURE_API_KEY,
+            'api_version': AZURE_API_VERSION
+        }
+    
     def _capture_photo(self) -> Optional[Dict[str, Any]]:
         """从摄像头拍照并返回图像数据和保存路径（改进版，使用统一的摄像头接口）"""
         import gc
@@ -154,27 +290,7 @@ class ImageAnalysisTool(BaseTool):
                         
                         if ret and frame is not None and frame.size > 0:
                             print(f"✅ 成功从摄像头 {camera_id} 拍照")
-                            
-                            # 将图像编码为字节数据
-                            _, buffer = cv2.imencode('.jpg', frame)
-                            image_data = buffer.tobytes()
-                            
-                            # 保存图像到本地存储
-                            filename = storage_manager.generate_filename("captured_photo", ".jpg")
-                            saved_path = storage_manager.save_image_from_bytes(
-                                image_data, filename, "image_analysis"
-                            )
-                            
-                            if saved_path:
-                                print(f"📁 图像已保存到: {saved_path}")
-                            else:
-                                print("⚠️ 图像保存失败，但继续进行分析")
-                            
-                            return {
-                                'image_data': image_data,
-                                'saved_path': saved_path,
-                                'frame': frame.copy()  # 保留原始帧供后续使用
-                            }
+                            return self._prepare_frame(frame)
                         else:
                             print(f"❌ 摄像头 {camera_id} 无法读取有效数据")
                             
@@ -199,6 +315,33 @@ class ImageAnalysisTool(BaseTool):
             cv2.destroyAllWindows()
             print("📸 拍照完成，摄像头资源已释放")
     
+    def _prepare_frame(self, frame) -> Optional[Dict[str, Any]]:
+        """将摄像头帧编码为JPEG并保存到本地存储"""
+        try:
+            # 将图像编码为字节数据
+            _, buffer = cv2.imencode('.jpg', frame)
+            image_data = buffer.tobytes()
+        except Exception as e:
+            logger.error(f"图像帧编码失败: {e}")
+            return None
+        
+        # 保存图像到本地存储
+        filename = storage_manager.generate_filename("captured_photo", ".jpg")
+        saved_path = storage_manager.save_image_from_bytes(
+            image_data, filename, "image_analysis"
+        )
+        
+        if saved_path:
+            print(f"📁 图像已保存到: {saved_path}")
+        else:
+            print("⚠️ 图像保存失败，但继续进行分析")
+        
+        return {
+            'image_data': image_data,
+            'saved_path': saved_path,
+            'frame': frame.copy()  # 保留原始帧供后续使用
+        }
+    
     def _encode_image_to_base64(self, image_data: bytes) -> Optional[str]:
         """将图像数据编码为base64"""
         try:
@@ -216,8 +359,53 @@ class ImageAnalysisTool(BaseTool):
             logger.error(f"文件编码失败: {e}")
             return None
     
-    def _analyze_image(self, base64_image: str, prompt: str) -> Dict[str, Any]:
-        """使用Azure OpenAI分析图像"""
+    def _build_vision_messages(self, base64_image: str, prompt: str) -> List[Dict[str, Any]]:
+        """构建视觉分析请求消息"""
+        return [
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": prompt},
+                    {
+                        "type": "image_url",
+                        "image_url": {
+                            "url": f"data:image/jpeg;base64,{base64_image}"
+                        }
+                    }
+                ]
+            }
+        ]
+    
+    def set_stream_callback(self, callback: Optional[Callable[[str, str], None]]):
+        """
+        设置流式分析的部分结果回调
+        
+        Args:
+            callback: 回调函数 callback(delta, accumulated_text)，为None时取消回调
+        """
+        self._stream_callback = callback
+    
+    def _vision_request_kwargs(self, base64_image: str, prompt: str, structured: bool) -> Dict[str, Any]:
+        """构建视觉分析请求参数（structured=True时启用JSON输出模式）"""
+        if structured:
+            return {
+                'model': AZURE_VISION_MODEL,
+                'messages': self._build_vision_messages(base64_image, prompt + STRUCTURED_OUTPUT_INSTRUCTION),
+                'max_tokens': 400,
+                'temperature': 0.3,
+                'response_format': {'type': 'json_object'}
+            }
+        return {
+            'model': AZURE_VISION_MODEL,
+            'messages': self._build_vision_messages(base64_image, prompt),
+            'max_tokens': 1000,
+            'temperature': 0.7
+        }
+    
+    def _analyze_image(self, base64_image: str, prompt: str, stream: bool = False,
+                       on_partial: Optional[Callable[[str, str], None]] = None,
+                       structured: bool = True) -> Dict[str, Any]:
+        """使用Azure OpenAI分析图像（stream=True时逐段返回文本并记录首token时间）"""
         azure_client = self._get_azure_client()
         if not azure_client:
             return {
@@ -226,53 +414,207 @@ class ImageAnalysisTool(BaseTool):
                 'analysis': None
             }
         
+        # 熔断器打开或本轮预算耗尽时直接短路，不再等待Azure超时
+        breaker = get_circuit_breaker('azure')
+        budget = current_latency_budget()
+        if (budget is not None and budget.expired()) or not breaker.allow_request('vision'):
+            return {
+                'success': False,
+                'message': 'Azure调用已熔断或超出本轮延迟预算，跳过图像分析',
+                'analysis': None,
+                'short_circuited': True
+            }
+        
+        # 有预算时按剩余时间设置超时，并由熔断器代替库内重试
+        if budget is not None:
+            azure_client = azure_client.with_options(timeout=max(budget.remaining(), 1.0), max_retries=0)
+        
+        start_time = time.time()
+        time_to_first_token = None
+        
         try:
             response = azure_client.chat.completions.create(
-                model="gpt-4.1",
-                messages=[
-                    {
-                        "role": "user",
-                        "content": [
-                            {"type": "text", "text": prompt},
-                            {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": f"data:image/jpeg;base64,{base64_image}"
-                                }
-                            }
-                        ]
-                    }
-                ],
-                max_tokens=1000,
-                temperature=0.7
+                **self._vision_request_kwargs(base64_image, prompt, structured),
+                stream=stream
             )
             
-            analysis_result = response.choices[0].message.content
+            if stream:
+                parts = []
+                for chunk in response:
+                    # Azure的首个分块可能只包含内容过滤信息
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta.content
+                    if not delta:
+                        continue
+                    if time_to_first_token is None:
+                        time_to_first_token = time.time() - start_time
+                    parts.append(delta)
+                    if on_partial:
+                        try:
+                            on_partial(delta, ''.join(parts))
+                        except Exception as e:
+                            logger.warning(f"流式回调异常: {e}")
+                analysis_result = ''.join(parts)
+            else:
+                analysis_result = response.choices[0].message.content
+            
+            # 流式响应不返回token用量
+            usage = None
+            if not stream and getattr(response, 'usage', None):
+                usage = {
+                    'prompt_tokens': response.usage.prompt_tokens,
+                    'completion_tokens': response.usage.completion_tokens,
+                    'total_tokens': response.usage.total_tokens
+                }
+            
+            breaker.record_success('vision', time.time() - start_time)
             
             result = {
                 'success': True,
                 'message': '图像分析完成',
                 'analysis': analysis_result,
                 'timestamp': datetime.now().isoformat(),
-                'prompt_used': prompt
+                'prompt_used': prompt,
+                'streamed': stream,
+                'time_to_first_token': round(time_to_first_token, 3) if time_to_first_token is not None else None,
+                'total_time': round(time.time() - start_time, 3),
+                'usage': usage
             }
             
+            if structured:
+                result.update(parse_vision_analysis(analysis_result))
+            
             return result
             
         except Exception as e:
+            breaker.record_failure('vision', time.time() - start_time)
             logger.error(f"图像分析失败: {e}")
             return {
                 'success': False,
                 'message': f'分析失败: {str(e)}',
+                'analysis': None,
+                'total_time': round(time.time() - start_time, 3)
+            }
+    
+    def _get_local_classifier(self) -> LocalExpressionClassifier:
+        """获取本地表情分类器（延迟加载）"""
+        if self._local_classifier is None:
+            self._local_classifier = LocalExpressionClassifier()
+        return self._local_classifier
+    
+    def _analyze_local(self, frame) -> Dict[str, Any]:
+        """使用本地CPU表情模型分析图像"""
+        local_result = self._get_local_classifier().classify(frame)
+        
+        result = {
+            'success': local_result['success'],
+            'message': local_result['message'],
+            'analysis': None,
+            'emotion': local_result.get('emotion'),
+            'confidence': local_result.get('confidence', 0.0),
+            'emotion_scores': local_result.get('emotion_scores'),
+            'backend': 'local',
+            'timestamp': datetime.now().isoformat(),
+            'total_time': local_result['total_time']
+        }
+        if result['success']:
+            result['analysis'] = f"本地表情识别: {result['emotion']}（置信度 {result['confidence']:.2f}）"
+            result['structured'] = {
+                'emotion': result['emotion'],
+                'confidence': result['confidence'],
+                'expression_cues': [],
+                'music_keywords': []
+            }
+            result['structured_valid'] = True
+        
+        return result
+    
+    def _record_backend_stats(self, backend: str, result: Dict[str, Any]):
+        """记录各后端的调用次数与耗时"""
+        stats = self._backend_stats[backend]
+        stats['calls'] += 1
+        if result.get('success'):
+            stats['successes'] += 1
+        stats['total_time'] += result.get('total_time') or 0.0
+    
+    def _record_agreement(self, local_emotion: str, azure_result: Dict[str, Any]):
+        """记录本地与Azure结果的一致性"""
+        structured = azure_result.get('structured') or {}
+        azure_emotion = normalize_emotion_label(structured.get('emotion') or azure_result.get('analysis'))
+        if not azure_emotion:
+            return
+        
+        self._agreement_stats['compared'] += 1
+        if azure_emotion == local_emotion:
+            self._agreement_stats['agreed'] += 1
+        azure_result['agrees_with_local'] = azure_emotion == local_emotion
+    
+    def _analyze_with_backend(self, base64_image: str, frame, prompt: str, stream: bool = False,
+                              backend: str = 'azure', escalation_threshold: float = 0.6,
+                              structured: bool = True) -> Dict[str, Any]:
+        """按指定后端分析图像（auto模式下本地置信度不足时升级到Azure）"""
+        if backend not in ('azure', 'local', 'auto'):
+            return {
+                'success': False,
+                'message': f'不支持的分析后端: {backend}',
                 'analysis': None
             }
+        
+        if backend == 'azure':
+            result = self._analyze_image(base64_image, prompt, stream, self._stream_callback, structured)
+            result['backend'] = 'azure'
+            self._record_backend_stats('azure', result)
+            return result
+        
+        local_result = self._analyze_local(frame)
+        self._record_backend_stats('local', local_result)
+        
+        if backend == 'local':
+            return local_result
+        
+        if local_result['success'] and local_result['confidence'] >= escalation_threshold:
+            return local_result
+        
+        print(f"⬆️ 本地表情识别置信度不足（{local_result.get('confidence', 0.0):.2f}），升级到Azure分析")
+        azure_result = self._analyze_image(base64_image, prompt, stream, self._stream_callback, structured)
+        azure_result['backend'] = 'azure'
+        azure_result['escalated'] = True
+        azure_result['local_result'] = {
+            'emotion': local_result.get('emotion'),
+            'confidence': local_result.get('confidence'),
+            'total_time': local_result.get('total_time')
+        }
+        self._record_backend_stats('azure', azure_result)
+        
+        if local_result['success'] and azure_result['success']:
+            self._record_agreement(local_result['emotion'], azure_result)
+        
+        # Azure不可用时仍返回低置信度的本地结果，总比没有好
+        if not azure_result['success'] and local_result['success']:
+            local_result['escalation_failed'] = True
+            return local_result
+        
+        return azure_result
     
-    def _capture_and_analyze(self, prompt: str) -> Dict[str, Any]:
+    def _capture_and_analyze(self, prompt: str, stream: bool = False, backend: str = 'azure',
+                             escalation_threshold: float = 0.6, structured: bool = True) -> Dict[str, Any]:
         """拍照并分析（改进版）"""
         print("🔍 开始图像分析：拍照 -> 保存 -> 编码 -> AI分析")
         
-        # 拍照（内部已包含资源管理和本地保存）
-        capture_result = self._capture_photo()
+        # 拍照（内部已包含资源管理和本地保存）；轮次已停止时不再打开摄像头
+        control = current_capture_control()
+        if control is not None and not control.acquire():
+            return {
+                'success': False,
+                'message': '本轮分析已停止，不再打开摄像头',
+                'data': None
+            }
+        try:
+            capture_result = self._capture_photo()
+        finally:
+            if control is not None:
+                control.release()
         if not capture_result:
             return {
                 'success': False,
@@ -280,6 +622,31 @@ class ImageAnalysisTool(BaseTool):
                 'data': None
             }
         
+        return self._analyze_capture(capture_result, prompt, stream, backend, escalation_threshold, structured)
+    
+    def analyze_frame(self, frame, prompt: str = DEFAULT_ANALYSIS_PROMPT, stream: bool = False,
+                      backend: str = 'azure', escalation_threshold: float = 0.6,
+                      structured: bool = True) -> Dict[str, Any]:
+        """
+        分析已经采集到的摄像头帧（不再单独打开摄像头）
+        
+        用于与姿态分析共用同一个摄像头流：姿态分析把首帧交给本方法，
+        视觉分析在后台线程中与剩余的姿态采集并发进行。
+        """
+        capture_result = self._prepare_frame(frame)
+        if not capture_result:
+            return {
+                'success': False,
+                'message': '图像帧编码失败',
+                'data': None
+            }
+        
+        result = self._analyze_capture(capture_result, prompt, stream, backend, escalation_threshold, structured)
+        return ensure_json_serializable(result)
+    
+    def _analyze_capture(self, capture_result: Dict[str, Any], prompt: str, stream: bool, backend: str,
+                         escalation_threshold: float, structured: bool) -> Dict[str, Any]:
+        """分析拍到的图像（编码 -> 后端分析 -> 记录结果）"""
         # 编码图像
         base64_image = self._encode_image_to_base64(capture_result['image_data'])
         if not base64_image:
@@ -292,7 +659,9 @@ class ImageAnalysisTool(BaseTool):
         print("🤖 正在进行AI图像分析...")
         
         # 分析图像
-        result = self._analyze_image(base64_image, prompt)
+        result = self._analyze_with_backend(
+            base64_image, capture_result['frame'], prompt, stream, backend, escalation_threshold, structured
+        )
         
         # 添加保存的图像路径信息
         if result['success']:
@@ -310,7 +679,8 @@ class ImageAnalysisTool(BaseTool):
             'saved_image_path': capture_result['saved_path']
         }
     
-    def _analyze_file(self, image_path: str, prompt: str) -> Dict[str, Any]:
+    def _analyze_file(self, image_path: str, prompt: str, stream: bool = False, backend: str = 'azure',
+                      escalation_threshold: float = 0.6, structured: bool = True) -> Dict[str, Any]:
         """分析指定图像文件"""
         if not os.path.exists(image_path):
             return {
@@ -328,8 +698,13 @@ class ImageAnalysisTool(BaseTool):
                 'data': None
             }
         
+        # 本地后端需要解码后的图像帧
+        frame = cv2.imread(image_path) if backend != 'azure' else None
+        
         # 分析图像
-        result = self._analyze_image(base64_image, prompt)
+        result = self._analyze_with_backend(
+            base64_image, frame, prompt, stream, backend, escalation_threshold, structured
+        )
         result['image_path'] = image_path
         
         if result['success']:
@@ -341,6 +716,166 @@ class ImageAnalysisTool(BaseTool):
             'data': result
         }
     
+    def _collect_batch_images(self, image_source: str) -> List[str]:
+        """收集批量分析的图像路径（支持目录或通配符）"""
+        if os.path.isdir(image_source):
+            pattern = os.path.join(image_source, '*')
+        else:
+            pattern = image_source
+
+        return sorted(
+            path for path in glob.glob(pattern, recursive=True)
+            if os.path.isfile(path) and path.lower().endswith(BATCH_IMAGE_EXTENSIONS)
+        )
+
+    def _load_completed_paths(self, output_path: str) -> set:
+        """读取已有JSONL结果，返回已成功分析的图像路径（用于中断后续跑）"""
+        completed = set()
+        if not os.path.exists(output_path):
+            return completed
+
+        with open(output_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # 崩溃时可能留下不完整的最后一行，直接忽略
+                    continue
+                if record.get('success') and record.get('image_path'):
+                    completed.add(record['image_path'])
+
+        return completed
+
+    async def _analyze_image_async(self, client, base64_image: str, prompt: str,
+                                   structured: bool = True) -> Dict[str, Any]:
+        """使用异步Azure OpenAI客户端分析图像"""
+        start_time = time.time()
+        try:
+            response = await client.chat.completions.create(
+                **self._vision_request_kwargs(base64_image, prompt, structured)
+            )
+
+            result = {
+                'success': True,
+                'message': '图像分析完成',
+                'analysis': response.choices[0].message.content,
+                'timestamp': datetime.now().isoformat(),
+                'prompt_used': prompt,
+                'total_time': round(time.time() - start_time, 3)
+            }
+            if structured:
+                result.update(parse_vision_analysis(result['analysis']))
+            return result
+
+        except Exception as e:
+            logger.error(f"图像分析失败: {e}")
+            return {
+                'success': False,
+                'message': f'分析失败: {str(e)}',
+                'analysis': None,
+                'total_time': round(time.time() - start_time, 3)
+            }
+
+    async def _run_batch(self, image_paths: List[str], prompt: str, output_path: str,
+                         max_concurrency: int, structured: bool = True) -> Dict[str, int]:
+        """并发执行批量分析，每完成一张立即写入JSONL"""
+        semaphore = asyncio.Semaphore(max_concurrency)
+        counts = {'successful': 0, 'failed': 0}
+
+        # 所有请求共用一个有界连接池
+        limits = httpx.Limits(
+            max_connections=max_concurrency,
+            max_keepalive_connections=max_concurrency
+        )
+        async with httpx.AsyncClient(limits=limits, timeout=httpx.Timeout(60.0, connect=10.0)) as http_client:
+            client = AsyncAzureOpenAI(**self._azure_client_kwargs(), http_client=http_client)
+
+            with open(output_path, 'a', encoding='utf-8') as output_file:
+
+                async def analyze_one(image_path: str):
+                    async with semaphore:
+                        base64_image = await asyncio.to_thread(self._encode_file_to_base64, image_path)
+                        if base64_image:
+                            result = await self._analyze_image_async(client, base64_image, prompt, structured)
+                        else:
+                            result = {
+                                'success': False,
+                                'message': '图像文件编码失败',
+                                'analysis': None
+                            }
+
+                    result['image_path'] = image_path
+                    counts['successful' if result['success'] else 'failed'] += 1
+
+                    # 逐条写入并落盘，崩溃时已完成的结果不会丢失
+                    output_file.write(json.dumps(ensure_json_serializable(result), ensure_ascii=False) + '\n')
+                    output_file.flush()
+                    os.fsync(output_file.fileno())
+
+                await asyncio.gather(*(analyze_one(path) for path in image_paths))
+
+        return counts
+
+    def _analyze_batch(self, image_source: str, prompt: str, output_path: Optional[str] = None,
+                       max_concurrency: int = 8, structured: bool = True) -> Dict[str, Any]:
+        """批量分析目录或通配符匹配的图像文件"""
+        if not ASYNC_AZURE_AVAILABLE:
+            return {
+                'success': False,
+                'message': '异步Azure OpenAI客户端不可用，请安装openai和httpx',
+                'data': None
+            }
+
+        image_paths = self._collect_batch_images(image_source)
+        if not image_paths:
+            return {
+                'success': False,
+                'message': f'未找到可分析的图像: {image_source}',
+                'data': None
+            }
+
+        if not output_path:
+            output_path = os.path.join(
+                storage_manager.base_dir,
+                storage_manager.generate_filename("batch_analysis", ".jsonl")
+            )
+        output_dir = os.path.dirname(output_path)
+        if output_dir:
+            os.makedirs(output_dir, exist_ok=True)
+
+        completed = self._load_completed_paths(output_path)
+        pending = [path for path in image_paths if path not in completed]
+        max_concurrency = max(1, max_concurrency or 1)
+
+        print(f"🗂️ 批量分析: 共{len(image_paths)}张，跳过已完成{len(image_paths) - len(pending)}张，并发{max_concurrency}")
+
+        start_time = time.time()
+        counts = {'successful': 0, 'failed': 0}
+        if pending:
+            counts = asyncio.run(self._run_batch(pending, prompt, output_path, max_concurrency, structured))
+        elapsed = time.time() - start_time
+
+        summary = {
+            'image_source': image_source,
+            'output_path': output_path,
+            'total_images': len(image_paths),
+            'skipped': len(image_paths) - len(pending),
+            'processed': len(pending),
+            'successful': counts['successful'],
+            'failed': counts['failed'],
+            'elapsed_seconds': round(elapsed, 2),
+            'images_per_second': round(len(pending) / elapsed, 2) if elapsed > 0 else None,
+            'max_concurrency': max_concurrency
+        }
+
+        print(f"✅ 批量分析完成: 成功{counts['successful']}，失败{counts['failed']}，结果: {output_path}")
+
+        return {
+            'success': counts['failed'] == 0,
+            'message': '批量分析完成' if counts['failed'] == 0 else f"批量分析完成，{counts['failed']}张失败",
+            'data': summary
+        }
+
     def _get_analysis_summary(self) -> Dict[str, Any]:
         """获取分析汇总"""
         successful = len([r for r in self._analysis_results if r.get('success', False)])
@@ -357,14 +892,39 @@ class ImageAnalysisTool(BaseTool):
             'failed': failed,
             'latest_analysis': latest_analysis,
             'camera_available': self._get_camera_manager() is not None,
-            'azure_client_available': self._get_azure_client() is not None
+            'azure_client_available': self._get_azure_client() is not None,
+            'backend_stats': self._get_backend_stats()
+        }
+    
+    def _get_backend_stats(self) -> Dict[str, Any]:
+        """获取各后端的延迟与一致率统计"""
+        stats = {}
+        for backend, data in self._backend_stats.items():
+            stats[backend] = {
+                'calls': data['calls'],
+                'successes': data['successes'],
+                'avg_latency': round(data['total_time'] / data['calls'], 4) if data['calls'] else None
+            }
+        
+        compared = self._agreement_stats['compared']
+        stats['agreement'] = {
+            'compared': compared,
+            'agreed': self._agreement_stats['agreed'],
+            'agreement_rate': round(self._agreement_stats['agreed'] / compared, 3) if compared else None
         }
+        return stats
     
     def _run(
         self,
         action: str,
         image_path: Optional[str] = None,
-        analysis_prompt: str = "请分析这张图片中的人物情感状态，并根据情感推荐合适的音乐风格。包括：1.人物表情和肢体语言分析 2.情感状态判断 3.音乐风格推荐",
+        output_path: Optional[str] = None,
+        max_concurrency: int = 8,
+        stream: bool = False,
+        structured: bool = True,
+        backend: str = "azure",
+        escalation_threshold: float = 0.6,
+        analysis_prompt: str = DEFAULT_ANALYSIS_PROMPT,
         run_manager: Optional[CallbackManagerForToolRun] = None,
     ) -> Dict[str, Any]:
         """执行工具操作"""
@@ -372,7 +932,9 @@ class ImageAnalysisTool(BaseTool):
             logger.info(f"执行图像分析操作: {action}")
             
             if action == "capture_and_analyze":
-                result = self._capture_and_analyze(analysis_prompt)
+                result = self._capture_and_analyze(
+                    analysis_prompt, stream, backend, escalation_threshold, structured
+                )
                 
             elif action == "analyze_file":
                 if not image_path:
@@ -382,7 +944,21 @@ class ImageAnalysisTool(BaseTool):
                         'data': None
                     }
                 
-                result = self._analyze_file(image_path, analysis_prompt)
+                result = self._analyze_file(
+                    image_path, analysis_prompt, stream, backend, escalation_threshold, structured
+                )
+                
+            elif action == "analyze_batch":
+                if not image_path:
+                    return {
+                        'success': False,
+                        'message': '缺少image_path参数（目录或通配符）',
+                        'data': None
+                    }
+                
+                result = self._analyze_batch(
+                    image_path, analysis_prompt, output_path, max_concurrency, structured
+                )
                 
             elif action == "get_summary":
                 summary = self._get_analysis_summary()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+LETDANCE 音乐关键词提交工具
+Agent的最后一步：以结构化参数提交4个音乐风格关键词，并按词表校验
+"""
+
+import logging
+from typing import Optional, Dict, List, Type, Any
+
+from langchain_core.tools import BaseTool
+from langchain_core.callbacks import CallbackManagerForToolRun
+from pydantic import BaseModel, Field, ValidationError, field_validator
+
+# 配置日志
+logger = logging.getLogger(__name__)
+
+# 音乐关键词词表，按投影情绪主题分组（投影系统的EmotionMapper使用同一份分组）
+MUSIC_KEYWORD_THEMES = {
+    # 主题1: 快乐/兴奋类
+    'theme1': ['energetic', 'upbeat', 'cheerful', 'joyful', 'vibrant', 'lively', 'happy', 'excited', 'bright', 'dynamic'],
+    # 主题2: 平静/舒缓类
+    'theme2': ['ambient', 'calm', 'peaceful', 'relaxing', 'gentle', 'serene', 'soft', 'soothing', 'tranquil', 'mellow'],
+    # 主题3: 忧郁/深沉类
+    'theme3': ['melancholic', 'contemplative', 'introspective', 'emotional', 'sad', 'thoughtful', 'moody', 'nostalgic', 'brooding', 'reflective'],
+    # 主题4: 强烈/激情类
+    'theme4': ['intense', 'powerful', 'dramatic', 'epic', 'strong', 'aggressive', 'passionate', 'bold', 'fierce', 'energizing']
+}
+
+MUSIC_KEYWORD_VOCABULARY = [keyword for keywords in MUSIC_KEYWORD_THEMES.values() for keyword in keywords]
+
+class MusicKeywordsInput(BaseModel):
+    """音乐关键词提交输入模型"""
+    keywords: List[str] = Field(
+        description=f"4个英文音乐风格关键词，只能从以下词表中选择: {', '.join(MUSIC_KEYWORD_VOCABULARY)}"
+    )
+
+class MusicKeywords(MusicKeywordsInput):
+    """校验后的音乐关键词（小写、去重、只保留词表内的词，最多4个）"""
+
+    @field_validator('keywords')
+    @classmethod
+    def validate_vocabulary(cls, value: List[str]) -> List[str]:
+        keywords = []
+        for keyword in value:
+            keyword = str(keyword).strip().lower()
+            if keyword in MUSIC_KEYWORD_VOCABULARY and keyword not in keywords:
+                keywords.append(keyword)
+
+        if not keywords:
+            raise ValueError(f"没有任何关键词在词表中: {value}")
+        return keywords[:4]
+
+def validate_music_keywords(keywords: List[str]) -> Optional[List[str]]:
+    """按词表校验关键词，全部无效时返回None"""
+    try:
+        return MusicKeywords(keywords=keywords).keywords
+    except ValidationError:
+        return None
+
+class SubmitMusicKeywordsTool(BaseTool):
+    """LangChain音乐关键词提交工具"""
+
+    name: str = "submit_music_keywords"
+    description: str = """
+    提交最终的音乐风格关键词（分析流程的最后一步，调用后流程立即结束）。
+    在图像分析和姿态分析都完成后，综合两者结果调用本工具。
+
+    使用示例：
+    - {"keywords": ["ambient", "emotional", "gentle", "reflective"]}
+    """
+    args_schema: Type[BaseModel] = MusicKeywordsInput
+    # 工具结果直接作为Agent的最终输出，省去Agent再总结一次的LLM调用
+    return_direct: bool = True
+
+    def _run(
+        self,
+        keywords: List[str],
+        run_manager: Optional[CallbackManagerForToolRun] = None,
+    ) -> Dict[str, Any]:
+        """校验并返回关键词"""
+        valid_keywords = validate_music_keywords(keywords)
+        if valid_keywords is None:
+            logger.warning(f"提交的关键词均不在词表中: {keywords}")
+            return {
+                'success': False,
+                'message': f'关键词均不在词表中: {keywords}',
+                'music_keywords': []
+            }
+
+        if len(valid_keywords) < len(keywords):
+            logger.info(f"已过滤词表外的关键词: {keywords} -> {valid_keywords}")
+
+        return {
+            'success': True,
+            'message': '音乐关键词提交成功',
+            'music_keywords': valid_keywords
+        }
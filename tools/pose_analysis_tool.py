@@ -10,10 +10,11 @@ import cv2
 import json
 import math
 import logging
+import threading
 import numpy as np
 from datetime import datetime
 from collections import deque
-from typing import Optional, Dict, List, Type, Any
+from typing import Optional, Dict, List, Type, Any, Callable
 
 from langchain_core.tools import BaseTool
 from langchain_core.callbacks import CallbackManagerForToolRun
@@ -28,6 +29,7 @@ except ImportError:
 
 # 导入图像存储管理器
 from .image_storage_utils import storage_manager
+from .capture_control import current_capture_control
 
 # 配置已直接填入，无需导入config
 
@@ -541,18 +543,29 @@ class PoseAnalysisTool(BaseTool):
         return frame
     
     def _analyze_realtime(self, duration: int, confidence_threshold: float, 
-                         save_frames: bool = True, save_interval: int = 30) -> Dict[str, Any]:
-        """实时姿态分析 - 改进版，处理摄像头资源冲突"""
+                         save_frames: bool = True, save_interval: int = 30,
+                         frame_callback: Optional[Callable] = None,
+                         release_wait: float = 2.0,
+                         stop_event: Optional[threading.Event] = None) -> Dict[str, Any]:
+        """
+        实时姿态分析 - 改进版，处理摄像头资源冲突
+        
+        Args:
+            frame_callback: 读到第一帧有效画面时回调（传入帧副本），供图像分析共用摄像头流
+            release_wait: 打开摄像头前等待其他程序释放资源的时间（秒）
+            stop_event: 被设置时提前结束采集，用已采集的帧汇总结果（协作式取消）
+        """
         import time
         import gc
         
         print(f"🎯 开始{duration}秒实时姿态分析...")
         
         # 强制释放可能占用的摄像头资源
-        print("⏳ 等待摄像头资源完全释放...")
         gc.collect()  # 垃圾回收
         cv2.destroyAllWindows()  # 关闭所有OpenCV窗口
-        time.sleep(2)  # 增加等待时间，确保资源释放
+        if release_wait > 0:
+            print("⏳ 等待摄像头资源完全释放...")
+            time.sleep(release_wait)  # 增加等待时间，确保资源释放
         
         # 检测可用摄像头
         available_cameras = self._detect_available_cameras()
@@ -608,6 +621,10 @@ class PoseAnalysisTool(BaseTool):
             print("🎬 开始实时姿态分析...")
             
             while (time.time() - start_time) < duration:
+                if stop_event is not None and stop_event.is_set():
+                    print("⏹️ 收到停止信号，提前结束姿态采集")
+                    break
+                
                 ret, frame = cap.read()
                 if not ret or frame is None:
                     consecutive_failures += 1
@@ -621,6 +638,13 @@ class PoseAnalysisTool(BaseTool):
                 consecutive_failures = 0  # 重置失败计数
                 frame_count += 1
                 
+                # 首帧交给回调（如图像分析），回调应尽快返回，不阻塞姿态采集
+                if frame_callback is not None and frame_count == 1:
+                    try:
+                        frame_callback(frame.copy())
+                    except Exception as e:
+                        logger.error(f"帧回调执行失败: {e}")
+                
                 # 检测姿态
                 keypoints = self._detect_pose(frame, confidence_threshold)
                 if keypoints is None:
@@ -789,6 +813,45 @@ class PoseAnalysisTool(BaseTool):
             'raw_qualities': laban
         }
 
+    def analyze_realtime(self, duration: int = 10, confidence_threshold: float = 0.5,
+                         model_path: str = "yolov8n-pose.pt", save_frames: bool = True,
+                         save_interval: int = 30, frame_callback: Optional[Callable] = None,
+                         release_wait: float = 2.0,
+                         stop_event: Optional[threading.Event] = None) -> Dict[str, Any]:
+        """
+        加载模型并执行实时姿态分析
+        
+        与图像分析组合使用时传入frame_callback和release_wait=0：
+        摄像头只打开一次，首帧交给图像分析，姿态采集立即开始。
+        """
+        # 检查YOLO可用性
+        if not YOLO_AVAILABLE:
+            return {
+                'success': False,
+                'message': 'YOLO未安装，请运行: pip install ultralytics',
+                'data': None,
+                'laban_analysis': None
+            }
+        
+        # 加载模型
+        if not self._load_model(model_path):
+            return {
+                'success': False,
+                'message': f'无法加载YOLO模型: {model_path}',
+                'data': None,
+                'laban_analysis': None
+            }
+        
+        result = self._analyze_realtime(
+            duration, confidence_threshold, save_frames, save_interval, frame_callback, release_wait, stop_event
+        )
+        
+        # 如果分析成功，添加拉班分析数据到顶层
+        if result['success'] and result['data']:
+            result['laban_analysis'] = self._format_laban_analysis_dict(result['data'])
+        
+        return result
+    
     def _run(
         self,
         action: str,
@@ -804,31 +867,26 @@ class PoseAnalysisTool(BaseTool):
             logger.info(f"执行姿态分析操作: {action}")
             
             if action == "analyze_realtime":
-                # 检查YOLO可用性
-                if not YOLO_AVAILABLE:
-                    return {
-                        'success': False,
-                        'message': 'YOLO未安装，请运行: pip install ultralytics',
-                        'data': None,
-                        'laban_analysis': None
-                    }
-                
-                # 加载模型
-                if not self._load_model(model_path):
+                # 轮次被取消或超时时，采集控制通知姿态采集提前结束
+                control = current_capture_control()
+                if control is None:
+                    return self.analyze_realtime(
+                        duration, confidence_threshold, model_path, save_frames, save_interval
+                    )
+                if not control.acquire():
                     return {
                         'success': False,
-                        'message': f'无法加载YOLO模型: {model_path}',
+                        'message': '本轮分析已停止，不再打开摄像头',
                         'data': None,
                         'laban_analysis': None
                     }
-                
-                result = self._analyze_realtime(duration, confidence_threshold, save_frames, save_interval)
-                
-                # 如果分析成功，添加拉班分析数据到顶层
-                if result['success'] and result['data']:
-                    result['laban_analysis'] = self._format_laban_analysis_dict(result['data'])
-                
-                return result
+                try:
+                    return self.analyze_realtime(
+                        duration, confidence_threshold, model_path, save_frames, save_interval,
+                        stop_event=control.stop_event
+                    )
+                finally:
+                    control.release()
                 
             elif action == "get_summary":
                 summary = self._get_analysis_summary()
@@ -11,6 +11,7 @@ from langchain_core.tools import BaseTool
 
 from .image_analysis_tool import ImageAnalysisTool
 from .pose_analysis_tool import PoseAnalysisTool
+from .music_keywords_tool import SubmitMusicKeywordsTool
 
 # 配置日志
 logger = logging.getLogger(__name__)
@@ -33,6 +34,10 @@ class ToolRegistry:
             self._tools['pose_analysis'] = PoseAnalysisTool()
             logger.info("姿态分析工具注册成功")
             
+            # 音乐关键词提交工具（Agent的最后一步）
+            self._tools['submit_music_keywords'] = SubmitMusicKeywordsTool()
+            logger.info("音乐关键词提交工具注册成功")
+            
         except Exception as e:
             logger.error(f"工具初始化失败: {e}")
     
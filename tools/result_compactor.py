@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+LETDANCE 工具结果压缩
+为Agent上下文生成工具结果的精简投影：只保留摘要字段、数值保留两位小数，
+完整结果仍保留在intermediate_steps中供程序使用
+"""
+
+import json
+import logging
+import threading
+import contextvars
+from typing import Dict, Any, List, Optional, Sequence, Tuple
+
+from langchain.agents.format_scratchpad.tools import format_to_tool_messages
+
+try:
+    import tiktoken
+    TIKTOKEN_AVAILABLE = True
+except ImportError:
+    TIKTOKEN_AVAILABLE = False
+
+# 配置日志
+logger = logging.getLogger(__name__)
+
+# 精简投影中的长度限制
+MAX_TEXT_LENGTH = 300
+MAX_LIST_ITEMS = 5
+
+def _round_numbers(obj, digits: int = 2):
+    """递归地将浮点数保留指定位数"""
+    if isinstance(obj, float):
+        return round(obj, digits)
+    if isinstance(obj, dict):
+        return {k: _round_numbers(v, digits) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [_round_numbers(item, digits) for item in obj]
+    return obj
+
+def _truncate(text: Optional[str], limit: int = MAX_TEXT_LENGTH) -> Optional[str]:
+    if not text or len(text) <= limit:
+        return text
+    return text[:limit] + '…'
+
+def compact_image_result(result: Dict[str, Any]) -> Dict[str, Any]:
+    """图像分析结果的精简投影"""
+    compact = {'success': result.get('success'), 'message': result.get('message')}
+    data = result.get('data') or {}
+    if not isinstance(data, dict):
+        return compact
+
+    structured = data.get('structured')
+    if structured:
+        compact.update({
+            'emotion': structured.get('emotion'),
+            'confidence': structured.get('confidence'),
+            'expression_cues': (structured.get('expression_cues') or [])[:MAX_LIST_ITEMS],
+            'music_keywords': structured.get('music_keywords') or []
+        })
+    elif data.get('emotion'):
+        # 本地表情模型结果
+        compact.update({'emotion': data.get('emotion'), 'confidence': data.get('confidence')})
+    else:
+        compact['analysis'] = _truncate(data.get('analysis'))
+
+    if data.get('backend'):
+        compact['backend'] = data['backend']
+    if data.get('short_circuited'):
+        compact['short_circuited'] = True
+
+    return _round_numbers(compact)
+
+def compact_pose_result(result: Dict[str, Any]) -> Dict[str, Any]:
+    """姿态分析结果的精简投影（去掉逐帧结果和保存路径）"""
+    compact = {'success': result.get('success'), 'message': result.get('message')}
+    data = result.get('data') or {}
+    if not isinstance(data, dict):
+        return compact
+
+    compact.update({
+        'dominant_emotion': data.get('dominant_emotion'),
+        'emotion_distribution': data.get('emotion_distribution'),
+        'average_laban_qualities': data.get('average_laban_qualities'),
+        'valid_analyses': data.get('valid_analyses'),
+        'duration_seconds': data.get('duration_seconds')
+    })
+    return _round_numbers({k: v for k, v in compact.items() if v is not None})
+
+def compact_generic_result(obj, depth: int = 0):
+    """未知工具结果的通用精简：截断长文本和长列表，数值保留两位小数"""
+    if isinstance(obj, str):
+        return _truncate(obj)
+    if isinstance(obj, float):
+        return round(obj, 2)
+    if isinstance(obj, list):
+        return [compact_generic_result(item, depth + 1) for item in obj[:MAX_LIST_ITEMS]]
+    if isinstance(obj, dict):
+        if depth >= 3:
+            return '…'
+        return {k: compact_generic_result(v, depth + 1) for k, v in obj.items()}
+    return obj
+
+# 工具名称 -> 精简投影函数
+COMPACTORS = {
+    'image_analysis': compact_image_result,
+    'pose_analysis': compact_pose_result
+}
+
+def compact_tool_result(tool_name: str, result: Any) -> Any:
+    """获取工具结果的LLM精简投影"""
+    if not isinstance(result, dict):
+        return result
+
+    compactor = COMPACTORS.get(tool_name, compact_generic_result)
+    try:
+        return compactor(result)
+    except Exception as e:
+        logger.warning(f"工具结果压缩失败，使用原始结果: {e}")
+        return result
+
+class ToolResultCompactor:
+    """
+    Agent的消息格式化器：把intermediate_steps中的工具结果替换为精简投影后再写入scratchpad
+
+    Agent每次迭代都会重新格式化全部历史步骤，因此按格式化次数累计的差值就是节省的prompt token数
+    """
+
+    def __init__(self, encoding_name: str = 'o200k_base'):
+        self._encoding = None
+        if TIKTOKEN_AVAILABLE:
+            try:
+                self._encoding = tiktoken.get_encoding(encoding_name)
+            except Exception as e:
+                logger.warning(f"tiktoken编码加载失败，改用估算: {e}")
+
+        self._lock = threading.Lock()
+        self._totals = self._new_stats()
+        # 当前轮次的统计（每轮独立，多轮并行时互不干扰）
+        self._round_stats = contextvars.ContextVar('letdance_compaction_stats', default=None)
+
+    @staticmethod
+    def _new_stats() -> Dict[str, int]:
+        return {'formatted_steps': 0, 'full_tokens': 0, 'compact_tokens': 0}
+
+    def count_tokens(self, text: str) -> int:
+        """统计token数（tiktoken不可用时按字符数估算）"""
+        if self._encoding is not None:
+            return len(self._encoding.encode(text))
+        return max(1, len(text) // 3)
+
+    def _serialize(self, observation: Any) -> str:
+        if isinstance(observation, str):
+            return observation
+        try:
+            return json.dumps(observation, ensure_ascii=False)
+        except Exception:
+            return str(observation)
+
+    def start_round(self) -> Dict[str, int]:
+        """开始一轮统计，返回本轮的统计字典（需在Agent调用前、同一上下文中调用）"""
+        stats = self._new_stats()
+        self._round_stats.set(stats)
+        return stats
+
+    def format_messages(self, intermediate_steps: Sequence[Tuple[Any, Any]]) -> List:
+        """create_tool_calling_agent的message_formatter"""
+        compact_steps = []
+        full_tokens = compact_tokens = 0
+
+        for action, observation in intermediate_steps:
+            compact = self._serialize(compact_tool_result(getattr(action, 'tool', ''), observation))
+            compact_steps.append((action, compact))
+
+            full_tokens += self.count_tokens(self._serialize(observation))
+            compact_tokens += self.count_tokens(compact)
+
+        round_stats = self._round_stats.get()
+        with self._lock:
+            for stats in (self._totals, round_stats):
+                if stats is None:
+                    continue
+                stats['formatted_steps'] += len(intermediate_steps)
+                stats['full_tokens'] += full_tokens
+                stats['compact_tokens'] += compact_tokens
+
+        return format_to_tool_messages(compact_steps)
+
+    def summarize(self, stats: Dict[str, int]) -> Dict[str, Any]:
+        """统计字典 -> 包含节省token数与比例的摘要"""
+        with self._lock:
+            summary = dict(stats)
+        summary['tokens_saved'] = summary['full_tokens'] - summary['compact_tokens']
+        summary['saved_ratio'] = (
+            round(summary['tokens_saved'] / summary['full_tokens'], 3) if summary['full_tokens'] else None
+        )
+        summary['token_counter'] = 'tiktoken' if self._encoding is not None else 'estimate'
+        return summary
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取进程内累计统计"""
+        return self.summarize(self._totals)